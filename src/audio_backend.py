@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# audio_backend.py
+#
+# The bits of AudioPlayer that actually make noise. The ALSA backend keeps
+# one PCM device open for the life of the process, the subprocess backend is
+# the original one aplay/espeak-ng process per clip approach.
+
+import logging
+import subprocess
+import time
+from contextlib import closing
+from threading import Event
+import startup
+np = startup.lazy_import("numpy")
+import pcm
+import metrics
+from transport import Transport, PLAYER_LEAD_SEC
+from speech_stream import SpeechStream
+
+_SPAWN_TIME = metrics.histogram("tattle_player_spawn_seconds", "Time taken to start an aplay or espeak-ng process")
+
+_SPEECH_UTIL = 'espeak-ng'
+_PLAYBACK_UTIL = 'aplay'
+_VOICE = 'en-us+f2'
+
+_DEFAULT_DEVICE = 'default'
+_DEFAULT_PERIOD_FRAMES = 512
+_DEFAULT_PERIODS = 4
+
+class SubprocessBackend():
+    """Spawns aplay (or espeak-ng) for every clip. Slow, but doesn't need
+    anything beyond the command line tools.
+    """
+    def __init__(self, device:str=None):
+        self._speech_util = startup.which(_SPEECH_UTIL)
+        self._playback_util = startup.which(_PLAYBACK_UTIL)
+        self._device_args = [] if device is None else ["-D", device]
+
+    def _run(self, args:list, interrupt:Event) -> bool:
+        """Run the given player until it finishes or we're interrupted
+
+        Args:
+            args (list): command line to run
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        with _SPAWN_TIME.time():
+            proc = subprocess.Popen(args)
+
+        # Wait for it to die.
+        while(proc.poll() is None):
+            if( interrupt.wait(timeout=0.2) ):
+                break
+        proc.kill()
+        proc.wait()
+        return not interrupt.is_set()
+
+    def play_file(self, file:str, interrupt:Event) -> bool:
+        # aplay only understands WAV, anything else we decode ourselves
+        if( str(file).lower().endswith(".wav") ):
+            return self._run([self._playback_util, *self._device_args, str(file)], interrupt)
+        with closing(pcm.output_chunks(file)) as chunks:
+            return self.play_stream(chunks, interrupt)
+
+    def play_text(self, text:str, interrupt:Event) -> bool:
+        return self._run([self._speech_util, f"-v{_VOICE}", text], interrupt)
+
+    def play_samples(self, samples:"np.ndarray", interrupt:Event) -> bool:
+        """Pipe already prepared samples through aplay
+
+        Args:
+            samples (np.ndarray): int16 samples in the output format
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        proc = self._open_raw_player()
+        try:
+            for start in range(0, len(samples), _DEFAULT_PERIOD_FRAMES):
+                if( interrupt.is_set() ):
+                    break
+                proc.stdin.write(samples[start:start + _DEFAULT_PERIOD_FRAMES].tobytes())
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self._finish_raw_player(proc, interrupt)
+
+    def play_transport(self, transport:Transport, interrupt:Event) -> bool:
+        """Pipe samples through aplay as the transport hands them out. aplay
+        can't be told to throw away what it's been given, so we only stay a
+        little ahead of it, which is how long a jump takes to be heard.
+
+        Args:
+            transport (Transport): what to play
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        proc = self._open_raw_player()
+        started = time.monotonic()
+        written = 0
+        try:
+            while( not interrupt.is_set() ):
+                ahead = written / pcm.OUTPUT_RATE - (time.monotonic() - started)
+                if( ahead > PLAYER_LEAD_SEC ):
+                    interrupt.wait(ahead - PLAYER_LEAD_SEC)
+                    continue
+                period = transport.read(_DEFAULT_PERIOD_FRAMES)
+                if( len(period) == 0 ):
+                    break
+                proc.stdin.write(period.tobytes())
+                written += len(period)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self._finish_raw_player(proc, interrupt)
+
+    def play_stream(self, chunks, interrupt:Event) -> bool:
+        """Pipe samples through aplay as they're produced, e.g. speech that's
+        still being synthesized
+
+        Args:
+            chunks (iterable): int16 sample arrays in the output format
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        proc = self._open_raw_player()
+        try:
+            for chunk in chunks:
+                if( interrupt.is_set() ):
+                    break
+                proc.stdin.write(chunk.tobytes())
+                proc.stdin.flush()
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self._finish_raw_player(proc, interrupt)
+
+    def _open_raw_player(self) -> subprocess.Popen:
+        with _SPAWN_TIME.time():
+            return subprocess.Popen([
+                    self._playback_util, *self._device_args, "-q", "-t", "raw", "-f", "S16_LE",
+                    "-r", str(pcm.OUTPUT_RATE), "-c", str(pcm.OUTPUT_CHANNELS), "-"],
+                stdin=subprocess.PIPE)
+
+    def _finish_raw_player(self, proc:subprocess.Popen, interrupt:Event) -> bool:
+        """Wait for aplay to play out what it's been given
+        """
+        while(proc.poll() is None):
+            if( interrupt.wait(timeout=0.2) ):
+                break
+        proc.kill()
+        proc.wait()
+        return not interrupt.is_set()
+
+    def close(self):
+        pass
+
+class AlsaBackend():
+    """Plays everything through a single ALSA PCM that is opened once and
+    kept open. Clips are converted to one fixed format and written a period
+    at a time, so a stop request is noticed within one period.
+    """
+    def __init__(self, device:str=_DEFAULT_DEVICE, period_frames:int=_DEFAULT_PERIOD_FRAMES, periods:int=_DEFAULT_PERIODS):
+        import alsaaudio
+        self._period_frames = period_frames
+        self._speech_util = startup.which(_SPEECH_UTIL)
+        self._pcm = alsaaudio.PCM(
+            type=alsaaudio.PCM_PLAYBACK,
+            mode=alsaaudio.PCM_NORMAL,
+            device=device,
+            rate=pcm.OUTPUT_RATE,
+            channels=pcm.OUTPUT_CHANNELS,
+            format=alsaaudio.PCM_FORMAT_S16_LE,
+            periodsize=period_frames,
+            periods=periods)
+
+        # How long it takes for a full device buffer to play out
+        self._buffer_seconds = period_frames * periods / pcm.OUTPUT_RATE
+
+    def play_samples(self, samples:"np.ndarray", interrupt:Event) -> bool:
+        """Write samples to the device a period at a time
+
+        Args:
+            samples (np.ndarray): int16 samples in the output format
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        for start in range(0, len(samples), self._period_frames):
+            if( interrupt.is_set() ):
+                self._pcm.drop()
+                return False
+            period = samples[start:start + self._period_frames]
+            if( len(period) < self._period_frames ):
+                period = np.pad(period, (0, self._period_frames - len(period)))
+            self._pcm.write(period.tobytes())
+        return self._drain(interrupt)
+
+    def play_transport(self, transport:Transport, interrupt:Event) -> bool:
+        """Write samples to the device as the transport hands them out. After
+        a jump whatever is still in the device buffer is dropped, so the jump
+        is heard straight away.
+
+        Args:
+            transport (Transport): what to play
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        while( True ):
+            if( interrupt.is_set() ):
+                self._pcm.drop()
+                return False
+            if( transport.take_jump() ):
+                self._pcm.drop()
+            period = transport.read(self._period_frames)
+            if( len(period) == 0 ):
+                break
+            if( len(period) < self._period_frames ):
+                period = np.pad(period, (0, self._period_frames - len(period)))
+            self._pcm.write(period.tobytes())
+        return self._drain(interrupt)
+
+    def play_stream(self, chunks, interrupt:Event) -> bool:
+        """Write samples to the device as they're produced, e.g. speech
+        that's still being synthesized. Each period goes out as soon as
+        there's enough for one.
+
+        Args:
+            chunks (iterable): int16 sample arrays in the output format
+            interrupt (Event): set when someone wants us to stop
+
+        Returns:
+            bool: True if it played to the end, False if interrupted
+        """
+        pending = np.zeros(0, dtype=np.int16)
+        for chunk in chunks:
+            if( interrupt.is_set() ):
+                self._pcm.drop()
+                return False
+            pending = np.concatenate((pending, chunk))
+            whole = len(pending) - len(pending) % self._period_frames
+            for start in range(0, whole, self._period_frames):
+                self._pcm.write(pending[start:start + self._period_frames].tobytes())
+            pending = pending[whole:]
+        if( interrupt.is_set() ):
+            self._pcm.drop()
+            return False
+        if( len(pending) > 0 ):
+            self._pcm.write(np.pad(pending, (0, self._period_frames - len(pending))).tobytes())
+        return self._drain(interrupt)
+
+    def _drain(self, interrupt:Event) -> bool:
+        """Let whatever is left in the device buffer play out
+        """
+        if( interrupt.wait(timeout=self._buffer_seconds) ):
+            self._pcm.drop()
+            return False
+        return True
+
+    def play_file(self, file:str, interrupt:Event) -> bool:
+        # Played as it's read, rather than converting the whole file first
+        with closing(pcm.output_chunks(file)) as chunks:
+            return self.play_stream(chunks, interrupt)
+
+    def play_text(self, text:str, interrupt:Event) -> bool:
+        stream = SpeechStream([self._speech_util, f"-v{_VOICE}", "--stdout", text])
+        try:
+            return self.play_stream(stream.chunks(), interrupt)
+        finally:
+            stream.close()
+
+    def close(self):
+        self._pcm.close()
+
+def create_backend(name:str, device:str=_DEFAULT_DEVICE):
+    """Build the named audio backend, falling back to subprocesses if the
+    ALSA bindings aren't available.
+
+    Args:
+        name (str): "alsa" or "subprocess"
+        device (str): ALSA device name for the alsa backend
+
+    Returns:
+        The backend
+    """
+    if( name == "alsa" ):
+        try:
+            return AlsaBackend(device)
+        except ImportError:
+            logging.warning("pyalsaaudio is not installed, falling back to the subprocess audio backend")
+        except Exception as e:
+            logging.warning("Unable to open ALSA device %s (%s), falling back to the subprocess audio backend", device, e)
+    elif( name != "subprocess" ):
+        raise ValueError(f"Unknown audio backend {name}")
+    return SubprocessBackend(device)
@@ -5,36 +5,60 @@
 # Class which exists to play audio, and which is made as a Thread so it
 # can be easily interrupted.
 
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import logging
-import subprocess
-import shutil
 import enum
 import time
 from queue import Queue
-
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+from tts_cache import TTSCache
+from audio_backend import SubprocessBackend
+from transport import Transport
+import metrics
 
 class PlayType(enum.Enum):
     PLAYER_KILL=0
     PLAYER_TEXT=1
     PLAYER_FILE=2
+    PLAYER_SAMPLES=3
+    PLAYER_TRANSPORT=4
 
-_SPEECH_UTIL = 'espeak-ng'
-_PLAYBACK_UTIL = 'aplay'
+_QUEUE_DEPTH = metrics.gauge("tattle_audio_queue_depth", "Clips waiting for the audio player")
+_START_LATENCY = metrics.histogram("tattle_playback_start_seconds", "Time from a clip being queued to it starting to play")
+_PLAY_ERRORS = metrics.counter("tattle_playback_errors_total", "Clips that failed to play")
 
 class AudioPlayer(Thread):
-    def __init__(self, output_queue:Queue):
+    def __init__(self, output_queue:Queue, tts_cache:TTSCache=None, backend=None, backend_factory=None):
+        """
+        Args:
+            output_queue (Queue): where to say we've finished playing
+            tts_cache (TTSCache, optional): where to get speech rendered
+            backend (optional): what to play audio through
+            backend_factory (callable, optional): builds the backend on the
+                player's own thread instead, so opening the sound card doesn't
+                hold up whoever is starting us. Defaults to a SubprocessBackend
+                if neither is given.
+        """
         super().__init__()
         self.name = "AudioPlayer"
         self._play_interrupt = Event()
         self._input_queue = Queue()
         self._output_queue = output_queue
-        self._proc = None
-
-        self._speech_util = shutil.which(_SPEECH_UTIL)
-        self._playback_util = shutil.which(_PLAYBACK_UTIL)
+        self._busy = False
+        self._lock = Lock()
+        # Goes up with every stop(), jobs queued before it are dropped even
+        # if we'd already taken them off the queue
+        self._generation = 0
+        self._tts_cache = tts_cache
+
+        # Speech being synthesized as it plays, so stop() can cut it off
+        self._speech = None
+
+        # Whatever actually makes the noise
+        self._backend = backend
+        self._backend_factory = backend_factory if backend_factory is not None else SubprocessBackend
+
+        # Set once we're able to play things
+        self.ready = Event()
     
     def is_busy(self) -> bool:
         """Let someone know if we're busy. Allows us to block while playing.
@@ -42,20 +66,32 @@ class AudioPlayer(Thread):
         Returns:
             bool: True if we're currently playing something, false otherwise.
         """
-        return self.proc is not None
+        return self._busy
     
     def kill(self):
-        self._input_queue.put((PlayType.PLAYER_KILL,0))
-        pass
+        self._queue_job(PlayType.PLAYER_KILL, 0)
+
+    def _queue_job(self, job_type:PlayType, item):
+        with self._lock:
+            self._input_queue.put((job_type, item, time.monotonic(), self._generation))
+        _QUEUE_DEPTH.set(self._input_queue.qsize())
 
     def stop(self):
         """Stop any ongoing playing happening right now
         """
-        self._play_interrupt.set()
-
-        # Get rid of anything in the queue
-        while(not self._input_queue.empty()):
-            _ = self._input_queue.get()
+        with self._lock:
+            self._generation += 1
+
+            # Get rid of anything in the queue
+            while(not self._input_queue.empty()):
+                _ = self._input_queue.get()
+
+            # Only interrupt something that's actually playing, otherwise
+            # we'd cut off whatever gets queued next.
+            if( self._busy ):
+                self._play_interrupt.set()
+                if( self._speech is not None ):
+                    self._speech.cancel()
     
     def play_text(self, text:str):
         """Render the given text as audio.
@@ -63,7 +99,7 @@ class AudioPlayer(Thread):
         Args:
             text (str): Text you would like converted to speech
         """
-        self._input_queue.put((PlayType.PLAYER_TEXT, text))
+        self._queue_job(PlayType.PLAYER_TEXT, text)
     
     def play_file(self, file:str):
         """Play the given file
@@ -71,57 +107,111 @@ class AudioPlayer(Thread):
         Args:
             file (str): file you would like converted to speech
         """
-        self._input_queue.put((PlayType.PLAYER_FILE, file))
+        self._queue_job(PlayType.PLAYER_FILE, file)
+
+    def play_samples(self, samples:"np.ndarray"):
+        """Play audio which has already been decoded, e.g. by the
+        playback pipeline.
+
+        Args:
+            samples (np.ndarray): int16 samples in the output format
+        """
+        self._queue_job(PlayType.PLAYER_SAMPLES, samples)
+
+    def play_transport(self, transport:Transport):
+        """Play prepared audio that can be jumped around in, or sped up,
+        while it plays
+
+        Args:
+            transport (Transport): what to play
+        """
+        self._queue_job(PlayType.PLAYER_TRANSPORT, transport)
 
     def run(self):
+        if( self._backend is None ):
+            self._backend = self._backend_factory()
+        self.ready.set()
+
         while(1):
             logging.info("AudioPlayer: Waiting for a request")
-            job_type, item = self._input_queue.get()
-
-            args = []
+            job_type, item, queued_at, generation = self._input_queue.get()
+            _QUEUE_DEPTH.set(self._input_queue.qsize())
+            with self._lock:
+                stale = generation != self._generation and job_type != PlayType.PLAYER_KILL
+                self._busy = not stale
+            if( stale ):
+                logging.debug("AudioPlayer: Stopped before it started, dropping %s", job_type.name)
+                continue
+
+            play = None
             if( job_type == PlayType.PLAYER_TEXT ):
-                logging.info("AudioPlayer: I've been asked to play this text '{}'".format(item))
-                # formulate my arguments and start the process
-                args = [
-                    self._speech_util,
-                    "-ven-us+f2",
-                    item]
+                logging.info("AudioPlayer: I've been asked to play this text '%s'", item)
+                # Play it from the cache if we can, otherwise start playing
+                # while it's synthesized, and cache it on the way
+                rendered = None
+                if( self._tts_cache is not None ):
+                    rendered = self._tts_cache.cached(item)
+                    if( rendered is None ):
+                        try:
+                            speech = self._tts_cache.stream(item)
+                        except (OSError, TypeError) as e:
+                            logging.error("AudioPlayer: Unable to synthesize '%s': %s", item, e)
+                        else:
+                            with self._lock:
+                                self._speech = speech
+
+                if( rendered is not None ):
+                    play = lambda: self._backend.play_file(rendered, self._play_interrupt)
+                elif( self._speech is not None ):
+                    play = lambda: self._backend.play_stream(self._speech.chunks(), self._play_interrupt)
+                else:
+                    play = lambda: self._backend.play_text(item, self._play_interrupt)
                 
             elif( job_type == PlayType.PLAYER_FILE ):
-                logging.info("AudioPlayer: I've been asked to play this file '{}'".format(item))
-                # Formulate my rguments and start the process
-                args = [
-                    self._playback_util,
-                    item
-                ]
+                logging.info("AudioPlayer: I've been asked to play this file '%s'", item)
+                play = lambda: self._backend.play_file(item, self._play_interrupt)
+
+            elif( job_type == PlayType.PLAYER_SAMPLES ):
+                logging.info("AudioPlayer: I've been asked to play %d prepared samples", len(item))
+                play = lambda: self._backend.play_samples(item, self._play_interrupt)
+
+            elif( job_type == PlayType.PLAYER_TRANSPORT ):
+                logging.info("AudioPlayer: I've been asked to play %.1fs of audio with transport controls", item.duration)
+                play = lambda: self._backend.play_transport(item, self._play_interrupt)
 
             # Let's stop this crazy ride!
             elif( job_type == PlayType.PLAYER_KILL ):
                 logging.info("AudioPlayer: It seems I've been told to die")
-                if( self.proc is not None ):
-                    self.proc.kill()
+                self._backend.close()
                 break
             
             else:
-                logging.error(f"AudioPlayer: Unrecognized job type {job_type}:{item}")
+                logging.error("AudioPlayer: Unrecognized job type %s:%s", job_type, item)
+                with self._lock:
+                    self._busy = False
             
-            # Open a process to play somethign
-            if( len(args) > 0 ):
-                self.proc = subprocess.Popen(args)
-
-                # Wait for it to die.
-                while(self.proc.poll() is None):
-                    if( self._play_interrupt.wait(timeout=0.2) ):
-                        break
-                self.proc.kill()
-                self.proc = None
-                if( self._play_interrupt.is_set() ):
-                    logging.debug("AudioPlayer: Looks like someone called STOP. Clearing the event")
+            # Play something
+            if( play is not None ):
+                _START_LATENCY.observe(time.monotonic() - queued_at)
+                try:
+                    play()
+                except Exception as e:
+                    _PLAY_ERRORS.inc()
+                    logging.error("AudioPlayer: Failed to play %s: %s", item, e)
+                with self._lock:
+                    speech, self._speech = self._speech, None
+                if( speech is not None ):
+                    speech.close()
+                with self._lock:
+                    self._busy = False
+                    interrupted = self._play_interrupt.is_set()
                     self._play_interrupt.clear()
-                else:
-                    logging.debug("AudioPlayer: It seems I've died of my own accord, continue!")
 
-                if( self._input_queue.empty() ):
+                # Whoever stopped us has already moved on, so don't tell them
+                # we're done, they'd take it as the end of whatever they play next.
+                if( interrupted ):
+                    logging.debug("AudioPlayer: Looks like someone called STOP. Clearing the event")
+                elif( self._input_queue.empty() ):
                     logging.debug("AudioPlayer: Queue is empty! Telling the caller that I'm ready for more")
                     self._output_queue.put(("AUDIO", None))
 
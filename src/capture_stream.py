@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# capture_stream.py
+#
+# Keeps arecord running while the handset is off the hook, holding the last
+# couple of seconds of microphone audio in memory. A recording can then
+# start with audio from before it was asked for, instead of losing whatever
+# was said while arecord started up.
+
+import collections
+import logging
+import subprocess
+import time
+from threading import Thread, Lock
+import metrics
+import startup
+from voice_recorder import CAPTURE_RATE, CAPTURE_CHANNELS, capture_args
+
+_RECORD_EXECUTABLE = 'arecord'
+
+# 50ms of S16 samples at a time
+_CHUNK_FRAMES = CAPTURE_RATE // 20
+_BYTES_PER_FRAME = 2 * CAPTURE_CHANNELS
+_DEFAULT_RING_SEC = 2.0
+
+_PREROLL = metrics.histogram("tattle_capture_preroll_seconds", "Audio from before the recording was started that was flushed into it",
+                             buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0))
+
+class CaptureStream(Thread):
+    """Runs arecord continuously, keeping a ring buffer of the most recent
+    chunks. Whoever is attached gets the buffered chunks they asked for and
+    then every new chunk as it arrives.
+    """
+    def __init__(self, ring_sec:float=_DEFAULT_RING_SEC, device:str=None):
+        """
+        Args:
+            ring_sec (float, optional): how much audio to keep. Defaults to 2 seconds.
+            device (str, optional): ALSA device to capture from, None for arecord's default
+        """
+        super().__init__(daemon=True)
+        self.name = "CaptureStream"
+        self._executable = startup.which(_RECORD_EXECUTABLE)
+        self._device = device
+        self._chunk_bytes = _CHUNK_FRAMES * _BYTES_PER_FRAME
+        self._chunk_sec = _CHUNK_FRAMES / CAPTURE_RATE
+        self._ring = collections.deque(maxlen=max(1, int(ring_sec / self._chunk_sec)))
+        self._lock = Lock()
+        self._sink = None
+        self._proc = None
+        self._keep_going = True
+
+    def attach(self, sink, since:float) -> bool:
+        """Start sending audio somewhere, beginning with what's buffered
+
+        Args:
+            sink (callable): called with each chunk of raw capture data, on
+                this thread, so it must not block
+            since (float): time.monotonic() of the earliest audio wanted
+
+        Returns:
+            bool: False if the stream isn't running, so the caller needs to
+                capture for itself
+        """
+        with self._lock:
+            if( not self._keep_going or not self.is_alive() ):
+                return False
+            flushed = 0
+            for received, chunk in self._ring:
+                # received is when the chunk finished, keep any that overlap
+                if( received >= since ):
+                    sink(chunk)
+                    flushed += 1
+            self._sink = sink
+        _PREROLL.observe(flushed * self._chunk_sec)
+        logging.debug("CaptureStream: Flushed %.2fs of pre-roll", flushed * self._chunk_sec)
+        return True
+
+    def detach(self):
+        """Stop sending audio to the sink
+        """
+        with self._lock:
+            self._sink = None
+
+    def run(self):
+        with self._lock:
+            if( not self._keep_going ):
+                return
+            self._proc = subprocess.Popen(capture_args(self._executable, "-", self._device), stdout=subprocess.PIPE)
+        logging.debug("CaptureStream: Warmed up")
+        while( self._keep_going ):
+            chunk = self._proc.stdout.read(self._chunk_bytes)
+            if( len(chunk) == 0 ):
+                if( self._keep_going ):
+                    logging.error("CaptureStream: arecord stopped unexpectedly")
+                break
+            with self._lock:
+                self._ring.append((time.monotonic(), chunk))
+                if( self._sink is not None ):
+                    self._sink(chunk)
+        with self._lock:
+            self._keep_going = False
+            self._sink = None
+        self._proc.wait()
+        logging.debug("CaptureStream: Stopped")
+
+    def kill(self):
+        """Stop capturing, anyone still attached just stops getting audio
+        """
+        with self._lock:
+            self._keep_going = False
+            proc = self._proc
+        if( proc is not None and proc.poll() is None ):
+            proc.terminate()
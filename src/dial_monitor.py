@@ -4,92 +4,89 @@
 #
 # A class to monitor the dial as it turns and report new digits back to the owner
 
-import RPi.GPIO as GPIO
+import gpio_backend
+import metrics
 from queue import Queue
-from threading import Thread, Lock, Timer, Event
 import logging
-import time
 
-class PulseCollector(Thread):
-    def __init__(self, timeout, output_queue):
-        super().__init__(daemon=True)
-        self._timeout = timeout
-        self._output_queue = output_queue
-        self._event = Event()
-        self._digit = 0
-        self._keep_going = True
-        self.name="PulseCollector"
-    
-    def run(self):
-        while self._keep_going:
-            # Wait for first pulse
-            if( self._event.wait(timeout=2) ):
-
-                # Wait for subsequent pulses
-                while self._event.is_set():
-                    self._digit += 1
-                    self._event.clear()
-                    self._event.wait(self._timeout)
-
-                # Output the digit to the customer
-                logging.debug( "Collected a digit: {} ".format(self._digit))
-                if( self._digit >= 10 ):
-                    logging.debug( f"Correcting {self._digit} to 0")
-                    self._digit = 0
-
-                self._output_queue.put( ("DIAL", self._digit) )
-                self._digit = 0
-    
-    def kill(self):
-        """Kill this thread
-        """
-        self._keep_going = False
-    
-    def pulse(self):
-        logging.debug("Setting the event")
-        self._event.set()
-
-class ButtonHandler(Thread):
-    """Class to act as a software debouncer for the rotary dial.
-    """
-    def __init__(self, pin, func, edge='both', bouncetime=10):
-        super().__init__(daemon=True)
-        self.edge = edge
-        self.func = func
-        self.pin = pin
-        self.bouncetime = float(bouncetime)/1000
-        self.lastpinval = GPIO.input(self.pin)
-        self.lock = Lock()
-        self.name="ButtonHandler"
-
-    def __call__(self, *args):
-        if not self.lock.acquire(blocking=False):
-            return
-        t = Timer(self.bouncetime, self.read, args=args)
-        t.start()
-
-    def read(self, *args):
-        pinval = GPIO.input(self.pin)
-        if (
-                ((pinval == 0 and self.lastpinval == 1) and
-                 (self.edge in ['falling', 'both'])) or
-                ((pinval == 1 and self.lastpinval == 0) and
-                 (self.edge in ['rising', 'both']))
-        ):
-            self.func(*args)
-        self.lastpinval = pinval
-        self.lock.release()
-
-
-class DialMonitor(Thread):
-    """A class to monitor the phone dial and report back new digits as they arrive
+_PULSES_PER_DIGIT = metrics.histogram("tattle_dial_pulses_per_digit", "Pulses counted for each dialed digit", buckets=range(1, 11))
+_DEBOUNCE_REJECTS = metrics.counter("tattle_dial_debounce_rejections_total", "Dial edges ignored as contact bounce")
+
+class PulseDecoder():
+    """Turns dial pulse timestamps into digits. Edges closer together than
+    the debounce time are contact bounce and ignored, a gap of more than the
+    digit gap since the last pulse ends the digit.
     """
-    
-    __KILL_CODE = -1
+    def __init__(self, debounce:float, digit_gap:float):
+        self.debounce = debounce
+        self.digit_gap = digit_gap
+        self.rejected = 0
+        self._pulses = 0
+        self._last_pulse = None
+
+    def _finish(self) -> int:
+        digit = self._pulses
+        self._pulses = 0
+        _PULSES_PER_DIGIT.observe(digit)
+        logging.debug("Collected a digit: %d", digit)
+        if( digit >= 10 ):
+            logging.debug("Correcting %d to 0", digit)
+            digit = 0
+        return digit
+
+    def feed(self, timestamp:float) -> int:
+        """Add a pulse edge
+
+        Args:
+            timestamp (float): when the edge happened
+
+        Returns:
+            int: the previous digit if this edge started a new one, else None
+        """
+        digit = None
+        if( self._last_pulse is not None ):
+            interval = timestamp - self._last_pulse
+            if( interval < self.debounce ):
+                self.rejected += 1
+                _DEBOUNCE_REJECTS.inc()
+                return None
+            if( self._pulses > 0 and interval >= self.digit_gap ):
+                digit = self._finish()
+        self._pulses += 1
+        self._last_pulse = timestamp
+        return digit
+
+    def poll(self, now:float) -> int:
+        """Check whether the digit in progress has finished
+
+        Args:
+            now (float): the current time
 
-    def __init__(self, dial_pin:int, output_queue:Queue, kill_timeout=5, pulse_timeout=0.15) -> None:
-        super().__init__()
+        Returns:
+            int: the digit if it's finished, else None
+        """
+        if( self._pulses > 0 and now - self._last_pulse >= self.digit_gap ):
+            return self._finish()
+        return None
+
+    def deadline(self) -> float:
+        """When the digit in progress will be finished if no more pulses arrive
+
+        Returns:
+            float: the time, or None if there's no digit in progress
+        """
+        if( self._pulses == 0 ):
+            return None
+        return self._last_pulse + self.digit_gap
+
+class DialMonitor():
+    """A class to monitor the phone dial and report back new digits as they arrive.
+    Pulses are timestamped as they happen and handed to us on the shared edge
+    dispatcher's thread, and the digits are decoded from the timing between
+    them. A timer on the dispatcher finishes each digit when the pulses stop.
+    """
 
+    def __init__(self, dial_pin:int, output_queue:Queue, kill_timeout=5, pulse_timeout=0.15, debounce=0.03, dispatcher=None) -> None:
         # Config items
         self.dial_pin = dial_pin
         self.kill_timeout = kill_timeout
@@ -97,58 +94,65 @@ class DialMonitor(Thread):
         self.name = "DialMonitor"
 
         # inter-thread comms
-        self._input_queue = Queue()
         self._output_queue = output_queue
+        self._dispatcher = dispatcher
+        self._timer_armed = False
+        self._running = False
 
-        # initialize State
-        self.digit = 0
+        # Turns timestamps into digits
+        self.decoder = PulseDecoder(debounce, pulse_timeout)
 
-        # Create our pulse collector
-        self.pulse_collector = PulseCollector(pulse_timeout, self._output_queue)
+    def start(self):
+        """Start watching the dial
+        """
+        if( self._dispatcher is None ):
+            self._dispatcher = gpio_backend.get_dispatcher()
+        self._running = True
+        self._dispatcher.watch(self.dial_pin, gpio_backend.RISING, self._on_pulse)
 
-        # Created our Button Handler
-        self.button_handler = ButtonHandler(dial_pin, self._collect_pulses, edge='rising', bouncetime=10)
-    
     def kill(self):
-        """Tell this guy to terminate.
+        """Stop watching the dial, takes effect immediately.
         """
-        self._input_queue.put(DialMonitor.__KILL_CODE)
+        self._running = False
+        if( self._dispatcher is not None ):
+            self._dispatcher.unwatch(self.dial_pin)
+        logging.info('Exiting...')
 
-    def _collect_pulses(self, pin):
-        """Forwarding off to the pulse collector
+    def join(self, timeout=None):
+        """Nothing to wait for, there's no thread of our own. Here so the
+        monitor can be shut down like every other worker.
+        """
+        pass
 
-        Args:
-            pin (int): the GPIO pin that generated the pulse
+    def _emit(self, digit:int):
+        if( digit is not None and self._running ):
+            self._output_queue.put( ("DIAL", digit) )
+
+    def _arm(self):
+        """Make sure we'll look again when the digit in progress should end
         """
-        logging.debug("Got a pulse, sending to pulse collector.")
-        self.pulse_collector.pulse()
-    
-    def run(self):
-        self.running = True
-        GPIO.add_event_detect( self.dial_pin, GPIO.BOTH, callback=self.button_handler )
-
-        # Start the pulse collector
-        self.pulse_collector.start()
-        
-        # Wait for someone to kill me
-        while self.running:
-            item = self._input_queue.get()
-            logging.debug("Received message {}".format(item))
-            if( item == DialMonitor.__KILL_CODE ):
-                self.running = False
-            else:
-                logging.info("Received an unknown message from input_queue: '{}'".format(item))
-        
-        # Clean up our 2 threads
-        self.pulse_collector.kill()
-        self.pulse_collector.join()
-        logging.info('Exiting...')
+        deadline = self.decoder.deadline()
+        if( deadline is not None and not self._timer_armed ):
+            self._timer_armed = True
+            self._dispatcher.call_at(deadline, self._on_deadline)
+
+    def _on_pulse(self, pin, timestamp):
+        self._emit(self.decoder.feed(timestamp))
+        self._arm()
+
+    def _on_deadline(self):
+        # Later pulses push the deadline back, in which case this finds
+        # nothing and we go round again
+        self._timer_armed = False
+        self._emit(self.decoder.poll(self._dispatcher.clock()))
+        self._arm()
 
 if __name__ == "__main__":
     # Setup GPIO
     dial_pin = 16
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(dial_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO = gpio_backend.get_gpio()
+    GPIO.setmode(gpio_backend.BOARD)
+    GPIO.setup(dial_pin, gpio_backend.IN, pull_up_down=gpio_backend.PUD_UP)
 
     # Run a test to see if we can monitor the hook
     logging.basicConfig(level=logging.INFO)
@@ -166,4 +170,5 @@ if __name__ == "__main__":
         logging.info( "{} Digit: {}".format(source,change))
     dial_monitor.kill()
     dial_monitor.join()
+    gpio_backend.stop_dispatcher()
     GPIO.cleanup()
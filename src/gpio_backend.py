@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+# gpio_backend.py
+#
+# Stands between the monitors and RPi.GPIO so that the phone can be driven
+# off the Pi. The simulator replays traces of recorded edges, at real time or
+# sped up, and the capturing backend records those traces on real hardware.
+# The edge dispatcher is the one thread that acts on edges from every pin.
+
+import csv
+import heapq
+import itertools
+import logging
+import time
+from array import array
+from threading import Thread, Lock, Event
+import metrics
+
+# Same values RPi.GPIO uses, so either backend can be handed either constant
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+_TRACE_HEADER = ["timestamp", "pin", "level"]
+
+_EDGE_OVERFLOWS = metrics.counter("tattle_gpio_edge_overflows_total", "Edges lost because the dispatcher fell behind")
+_HANDLER_ERRORS = metrics.counter("tattle_gpio_handler_errors_total", "Edge handlers or timers that raised")
+
+_gpio = None
+_dispatcher = None
+
+def get_gpio():
+    """Get the GPIO backend in use, the real hardware unless someone has
+    said otherwise.
+
+    Returns:
+        the backend
+    """
+    global _gpio
+    if( _gpio is None ):
+        _gpio = HardwareGPIO()
+    return _gpio
+
+def use(backend):
+    """Choose the GPIO backend everyone should use. Must be called before
+    any monitors are created.
+
+    Args:
+        backend: HardwareGPIO, SimulatedGPIO or CapturingGPIO
+    """
+    global _gpio
+    _gpio = backend
+
+def get_dispatcher():
+    """Get the edge dispatcher, starting it on the GPIO backend in use if
+    it isn't running yet.
+
+    Returns:
+        EdgeDispatcher: the dispatcher
+    """
+    global _dispatcher
+    if( _dispatcher is None ):
+        _dispatcher = EdgeDispatcher(get_gpio())
+        _dispatcher.start()
+    return _dispatcher
+
+def stop_dispatcher():
+    """Stop the edge dispatcher, if it's running
+    """
+    global _dispatcher
+    if( _dispatcher is not None ):
+        _dispatcher.kill()
+        _dispatcher.join()
+        _dispatcher = None
+
+def _edge_matches(edge:int, level:int) -> bool:
+    return edge == BOTH or (edge == RISING and level == HIGH) or (edge == FALLING and level == LOW)
+
+def read_trace(path:str) -> list:
+    """Load a trace file
+
+    Args:
+        path (str): CSV file with timestamp, pin and level columns
+
+    Returns:
+        list: (timestamp, pin, level) tuples, in time order
+    """
+    with open(path, newline="") as f:
+        rows = [(float(row["timestamp"]), int(row["pin"]), int(row["level"])) for row in csv.DictReader(f)]
+    return sorted(rows)
+
+def write_trace(path:str, rows):
+    """Save a trace file
+
+    Args:
+        path (str): where to write it
+        rows (iterable): (timestamp, pin, level) tuples
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(_TRACE_HEADER)
+        writer.writerows(rows)
+
+class HardwareGPIO():
+    """The real thing, everything not defined here is passed on to RPi.GPIO
+    """
+    time_scale = 1.0
+
+    def __init__(self):
+        import RPi.GPIO
+        self._gpio = RPi.GPIO
+
+    def __getattr__(self, name):
+        return getattr(self._gpio, name)
+
+    def clock(self) -> float:
+        """The clock that edge times are measured against
+
+        Returns:
+            float: seconds
+        """
+        return time.monotonic()
+
+class CapturingGPIO(HardwareGPIO):
+    """Real hardware, but every edge on a monitored pin is also written to a
+    trace file that the simulator can replay later.
+    """
+    def __init__(self, trace_path:str):
+        super().__init__()
+        self._file = open(trace_path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(_TRACE_HEADER)
+        self._lock = Lock()
+
+    def _record(self, pin:int, level:int):
+        with self._lock:
+            self._writer.writerow((f"{self.clock():.6f}", pin, level))
+            self._file.flush()
+
+    def setup(self, pin, direction, **kwargs):
+        self._gpio.setup(pin, direction, **kwargs)
+        if( direction == IN ):
+            self._record(pin, self._gpio.input(pin))
+
+    def add_event_detect(self, pin, edge, callback=None, **kwargs):
+        """Watch both edges whatever was asked for, so the trace has every
+        level change in it, but only pass on the ones the caller wanted.
+        """
+        def capture(channel):
+            level = self._gpio.input(channel)
+            self._record(channel, level)
+            if( callback is not None and _edge_matches(edge, level) ):
+                callback(channel)
+        self._gpio.add_event_detect(pin, BOTH, callback=capture, **kwargs)
+
+    def cleanup(self, *args):
+        self._gpio.cleanup(*args)
+        with self._lock:
+            self._file.close()
+
+class SimulatedGPIO():
+    """Pretend GPIO pins. Levels are changed with set_level(), or by
+    replaying a trace, and callbacks fire just like they do on the Pi.
+
+    The simulator keeps its own clock which runs `speed` times faster than
+    real time, so that traces can be replayed faster than they happened.
+    Anything waiting on edge timing should divide its waits by time_scale.
+    """
+    BOARD = BOARD
+    BCM = BCM
+    OUT = OUT
+    IN = IN
+    LOW = LOW
+    HIGH = HIGH
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    def __init__(self, speed:float=1.0):
+        self.time_scale = float(speed)
+        self._real_start = time.monotonic()
+        self._levels = {}
+        self._callbacks = {}
+        self._lock = Lock()
+
+    def clock(self) -> float:
+        """Simulated time, starting at zero
+
+        Returns:
+            float: seconds
+        """
+        return (time.monotonic() - self._real_start) * self.time_scale
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+        with self._lock:
+            if( direction == OUT ):
+                self._levels[pin] = initial
+            else:
+                self._levels.setdefault(pin, HIGH if pull_up_down == PUD_UP else LOW)
+
+    def input(self, pin) -> int:
+        with self._lock:
+            return self._levels.get(pin, LOW)
+
+    def output(self, pin, level):
+        self.set_level(pin, level)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            self._callbacks[pin] = [(edge, callback)] if callback is not None else []
+
+    def add_event_callback(self, pin, callback):
+        with self._lock:
+            callbacks = self._callbacks.setdefault(pin, [])
+            callbacks.append((callbacks[0][0] if callbacks else BOTH, callback))
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._callbacks.pop(pin, None)
+
+    def cleanup(self, *args):
+        with self._lock:
+            self._callbacks.clear()
+
+    def set_level(self, pin:int, level:int):
+        """Drive a pin to the given level, firing callbacks if it changed
+
+        Args:
+            pin (int): the pin
+            level (int): HIGH or LOW
+        """
+        with self._lock:
+            if( self._levels.get(pin) == level ):
+                return
+            self._levels[pin] = level
+            callbacks = list(self._callbacks.get(pin, []))
+        for edge, callback in callbacks:
+            if( _edge_matches(edge, level) ):
+                callback(pin)
+
+    def replay(self, rows, start:bool=True) -> Thread:
+        """Replay a trace against the simulated clock. Trace times are taken
+        relative to the first row, which happens immediately.
+
+        Args:
+            rows (list): (timestamp, pin, level) tuples, e.g. from read_trace()
+            start (bool, optional): start the replay thread. Defaults to True.
+
+        Returns:
+            Thread: the thread doing the replay
+        """
+        def run():
+            if( len(rows) == 0 ):
+                return
+            offset = self.clock() - rows[0][0]
+            for timestamp, pin, level in rows:
+                delay = (timestamp + offset - self.clock()) / self.time_scale
+                if( delay > 0 ):
+                    time.sleep(delay)
+                self.set_level(pin, level)
+            logging.debug("SimulatedGPIO: Replayed %d edges", len(rows))
+
+        thread = Thread(target=run, name="GPIOReplay", daemon=True)
+        if( start ):
+            thread.start()
+        return thread
+
+class EdgeRing():
+    """Fixed size ring buffer of (pin, timestamp) edges. GPIO callbacks
+    are the writers and the dispatcher the only reader, so all a callback
+    does is store a couple of numbers and bump an index, under a lock that
+    is never held for long.
+    """
+    def __init__(self, size:int=256):
+        self._pins = array('i', bytes(4 * size))
+        self._times = array('d', bytes(8 * size))
+        self._size = size
+        self._head = 0
+        self._tail = 0
+        self._lock = Lock()
+        self.overflows = 0
+
+    def push(self, pin:int, timestamp:float):
+        # Replays and the hardware can both be writing, so don't trust a
+        # single writer here
+        with self._lock:
+            index = self._head % self._size
+            self._pins[index] = pin
+            self._times[index] = timestamp
+            self._head += 1
+
+    def pop_all(self) -> list:
+        """Take everything that's arrived since the last call
+
+        Returns:
+            list: (pin, timestamp) tuples, oldest first
+        """
+        # Held just long enough to copy the slots, so a writer can't reuse
+        # one while we're reading it
+        with self._lock:
+            head = self._head
+            lost = max(0, head - self._tail - self._size)
+            if( lost > 0 ):
+                # The writers lapped us, the oldest edges are gone
+                self._tail = head - self._size
+            edges = [(self._pins[i % self._size], self._times[i % self._size]) for i in range(self._tail, head)]
+            self._tail = head
+        if( lost > 0 ):
+            self.overflows += lost
+            _EDGE_OVERFLOWS.inc(lost)
+        return edges
+
+class EdgeDispatcher(Thread):
+    """The one thread that acts on GPIO edges. The GPIO callbacks only
+    timestamp each edge, then the dispatcher hands it to whoever is watching
+    that pin. Handlers can also ask to be called back at a later time on the
+    backend's clock, e.g. to see whether a level has been held long enough,
+    so nothing needs its own thread to poll or sleep.
+
+    Handlers and timers all run on this thread, one at a time, so they must
+    be quick and never block.
+    """
+    def __init__(self, gpio=None):
+        super().__init__(daemon=True)
+        self.name = "EdgeDispatcher"
+        self._gpio = gpio if gpio is not None else get_gpio()
+        self._edges = EdgeRing()
+        self._wake = Event()
+        self._lock = Lock()
+        self._handlers = {}
+        self._timers = []
+        self._sequence = itertools.count()
+        self._keep_going = True
+
+        # Set once edges are being dispatched
+        self.ready = Event()
+
+    @property
+    def gpio(self):
+        return self._gpio
+
+    def clock(self) -> float:
+        """The clock edge timestamps and timer deadlines use
+
+        Returns:
+            float: seconds
+        """
+        return self._gpio.clock()
+
+    def watch(self, pin:int, edge:int, handler):
+        """Start delivering edges on a pin
+
+        Args:
+            pin (int): the pin, which must already be set up as an input
+            edge (int): RISING, FALLING or BOTH
+            handler (callable): called as handler(pin, timestamp) on this thread
+        """
+        with self._lock:
+            if( pin in self._handlers ):
+                raise ValueError(f"Pin {pin} is already being watched")
+            self._handlers[pin] = handler
+        self._gpio.add_event_detect(pin, edge, callback=self._on_edge)
+
+    def unwatch(self, pin:int):
+        """Stop delivering edges on a pin. Anything already queued for it
+        is dropped.
+
+        Args:
+            pin (int): the pin
+        """
+        with self._lock:
+            if( self._handlers.pop(pin, None) is None ):
+                return
+        self._gpio.remove_event_detect(pin)
+
+    def call_at(self, deadline:float, callback):
+        """Call something on this thread once the clock reaches a deadline
+
+        Args:
+            deadline (float): time on the clock()
+            callback (callable): called with no arguments
+        """
+        with self._lock:
+            heapq.heappush(self._timers, (deadline, next(self._sequence), callback))
+        self._wake.set()
+
+    def kill(self):
+        """Stop dispatching, right away
+        """
+        self._keep_going = False
+        self._wake.set()
+
+    def _on_edge(self, pin):
+        self._edges.push(pin, self._gpio.clock())
+        self._wake.set()
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            _HANDLER_ERRORS.inc()
+            logging.exception("EdgeDispatcher: Handler failed")
+
+    def _timeout(self) -> float:
+        with self._lock:
+            if( len(self._timers) == 0 ):
+                return None
+            deadline = self._timers[0][0]
+        return max(0, deadline - self.clock()) / self._gpio.time_scale
+
+    def run(self):
+        self.ready.set()
+        while( self._keep_going ):
+            self._wake.wait(self._timeout())
+            self._wake.clear()
+
+            for pin, timestamp in self._edges.pop_all():
+                with self._lock:
+                    handler = self._handlers.get(pin)
+                if( handler is not None ):
+                    self._call(handler, pin, timestamp)
+
+            now = self.clock()
+            due = []
+            with self._lock:
+                while( len(self._timers) > 0 and self._timers[0][0] <= now ):
+                    due.append(heapq.heappop(self._timers)[2])
+            for callback in due:
+                self._call(callback)
+
+        logging.info('EdgeDispatcher: Exiting...')
+
+class TraceBuilder():
+    """Builds synthetic traces of someone using the phone, for load testing.
+    Levels follow the wiring in the README: the hook pin reads HIGH when the
+    handset is lifted, and the dial pin pulses HIGH once per count.
+    """
+    def __init__(self, hook_pin:int, dial_pin:int, pulse_period:float=0.1, pulse_high:float=0.04):
+        self.hook_pin = hook_pin
+        self.dial_pin = dial_pin
+        self.pulse_period = pulse_period
+        self.pulse_high = pulse_high
+        self.now = 0.0
+        self.rows = [(0.0, hook_pin, LOW), (0.0, dial_pin, LOW)]
+
+    def wait(self, seconds:float):
+        self.now += seconds
+        return self
+
+    def hook(self, off_hook:bool):
+        self.rows.append((self.now, self.hook_pin, HIGH if off_hook else LOW))
+        return self
+
+    def dial(self, digit:int, gap:float=0.5):
+        """Dial a digit, followed by the pause before the next one
+
+        Args:
+            digit (int): 0 - 9
+            gap (float, optional): quiet time after the digit. Defaults to 0.5.
+        """
+        for _ in range(10 if digit == 0 else digit):
+            self.rows.append((self.now, self.dial_pin, HIGH))
+            self.rows.append((self.now + self.pulse_high, self.dial_pin, LOW))
+            self.now += self.pulse_period
+        self.now += gap
+        return self
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Capture a trace of GPIO edges on real hardware")
+    parser.add_argument("trace", help="CSV file to write the trace to")
+    parser.add_argument("--pins", help="Pins to watch", type=int, nargs="+", default=[12, 16])
+    parser.add_argument("--seconds", help="How long to capture for", type=float, default=30)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    gpio = CapturingGPIO(args.trace)
+    gpio.setmode(BOARD)
+    for pin in args.pins:
+        gpio.setup(pin, IN, pull_up_down=PUD_UP)
+        gpio.add_event_detect(pin, BOTH)
+    logging.info(f"Capturing pins {args.pins} for {args.seconds} seconds")
+    time.sleep(args.seconds)
+    gpio.cleanup()
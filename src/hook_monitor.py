@@ -4,23 +4,91 @@
 # 
 # Monitors the hook
 
-import RPi.GPIO as GPIO
+import gpio_backend
+import metrics
 from queue import Queue
-from threading import Thread, Lock
+from threading import Lock
 import logging
-import time
 from enum import IntEnum
 
 class HookState(IntEnum):
     HOOK_ON=0
     HOOK_OFF=1
 
-class HookMonitor(Thread):
-    """Monitor the hook switch and signal when the phone is off/on the hook
+# How long the hook has to stay put before we believe it moved. Lifting the
+# handset should get a response quickly, but putting it down ends the call so
+# we want to be sure it wasn't just knocked.
+DEFAULT_HOLD_OFF = 0.05
+DEFAULT_HOLD_ON = 0.25
+
+_HOOK_EDGES = metrics.counter("tattle_hook_edges_total", "Edges seen on the hook switch")
+_HOOK_CHANGES = metrics.counter("tattle_hook_changes_total", "Hook changes that were held long enough to be reported")
+
+class HoldFilter():
+    """Decides when a bouncy switch has really changed. A new level only
+    counts once it has been held for the minimum time, and that time depends
+    on which level it is, so the switch can be quick to go one way and slow
+    to come back (hysteresis). Knows nothing about GPIO or threads, it's fed
+    edges and asked to look again at deadline().
+    """
+    def __init__(self, level:int, hold_times:dict):
+        """
+        Args:
+            level (int): the level the switch is sitting at now
+            hold_times (dict): seconds each level must be held for, keyed on level
+        """
+        self.level = level
+        self._hold_times = dict(hold_times)
+        self._pending = level
+        self._since = None
+
+    def edge(self, timestamp:float, level:int):
+        """The switch moved
+
+        Args:
+            timestamp (float): when
+            level (int): the level it moved to
+        """
+        self._pending = level
+        self._since = timestamp
+
+    def poll(self, now:float, level:int) -> int:
+        """Check whether the pending level has been held long enough
+
+        Args:
+            now (float): the current time
+            level (int): the level the switch is at now
+
+        Returns:
+            int: the new level if it changed, else None
+        """
+        if( level != self._pending ):
+            # We missed an edge, start timing from here
+            self.edge(now, level)
+            return None
+        if( self._pending == self.level or now - self._since < self._hold_times[self._pending] ):
+            return None
+        self.level = self._pending
+        return self.level
+
+    def deadline(self) -> float:
+        """When the pending level will have been held long enough
+
+        Returns:
+            float: the time, or None if nothing is pending
+        """
+        if( self._pending == self.level ):
+            return None
+        return self._since + self._hold_times[self._pending]
+
+class HookMonitor():
+    """Monitor the hook switch and signal when the phone is off/on the hook.
+    Edges are handed to us on the shared edge dispatcher's thread and run
+    through a HoldFilter, so contact bounce never reaches the output queue,
+    only changes that stuck.
     """
-    __KILL_CODE = -1
 
-    def __init__(self, hook_pin:int, output_queue:Queue, timeout=5) -> None:
+    def __init__(self, hook_pin:int, output_queue:Queue, hold_off:float=DEFAULT_HOLD_OFF, hold_on:float=DEFAULT_HOLD_ON, dispatcher=None) -> None:
         """Constructor for HookMonitor object, assumes that the caller 
         has already setup the GPIO pin, but we still need to setup the 
         interrupts.
@@ -28,28 +96,52 @@ class HookMonitor(Thread):
         Args:
             hook_pin (int): the GPIO pin number to monitor for the hook switch
             output_queue (Queue): Queue to send output that we receive
+            hold_off (float): seconds the handset must be lifted before it counts
+            hold_on (float): seconds the handset must be down before it counts
+            dispatcher (EdgeDispatcher): defaults to the shared one
         """
-        super().__init__()
-
         # Save some state
         self._hook_pin = hook_pin
-        self._input_queue = Queue()
         self._output_queue = output_queue
+        self._hold_times = {HookState.HOOK_OFF: hold_off, HookState.HOOK_ON: hold_on}
         self._hook_state = HookState.HOOK_ON
         self._lock = Lock()
-        self._timeout = timeout
+        self._dispatcher = dispatcher
+        self._filter = None
+        self._timer_armed = False
+        self._running = False
         self.name="HookMonitor"
-    
+
+    def start(self):
+        """Read where the hook is now and start watching it
+        """
+        if( self._dispatcher is None ):
+            self._dispatcher = gpio_backend.get_dispatcher()
+        with self._lock:
+            self._hook_state = HookState(self._dispatcher.gpio.input(self._hook_pin))
+        self._filter = HoldFilter(self._hook_state, self._hold_times)
+        self._running = True
+        self._dispatcher.watch(self._hook_pin, gpio_backend.BOTH, self.hook_change)
+
     def kill(self):
-        """Tell this guy to terminate.
+        """Stop watching the hook, takes effect immediately.
+        """
+        self._running = False
+        if( self._dispatcher is not None ):
+            self._dispatcher.unwatch(self._hook_pin)
+        logging.info('Exiting...')
+
+    def join(self, timeout=None):
+        """Nothing to wait for, there's no thread of our own. Here so the
+        monitor can be shut down like every other worker.
         """
-        self._input_queue.put(HookMonitor.__KILL_CODE)
+        pass
     
     def hook_state(self) -> HookState:
         """Return the current hook state.
 
         Returns:
-            bool: True if we're 
+            HookState: where the hook was when it last settled
         """
         with self._lock:
             return self._hook_state
@@ -68,50 +160,45 @@ class HookMonitor(Thread):
             return "HOOK_OFF"
         elif( state == HookState.HOOK_ON ):
             return "HOOK_ON"
+
+    def _arm(self):
+        """Make sure we'll look again when the pending level has been held
+        """
+        deadline = self._filter.deadline()
+        if( deadline is not None and not self._timer_armed ):
+            self._timer_armed = True
+            self._dispatcher.call_at(deadline, self._on_deadline)
     
-    def hook_change(self, pin):
-        """Monitor the hook for changes, when it changes report that 
-        through the output queue
+    def hook_change(self, pin, timestamp):
+        """Note an edge on the hook and start timing how long it's held for
 
         Args:
             pin (int): GPIO pin associated with this change in current
+            timestamp (float): when the edge happened
         """
-        if( self.running ):
+        _HOOK_EDGES.inc()
+        self._filter.edge(timestamp, self._dispatcher.gpio.input(pin))
+        self._arm()
+
+    def _on_deadline(self):
+        # Further edges push the deadline back, in which case this finds
+        # nothing and we go round again
+        self._timer_armed = False
+        level = self._filter.poll(self._dispatcher.clock(), self._dispatcher.gpio.input(self._hook_pin))
+        if( level is not None and self._running ):
             with self._lock:
-                self._hook_state = HookState(GPIO.input(pin))
+                self._hook_state = HookState(level)
+            _HOOK_CHANGES.inc()
             self._output_queue.put( ("HOOK", self._hook_state) )
-            logging.debug("Something changed on the hook, current value is {}".format(self._hook_state))
-        else:
-            logging.debug("Looks like I'm not running, but I'm getting interrupts")
-
-    
-    def run(self):
-        """Setup the interrupt for the hook GPIO pin and monitor it, 
-        communicating state back to the caller
-        """
-        self.running = True
-        with self._lock:
-            self._hook_state = HookState(GPIO.input(self._hook_pin))
-        GPIO.add_event_detect( self._hook_pin, GPIO.BOTH, self.hook_change )
-        
-        # Wait for someone to kill me
-        while self.running:
-            item = self._input_queue.get()
-            if( item == HookMonitor.__KILL_CODE ):
-                self.running = False
-            else:
-                logging.info("Received an unknown message from input_queue: '{}'".format(item))
-            
-            # sleep for a while
-            time.sleep(self._timeout)
-            
-        logging.info('Exiting...')
+            logging.debug("The hook settled at %s", self._hook_state.name)
+        self._arm()
 
 if __name__ == "__main__":
     # Setup GPIO
     hook_pin = 12
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(hook_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO = gpio_backend.get_gpio()
+    GPIO.setmode(gpio_backend.BOARD)
+    GPIO.setup(hook_pin, gpio_backend.IN, pull_up_down=gpio_backend.PUD_UP)
 
     # Run a test to see if we can monitor the hook
 
@@ -128,4 +215,5 @@ if __name__ == "__main__":
         logging.info( "{} change: {}".format(source,change))
     hook_monitor.kill()
     hook_monitor.join()
+    gpio_backend.stop_dispatcher()
     GPIO.cleanup()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# latency_bench.py
+#
+# Drives a whole TattlePhone through simulated calls, with simulated GPIO
+# pins and stand-in audio tools, and reports how long each transition of the
+# state machine takes. Run it before and after touching the audio backends or
+# the queues to see if anything got slower. With --lines it runs several
+# handsets at once and reports how much CPU the process used per line.
+
+import argparse
+import asyncio
+import logging
+import os
+import stat
+import tempfile
+import time
+from threading import Thread
+from pathlib import Path
+from queue import Queue, Empty
+import gpio_backend
+import metrics
+from audio_backend import SubprocessBackend
+from hook_monitor import HookState
+import tattle_core
+from tattle_core import TattlePhone, TattleState, build_parser, line_configs
+from tts_cache import TTSCache
+from tattle_async import AsyncTattlePhone
+
+# Stand-ins for the command line audio tools. They behave enough like the
+# real thing for the phone to work, without needing a sound card.
+_STUB_TOOLS = {
+    "espeak-ng": r"""#!/bin/sh
+# espeak-ng stand-in, every sentence is 0.2s of silence
+case "$1" in --version) echo "eSpeak NG stand-in"; exit 0;; esac
+out=-
+while [ $# -gt 0 ]; do
+    case "$1" in -w) out="$2"; shift;; esac
+    shift
+done
+speak() {
+    printf 'RIFF\230\042\000\000WAVEfmt \020\000\000\000\001\000\001\000\042\126\000\000\104\254\000\000\002\000\020\000data\164\042\000\000'
+    head -c 8820 /dev/zero
+}
+if [ "$out" = "-" ]; then speak; else speak > "$out"; fi
+""",
+    "aplay": r"""#!/bin/sh
+# aplay stand-in, files take a moment to "play", piped audio is swallowed
+for last; do :; done
+if [ "$last" = "-" ]; then cat > /dev/null; else sleep "${BENCH_CLIP_SEC:-0.2}"; fi
+""",
+    "arecord": r"""#!/bin/sh
+# arecord stand-in, produces silence in real time until it's terminated
+for out; do :; done
+trap 'exit 0' TERM
+if [ "$out" != "-" ]; then
+    exec > "$out"
+    printf 'RIFF\377\377\377\177WAVEfmt \020\000\000\000\001\000\001\000\200\076\000\000\000\175\000\000\002\000\020\000data\377\377\377\177'
+fi
+while :; do head -c 3200 /dev/zero; sleep 0.1; done
+""",
+}
+
+_WAIT_TIMEOUT_SEC = 10
+
+class InstrumentedBackend(SubprocessBackend):
+    """Subprocess backend which notes when each clip starts playing
+    """
+    def __init__(self, observations:Queue):
+        super().__init__()
+        self._observations = observations
+
+    def play_file(self, file, interrupt):
+        self._observations.put(("PLAY", str(file), time.monotonic()))
+        return super().play_file(file, interrupt)
+
+    def play_samples(self, samples, interrupt):
+        self._observations.put(("PLAY", "samples", time.monotonic()))
+        return super().play_samples(samples, interrupt)
+
+class InstrumentedPhone(TattlePhone):
+    """TattlePhone which notes every state change and finished recording
+    """
+    def __init__(self, config, observations:Queue, tts_cache:TTSCache=None):
+        self._observations = observations
+        super().__init__(config, InstrumentedBackend(observations), tts_cache)
+
+        add = self.recording_index.add
+        def add_and_observe(path):
+            self._observations.put(("RECORDED", str(path), time.monotonic()))
+            add(path)
+        self.recording_index.add = add_and_observe
+
+    def change_state(self, new_state:TattleState):
+        super().change_state(new_state)
+        self._observations.put(("STATE", new_state, time.monotonic()))
+
+class InstrumentedAsyncPhone(AsyncTattlePhone):
+    """AsyncTattlePhone which notes the same things as InstrumentedPhone
+    """
+    def __init__(self, config, observations:Queue):
+        self._observations = observations
+        super().__init__(config)
+
+        add = self.recording_index.add
+        def add_and_observe(path):
+            self._observations.put(("RECORDED", str(path), time.monotonic()))
+            add(path)
+        self.recording_index.add = add_and_observe
+
+    async def _play_file(self, file):
+        self._observations.put(("PLAY", str(file), time.monotonic()))
+        await super()._play_file(file)
+
+    async def _play_samples(self, samples):
+        self._observations.put(("PLAY", "samples", time.monotonic()))
+        await super()._play_samples(samples)
+
+    def change_state(self, new_state:TattleState):
+        super().change_state(new_state)
+        self._observations.put(("STATE", new_state, time.monotonic()))
+
+def install_stub_tools(directory:Path):
+    """Write the stand-in tools and put them first on the PATH
+
+    Args:
+        directory (Path): where to put them
+    """
+    for name, script in _STUB_TOOLS.items():
+        path = Path(directory, name)
+        path.write_text(script)
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+
+def wait_for(observations:Queue, kind:str, what=None, after:float=0.0) -> float:
+    """Wait for something to happen
+
+    Args:
+        observations (Queue): where the instrumentation reports to
+        kind (str): PLAY, STATE or RECORDED
+        what (optional): the file or state we're waiting for, None for any
+        after (float, optional): ignore anything that happened before this
+
+    Returns:
+        float: when it happened
+    """
+    deadline = time.monotonic() + _WAIT_TIMEOUT_SEC
+    while( True ):
+        try:
+            seen_kind, seen_what, when = observations.get(timeout=max(0, deadline - time.monotonic()))
+        except Empty:
+            raise TimeoutError(f"Gave up waiting for {kind} {what}")
+        if( seen_kind == kind and (what is None or seen_what == what) and when >= after ):
+            return when
+
+def percentile(samples:list, fraction:float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def report(results:dict):
+    print(f"{'transition':<28}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, samples in results.items():
+        if( len(samples) == 0 ):
+            continue
+        print(f"{name:<28}{len(samples):>5}"
+              f"{percentile(samples, 0.5) * 1000:>10.1f}{percentile(samples, 0.9) * 1000:>10.1f}"
+              f"{percentile(samples, 0.99) * 1000:>10.1f}{max(samples) * 1000:>10.1f}")
+
+def merge(results:list) -> dict:
+    """Combine the latencies measured on each line
+    """
+    merged = {}
+    for line_results in results:
+        for name, samples in line_results.items():
+            merged.setdefault(name, []).extend(samples)
+    return merged
+
+def run_calls(phone, gpio:gpio_backend.SimulatedGPIO, config, observations:Queue, calls:int, talk_sec:float) -> dict:
+    """Pick up, dial 1, talk, hang up, over and over.
+
+    Returns:
+        dict: latencies in seconds for each transition
+    """
+    results = {
+        "hook off -> menu playing": [],
+        "last pulse -> record state": [],
+        "hang up -> recorder stopped": [],
+    }
+    menu_file = str(phone.tts_cache.path_for(tattle_core._ROOT_MENU_TEXT))
+    builder = gpio_backend.TraceBuilder(config.hook_pin, config.dial_pin)
+
+    for _ in range(calls):
+        start = time.monotonic()
+        gpio.set_level(config.hook_pin, int(HookState.HOOK_OFF))
+        results["hook off -> menu playing"].append(wait_for(observations, "PLAY", menu_file, start) - start)
+
+        # A single pulse for a "1"
+        gpio.set_level(config.dial_pin, gpio_backend.HIGH)
+        last_pulse = time.monotonic()
+        time.sleep(builder.pulse_high)
+        gpio.set_level(config.dial_pin, gpio_backend.LOW)
+        results["last pulse -> record state"].append(wait_for(observations, "STATE", TattleState.TATTLE_RECORD, last_pulse) - last_pulse)
+
+        time.sleep(talk_sec)
+        hang_up = time.monotonic()
+        gpio.set_level(config.hook_pin, int(HookState.HOOK_ON))
+        results["hang up -> recorder stopped"].append(wait_for(observations, "RECORDED", None, hang_up) - hang_up)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the latency of the phone's state transitions")
+    parser.add_argument("--calls", help="How many simulated calls to make", type=int, default=20)
+    parser.add_argument("--talk_sec", help="How long each simulated tattle lasts", type=float, default=0.3)
+    parser.add_argument("--runtime", help="Which of the phone's runtimes to measure", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--lines", help="How many handsets to drive at once, each making --calls calls", type=int, default=1)
+    parser.add_argument("--metrics", help="Also print the metrics collected during the run", action="store_true")
+    bench_args = parser.parse_args()
+    if( bench_args.lines > 1 and bench_args.runtime == "asyncio" ):
+        parser.error("--lines is only supported by the threads runtime")
+
+    logging.basicConfig(level=logging.WARNING)
+    if( bench_args.metrics ):
+        metrics.enable()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        install_stub_tools(Path(workdir))
+        recording_dir = Path(workdir, "tattles")
+        recording_dir.mkdir()
+        phone_args = [
+            "--recording_dir", str(recording_dir),
+            "--tts_cache_dir", str(Path(workdir, "tts")),
+            "--audio_backend", "subprocess",
+            "--encoding", "wav",
+            "--runtime", bench_args.runtime]
+        if( bench_args.lines > 1 ):
+            for line in range(bench_args.lines):
+                phone_args += ["--line", f"line{line}", str(100 + 2 * line), str(101 + 2 * line), "default"]
+        lines = [config for _, config in line_configs(build_parser().parse_args(phone_args))]
+
+        gpio = gpio_backend.SimulatedGPIO()
+        gpio_backend.use(gpio)
+        tts_cache = TTSCache(lines[0].tts_cache_dir, max_bytes=lines[0].tts_cache_mb * 1024 * 1024)
+        phones = []
+        for config in lines:
+            gpio.setup(config.hook_pin, gpio_backend.IN)
+            gpio.setup(config.dial_pin, gpio_backend.IN)
+            Path(config.recording_dir).mkdir(parents=True, exist_ok=True)
+
+            observations = Queue()
+            if( config.runtime == "asyncio" ):
+                phone = InstrumentedAsyncPhone(config, observations)
+                phone_thread = Thread(target=asyncio.run, args=(phone.run(),), name="TattlePhone", daemon=True)
+            else:
+                phone = InstrumentedPhone(config, observations, tts_cache)
+                phone_thread = Thread(target=phone.run, name="TattlePhone", daemon=True)
+            phone_thread.start()
+            if( config.runtime == "asyncio" ):
+                phone.ready.wait(_WAIT_TIMEOUT_SEC)
+            phones.append((phone, phone_thread, config, observations))
+
+        # Every line makes its calls at the same time
+        results = [None] * len(phones)
+        def drive(line, phone, config, observations):
+            results[line] = run_calls(phone, gpio, config, observations, bench_args.calls, bench_args.talk_sec)
+        drivers = [Thread(target=drive, args=(line, phone, config, observations), name=f"Driver{line}")
+                   for line, (phone, _, config, observations) in enumerate(phones)]
+        started, cpu_started = time.monotonic(), time.process_time()
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        wall, cpu = time.monotonic() - started, time.process_time() - cpu_started
+
+        report(merge(results))
+        print(f"\n{len(phones)} line(s): {cpu * 1000:.0f}ms of CPU over {wall:.1f}s, "
+              f"{cpu / wall * 100:.1f}% of a core, {cpu / len(phones) * 1000:.0f}ms per line")
+        if( bench_args.metrics ):
+            print(metrics.render())
+
+        for phone, phone_thread, _, _ in phones:
+            phone.kill()
+        for _, phone_thread, _, _ in phones:
+            phone_thread.join(tattle_core._JOIN_TIMEOUT_SEC)
+        gpio_backend.stop_dispatcher()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# log_pipeline.py
+#
+# Keeps logging off the real-time threads. A logging call only puts the
+# record on a queue, and the message is formatted and written to the console
+# and the log file by a single background thread. Call sites that can fire
+# many times a second, like dial pulses or a bouncing hook, are rate limited,
+# with a note of how many messages were left out.
+
+import atexit
+import logging.handlers
+import sys
+from queue import Queue, Full
+from threading import Lock
+import metrics
+
+_FORMAT = "%(asctime)s %(levelname)s %(threadName)s: %(message)s"
+
+# Records waiting to be written, anything beyond this is dropped rather than
+# holding up whoever is logging
+_QUEUE_SIZE = 10000
+
+_FILE_BYTES = 1024 * 1024
+_FILE_BACKUPS = 5
+
+# How many records a second each call site may log, with bursts of up to
+# _SITE_BURST. Errors always get through.
+_SITE_RATE = 5.0
+_SITE_BURST = 20
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_SUPPRESSED = metrics.counter("tattle_log_suppressed_total", "Log records left out because their call site was logging too often")
+_DROPPED = metrics.counter("tattle_log_dropped_total", "Log records dropped because the log queue was full")
+
+class SiteRateLimiter(logging.Filter):
+    """Token bucket for each place in the code that logs, identified by its
+    file and line. Whatever gets through after some were held back carries
+    a count of them.
+    """
+    def __init__(self, rate:float=_SITE_RATE, burst:int=_SITE_BURST):
+        super().__init__()
+        self._rate = rate
+        self._burst = burst
+        self._lock = Lock()
+        # (pathname, lineno) -> [tokens, last seen, suppressed since last let through]
+        self._sites = {}
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if( record.levelno >= logging.ERROR ):
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if( site is None ):
+                site = self._sites[key] = [self._burst, record.created, 0]
+            site[0] = min(self._burst, site[0] + (record.created - site[1]) * self._rate)
+            site[1] = record.created
+            if( site[0] < 1 ):
+                site[2] += 1
+                _SUPPRESSED.inc()
+                return False
+            site[0] -= 1
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without formatting them, so the caller doesn't pay for
+    it. The arguments are formatted later by the listener, so anything logged
+    should not be changed straight afterwards. Never blocks, if the queue is
+    full the record is dropped.
+    """
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record:logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _DROPPED.inc()
+
+class _Formatter(logging.Formatter):
+    def format(self, record:logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if( suppressed ):
+            text += f" ({suppressed} more like this left out)"
+        return text
+
+class LogPipeline():
+    """Sends everything logged through the root logger to the console, and
+    optionally a rotating log file, from a background thread
+    """
+    def __init__(self, level:str="INFO", log_file:str=None, console:bool=True):
+        """
+        Args:
+            level (str, optional): least important level to log, one of LEVELS
+            log_file (str, optional): also write to this file, rotated as it grows
+            console (bool, optional): write to stderr
+        """
+        self._level = logging.getLevelName(level)
+        formatter = _Formatter(_FORMAT)
+        handlers = []
+        if( console ):
+            handlers.append(logging.StreamHandler(sys.stderr))
+        if( log_file is not None ):
+            handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=_FILE_BYTES, backupCount=_FILE_BACKUPS))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self._queue = Queue(_QUEUE_SIZE)
+        self._handler = LazyQueueHandler(self._queue)
+        self._handler.addFilter(SiteRateLimiter())
+        self._listener = logging.handlers.QueueListener(self._queue, *handlers, respect_handler_level=True)
+        self._started = False
+
+    def start(self):
+        """Route the root logger through the pipeline, replacing any
+        handlers it already has
+        """
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        root.setLevel(self._level)
+        self._listener.start()
+        self._started = True
+        # Write out whatever is still queued however we exit
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out anything still queued and stop the background thread
+        """
+        if( not self._started ):
+            return
+        self._started = False
+        logging.getLogger().removeHandler(self._handler)
+        self._listener.stop()
+
+if __name__ == "__main__":
+    import time
+    pipeline = LogPipeline("DEBUG")
+    pipeline.start()
+    started = time.perf_counter()
+    for count in range(10000):
+        logging.debug("Pulse %d", count)
+    logging.info("Logged 10000 pulses in %.1fms", (time.perf_counter() - started) * 1000)
+    pipeline.stop()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# metrics.py
+#
+# Counters, gauges and histograms for the worker threads. Metrics are
+# declared at import time but do nothing until enable() is called, so the
+# instrumentation costs a single attribute check when nobody is looking.
+# When enabled they can be written to a file, or served over HTTP on
+# localhost, in the Prometheus text format.
+
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+
+# Seconds, from a millisecond up to the length of a long message
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _State():
+    enabled = False
+
+_state = _State()
+_registry = {}
+_registry_lock = Lock()
+
+def enable():
+    """Start collecting metrics
+    """
+    _state.enabled = True
+
+def is_enabled() -> bool:
+    return _state.enabled
+
+class Counter():
+    """A value that only goes up
+    """
+    kind = "counter"
+
+    def __init__(self, name:str, help:str):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        if( not _state.enabled ):
+            return
+        with self._lock:
+            self._value += amount
+
+    def render(self) -> list:
+        return [f"{self.name} {self._value}"]
+
+class Gauge():
+    """A value that goes up and down
+    """
+    kind = "gauge"
+
+    def __init__(self, name:str, help:str):
+        self.name = name
+        self.help = help
+        self._value = 0
+
+    def set(self, value):
+        if( not _state.enabled ):
+            return
+        self._value = value
+
+    def render(self) -> list:
+        return [f"{self.name} {self._value}"]
+
+class Histogram():
+    """Counts of observations falling into fixed buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        if( not _state.enabled ):
+            return
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe how long the body of a with statement takes
+        """
+        if( not _state.enabled ):
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def render(self) -> list:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._bounds, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+def _register(metric):
+    with _registry_lock:
+        if( metric.name in _registry ):
+            return _registry[metric.name]
+        _registry[metric.name] = metric
+    return metric
+
+def counter(name:str, help:str) -> Counter:
+    return _register(Counter(name, help))
+
+def gauge(name:str, help:str) -> Gauge:
+    return _register(Gauge(name, help))
+
+def histogram(name:str, help:str, buckets=LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, buckets))
+
+def render() -> str:
+    """Everything we've collected, in the Prometheus text format
+
+    Returns:
+        str: the metrics
+    """
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def _make_server(port:int):
+    """HTTP server for the metrics on localhost. http.server is slow to
+    import and most of the time nobody wants it, so it's only imported here.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    return server
+
+class MetricsExporter(Thread):
+    """Periodically writes the metrics to a file, and/or serves them over
+    HTTP on localhost.
+    """
+    def __init__(self, path:str=None, port:int=None, interval:float=10):
+        super().__init__(daemon=True)
+        self.name = "MetricsExporter"
+        self._path = path
+        self._interval = interval
+        self._kill_event = Event()
+        self._server = None
+        if( port is not None ):
+            self._server = _make_server(port)
+
+    def _write(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(render())
+        os.replace(tmp_path, self._path)
+
+    def run(self):
+        if( self._server is not None ):
+            Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True).start()
+        while( not self._kill_event.wait(self._interval) ):
+            if( self._path is not None ):
+                try:
+                    self._write()
+                except OSError as e:
+                    logging.error("MetricsExporter: Unable to write %s: %s", self._path, e)
+
+    def kill(self):
+        self._kill_event.set()
+        if( self._server is not None ):
+            self._server.shutdown()
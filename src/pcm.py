@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# pcm.py
+#
+# Helpers to get audio from whatever format it arrives in into the one format
+# our long-lived output stream is opened with.
+
+import subprocess
+from pathlib import Path
+import startup
+from wav_reader import WavError, WavFile, parse_header
+np = startup.lazy_import("numpy")
+
+# Everything we play is converted to this before it hits the device.
+OUTPUT_RATE = 22050
+OUTPUT_CHANNELS = 1
+OUTPUT_SAMPLE_WIDTH = 2
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+
+# Command lines which decode a compressed file to WAV on stdout
+_DECODERS = {
+    ".flac": ['flac', '--decode', '--silent', '--stdout', '{file}'],
+    ".opus": ['opusdec', '--quiet', '--force-wav', '{file}', '-'],
+}
+
+# Raised when we're handed audio we don't understand
+PCMError = WavError
+
+# Files are read and converted this much at a time
+_BLOCK_SEC = 0.5
+
+def _decode_samples(raw, format_tag:int, bits:int) -> "np.ndarray":
+    """Turn raw interleaved sample data into floats in the range [-1, 1]
+
+    Args:
+        raw (bytes): the sample data
+        format_tag (int): WAVE_FORMAT_PCM or WAVE_FORMAT_IEEE_FLOAT
+        bits (int): bits per sample
+
+    Returns:
+        np.ndarray: float32 samples, still interleaved
+    """
+    if( format_tag == _WAVE_FORMAT_IEEE_FLOAT ):
+        if( bits == 32 ):
+            return np.frombuffer(raw, dtype='<f4', count=len(raw) // 4).astype(np.float32)
+        elif( bits == 64 ):
+            return np.frombuffer(raw, dtype='<f8', count=len(raw) // 8).astype(np.float32)
+    elif( format_tag == _WAVE_FORMAT_PCM ):
+        if( bits == 8 ):
+            return (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+        elif( bits == 16 ):
+            return np.frombuffer(raw, dtype='<i2', count=len(raw) // 2).astype(np.float32) / 32768
+        elif( bits == 24 ):
+            triples = np.frombuffer(raw, dtype=np.uint8, count=len(raw) // 3 * 3).reshape(-1, 3).astype(np.int32)
+            values = triples[:, 0] | (triples[:, 1] << 8) | (triples[:, 2] << 16)
+            values = np.where(values & 0x800000, values - 0x1000000, values)
+            return values.astype(np.float32) / 8388608
+        elif( bits == 32 ):
+            return np.frombuffer(raw, dtype='<i4', count=len(raw) // 4).astype(np.float32) / 2147483648
+    raise PCMError(f"Unsupported sample format {format_tag:#x} with {bits} bits")
+
+def _to_mono(samples:"np.ndarray", channels:int) -> "np.ndarray":
+    if( channels > 1 ):
+        return samples.reshape(-1, channels).mean(axis=1)
+    return samples
+
+def parse_wav(data) -> tuple:
+    """Pull the audio out of a RIFF/WAVE buffer
+
+    Args:
+        data (bytes): the entire WAV file
+
+    Returns:
+        tuple: (mono float32 samples, sample rate)
+    """
+    fmt = parse_header(data)
+    raw = memoryview(data)[fmt.data_offset:fmt.data_offset + fmt.data_bytes]
+    return _to_mono(_decode_samples(raw, fmt.format_tag, fmt.bits), fmt.channels), fmt.rate
+
+def decode_chunk(raw, fmt) -> "np.ndarray":
+    """Convert a piece of a WAV stream straight to the output format, e.g.
+    speech as it comes out of espeak-ng. Output that's already in the right
+    format is used as it is.
+
+    Args:
+        raw (bytes): whole frames of sample data
+        fmt (WavFormat): the stream's format, from its header
+
+    Returns:
+        np.ndarray: int16 samples at OUTPUT_RATE
+    """
+    if( (fmt.format_tag, fmt.bits, fmt.channels, fmt.rate) == (_WAVE_FORMAT_PCM, 16, OUTPUT_CHANNELS, OUTPUT_RATE) ):
+        return np.frombuffer(raw, dtype='<i2')
+    return to_output(_to_mono(_decode_samples(raw, fmt.format_tag, fmt.bits), fmt.channels), fmt.rate)
+
+def read_wav(path) -> tuple:
+    """Read a WAV file without reading it all into memory first, the samples
+    are converted straight out of the memory-mapped file
+
+    Args:
+        path (str): WAV file to read
+
+    Returns:
+        tuple: (mono float32 samples, sample rate)
+    """
+    with WavFile(path) as wav:
+        raw = wav.frame_bytes()
+        try:
+            samples = _decode_samples(raw, wav.format.format_tag, wav.format.bits)
+        finally:
+            raw.release()
+        return _to_mono(samples, wav.channels), wav.rate
+
+def resample(samples:"np.ndarray", rate:int, out_rate:int=OUTPUT_RATE) -> "np.ndarray":
+    """Linear interpolation resampler, plenty for a telephone earpiece.
+
+    Args:
+        samples (np.ndarray): mono float samples
+        rate (int): rate the samples are at
+        out_rate (int): rate we'd like them at
+
+    Returns:
+        np.ndarray: resampled float32 samples
+    """
+    if( rate == out_rate or len(samples) == 0 ):
+        return samples
+    out_len = int(round(len(samples) * out_rate / rate))
+    positions = np.arange(out_len, dtype=np.float64) * (rate / out_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def to_output(samples:"np.ndarray", rate:int, gain_db:float=0.0) -> "np.ndarray":
+    """Convert float samples to what the output stream expects
+
+    Args:
+        samples (np.ndarray): mono float samples
+        rate (int): rate the samples are at
+        gain_db (float, optional): how much to turn it up or down
+
+    Returns:
+        np.ndarray: int16 samples at OUTPUT_RATE
+    """
+    return _to_int16(resample(samples, rate), gain_db)
+
+class Resampler():
+    """resample() for audio that arrives a block at a time. The last sample
+    of each block is kept so the next one carries on from it, so the result
+    is the same as resampling everything in one go.
+    """
+    def __init__(self, rate:int, out_rate:int=OUTPUT_RATE):
+        self._rate = rate
+        self._out_rate = out_rate
+        self._step = rate / out_rate
+        # Next sample to output, and where the carried over sample was
+        self._next = 0
+        self._carry = np.zeros(0, dtype=np.float32)
+        self._carry_at = 0
+
+    def process(self, samples:"np.ndarray") -> "np.ndarray":
+        """
+        Args:
+            samples (np.ndarray): the next block of mono float samples
+
+        Returns:
+            np.ndarray: as many float32 samples at out_rate as the input so far covers
+        """
+        if( self._rate == self._out_rate or len(samples) == 0 ):
+            return samples
+        samples = np.concatenate((self._carry, samples))
+        last = self._carry_at + len(samples) - 1
+        end = int(last / self._step) + 1
+        positions = np.arange(self._next, end, dtype=np.float64) * self._step - self._carry_at
+        self._next = end
+        self._carry = samples[-1:]
+        self._carry_at = last
+        return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def _to_int16(samples:"np.ndarray", gain_db:float=0.0) -> "np.ndarray":
+    scale = 32767 * 10 ** (gain_db / 20)
+    return np.clip(samples * scale, -32767, 32767).astype(np.int16)
+
+class AudioBlocks():
+    """A recording read a block at a time as mono float samples. WAV files
+    are read straight out of the memory-mapped file, so only the block being
+    worked on is ever converted. Compressed files have to be decoded in one
+    go first.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): WAV, FLAC or Opus file to read
+        """
+        self._wav = None
+        self._samples = None
+        if( Path(path).suffix.lower() in _DECODERS ):
+            self._samples, self.rate = decode_audio(path)
+            self.frames = len(self._samples)
+        else:
+            self._wav = WavFile(path)
+            self.rate = self._wav.rate
+            self.frames = self._wav.frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if( self._wav is not None ):
+            self._wav.close()
+
+    def raw_blocks(self, block_frames:int):
+        """Blocks just as they are in a WAV file, when they're already mono
+        16 bit samples
+
+        Yields:
+            np.ndarray: int16 views onto the file, None if it isn't that format
+        """
+        wav = self._wav
+        if( wav is None or wav.channels != 1 or (wav.format.format_tag, wav.format.bits) != (_WAVE_FORMAT_PCM, 16) ):
+            return None
+        return (block[:, 0] for block in wav.blocks(block_frames))
+
+    def blocks(self, block_frames:int):
+        """Walk through the recording
+
+        Args:
+            block_frames (int): frames per block, the last one may be short
+
+        Yields:
+            np.ndarray: mono float32 samples in the range [-1, 1]
+        """
+        if( self._wav is None ):
+            for start in range(0, self.frames, block_frames):
+                yield self._samples[start:start + block_frames]
+            return
+
+        wav = self._wav
+        if( not wav.can_view ):
+            for start in range(0, self.frames, block_frames):
+                raw = wav.frame_bytes(start, block_frames)
+                try:
+                    yield _to_mono(_decode_samples(raw, wav.format.format_tag, wav.format.bits), wav.channels)
+                finally:
+                    raw.release()
+            return
+
+        for block in wav.blocks(block_frames):
+            samples = block.astype(np.float32)
+            if( block.dtype.kind == "u" ):
+                samples = (samples - 128) / 128
+            elif( block.dtype.kind == "i" ):
+                samples /= 2 ** (8 * block.dtype.itemsize - 1)
+            yield samples.mean(axis=1) if wav.channels > 1 else samples[:, 0]
+
+def output_chunks(path, gain_db:float=0.0):
+    """Read any of the formats we record in a block at a time, converted to
+    the output format, for playing as it's read
+
+    Args:
+        path (str): WAV, FLAC or Opus file to read
+        gain_db (float, optional): how much to turn it up or down
+
+    Yields:
+        np.ndarray: int16 samples at OUTPUT_RATE
+    """
+    with AudioBlocks(path) as audio:
+        block_frames = max(1, int(audio.rate * _BLOCK_SEC))
+        if( audio.rate == OUTPUT_RATE and gain_db == 0.0 ):
+            raw = audio.raw_blocks(block_frames)
+            if( raw is not None ):
+                # Already what the output wants, no need to convert anything
+                yield from raw
+                return
+        resampler = Resampler(audio.rate)
+        for block in audio.blocks(block_frames):
+            yield _to_int16(resampler.process(block), gain_db)
+
+def load_wav(path) -> "np.ndarray":
+    """Read a WAV file and convert it to the output format
+
+    Args:
+        path (str): WAV file to read
+
+    Returns:
+        np.ndarray: int16 samples at OUTPUT_RATE
+    """
+    return load_audio(path)
+
+def decode_audio(path) -> tuple:
+    """Read any of the formats we record in. Compressed files are decoded by
+    their command line decoder.
+
+    Args:
+        path (str): WAV, FLAC or Opus file to read
+
+    Returns:
+        tuple: (mono float32 samples, sample rate)
+    """
+    suffix = Path(path).suffix.lower()
+    if( suffix not in _DECODERS ):
+        return read_wav(path)
+
+    decoder = _DECODERS[suffix]
+    args = [startup.which(decoder[0])] + [arg.format(file=path) for arg in decoder[1:]]
+    if( args[0] is None ):
+        raise PCMError(f"{decoder[0]} is needed to decode {path}")
+    result = subprocess.run(args, capture_output=True, check=True)
+    return parse_wav(result.stdout)
+
+def load_audio(path, gain_db:float=0.0) -> "np.ndarray":
+    """Read any of the formats we record in and convert it to the output
+    format.
+
+    Args:
+        path (str): WAV, FLAC or Opus file to read
+        gain_db (float, optional): how much to turn it up or down
+
+    Returns:
+        np.ndarray: int16 samples at OUTPUT_RATE
+    """
+    chunks = list(output_chunks(path, gain_db))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
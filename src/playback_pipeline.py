@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# playback_pipeline.py
+#
+# Gets the next few recordings ready (intro synthesized, everything decoded
+# and joined into one buffer) while the current one is playing, so moving on
+# to the next tattle doesn't have to wait on espeak-ng or the SD card.
+
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+import logging
+import startup
+np = startup.lazy_import("numpy")
+import pcm
+from tts_cache import TTSCache
+from recording_index import Recording
+
+_DEFAULT_DEPTH = 2
+_POLL_SEC = 0.1
+
+# A little breath between the intro and the message itself
+_INTRO_GAP_SEC = 0.25
+
+class PreparedRecording():
+    """A recording that's been decoded and is ready to hand to the player
+    """
+    def __init__(self, name:str, samples:"np.ndarray"):
+        self.name = name
+        self.samples = samples
+
+def prepare_recording(recording:Recording, tts_cache:TTSCache) -> PreparedRecording:
+    """Decode a single intro and recording into one buffer, leaving out
+    the silence either side of the speech if we know where it is, and
+    evening out the volume if we've measured it.
+
+    Args:
+        recording (Recording): the recording to prepare
+        tts_cache (TTSCache): where to get the intro rendered
+
+    Returns:
+        PreparedRecording: ready to play
+    """
+    parts = []
+    intro_file = tts_cache.render(recording.intro_text)
+    if( intro_file is not None ):
+        parts.append(pcm.load_wav(intro_file))
+        parts.append(np.zeros(int(_INTRO_GAP_SEC * pcm.OUTPUT_RATE), dtype=np.int16))
+
+    samples = pcm.load_audio(recording.path, recording.gain_db or 0.0)
+    if( recording.trim_start is not None and recording.trim_end is not None ):
+        samples = samples[int(recording.trim_start * pcm.OUTPUT_RATE):int(recording.trim_end * pcm.OUTPUT_RATE)]
+    parts.append(samples)
+    return PreparedRecording(recording.name, np.concatenate(parts))
+
+class PlaybackPipeline(Thread):
+    """Prepares recordings in the background, at most `depth` ahead of the
+    one currently being played.
+    """
+    def __init__(self, recordings, tts_cache:TTSCache, depth:int=_DEFAULT_DEPTH):
+        """Constructor
+
+        Args:
+            recordings (iterable): Recordings in the order to play them
+            tts_cache (TTSCache): where to get intros rendered
+            depth (int, optional): how many recordings to prepare ahead. Defaults to 2.
+        """
+        super().__init__(daemon=True)
+        self.name = "PlaybackPipeline"
+        self._recordings = recordings
+        self._tts_cache = tts_cache
+        self._prepared = Queue(maxsize=depth)
+        self._cancel = Event()
+        self._done = Event()
+
+    def run(self):
+        try:
+            for recording in self._recordings:
+                if( self._cancel.is_set() ):
+                    break
+                try:
+                    prepared = prepare_recording(recording, self._tts_cache)
+                except Exception as e:
+                    logging.error("PlaybackPipeline: Unable to prepare %s: %s", recording.name, e)
+                    continue
+
+                # Wait for room, but give up if we're cancelled
+                while( not self._cancel.is_set() ):
+                    try:
+                        self._prepared.put(prepared, timeout=_POLL_SEC)
+                        break
+                    except Full:
+                        pass
+        finally:
+            self._done.set()
+
+    def next(self) -> PreparedRecording:
+        """Get the next prepared recording, waiting for it if needed
+
+        Returns:
+            PreparedRecording: the next recording, None once we've run out
+        """
+        while( True ):
+            try:
+                return self._prepared.get(timeout=_POLL_SEC)
+            except Empty:
+                if( self._done.is_set() and self._prepared.empty() ):
+                    return None
+
+    def cancel(self):
+        """Stop preparing recordings, e.g. because the phone was hung up
+        """
+        self._cancel.set()
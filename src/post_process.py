@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+# post_process.py
+#
+# Works things out about recordings once they've finished: where the speech
+# is, how loud it is, a waveform overview, and so on. The work happens in a small pool of
+# worker processes at the lowest CPU and I/O priority, so decoding a long
+# recording never holds up the hook, the dial or the audio. Results go into a
+# sidecar JSON file next to the recording, and the index.
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from queue import Queue, Full
+from threading import Thread, BoundedSemaphore
+import metrics
+import pcm
+import startup
+from recording_index import RecordingIndex, sidecar_path
+from retention import lower_priority
+from silence_trim import speech_bounds, block_energy_db, BLOCK_SEC
+
+np = startup.lazy_import("numpy")
+
+_DEFAULT_WORKERS = 1
+
+# Recordings waiting for a worker, anything beyond this is left for the next
+# backfill rather than piling up in memory
+_DEFAULT_BACKLOG = 32
+
+# Recordings are read this much at a time
+_READ_BLOCK_SEC = 1.0
+
+# How many points the waveform overview has
+_PEAK_COUNT = 100
+
+# Loudness is measured over blocks this long, ignoring blocks that are
+# silent, or much quieter than the rest, as in ITU-R BS.1770
+_LOUDNESS_BLOCK_SEC = 0.4
+_ABSOLUTE_GATE_DB = -70
+_RELATIVE_GATE_DB = -10
+
+# Everything is turned up or down to about this level, within reason
+_TARGET_LOUDNESS_DB = -20
+_MAX_BOOST_DB = 18
+_MAX_CUT_DB = 12
+
+# Never turn anything up so far that it clips
+_PEAK_CEILING = 0.99
+
+_QUEUED = metrics.gauge("tattle_postprocess_queued", "Recordings waiting to be post-processed")
+_DEFERRED = metrics.counter("tattle_postprocess_deferred_total", "Recordings left for later because the post-processing queue was full")
+_FAILED = metrics.counter("tattle_postprocess_failed_total", "Recordings that couldn't be post-processed")
+_PROCESS_TIME = metrics.histogram("tattle_postprocess_seconds", "Time from a recording being queued to its results being stored",
+                                  buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+class _BlockLevels():
+    """block_energy_db() for a recording that arrives a piece at a time. Any
+    part of a block left over at the end of a piece waits for the next one.
+    """
+    def __init__(self, rate:int, block_sec:float):
+        self._rate = rate
+        self._block_sec = block_sec
+        self._block = max(1, int(rate * block_sec))
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._levels = []
+
+    def add(self, samples:"np.ndarray"):
+        if( len(self._pending) > 0 ):
+            samples = np.concatenate((self._pending, samples))
+        whole = len(samples) - len(samples) % self._block
+        if( whole > 0 ):
+            self._levels.append(block_energy_db(samples[:whole], self._rate, self._block_sec))
+        self._pending = samples[whole:]
+
+    @property
+    def levels(self) -> "np.ndarray":
+        return np.concatenate(self._levels) if self._levels else np.zeros(0, dtype=np.float32)
+
+class SpeechStage():
+    """Finds where the talking is
+    """
+    def __init__(self, rate:int, frames:int):
+        self._levels = _BlockLevels(rate, BLOCK_SEC)
+        self._peak = 0.0
+        self._duration = frames / rate
+
+    def add(self, samples:"np.ndarray"):
+        self._levels.add(samples)
+        if( len(samples) > 0 ):
+            self._peak = max(self._peak, float(np.max(np.abs(samples))))
+
+    def result(self) -> dict:
+        """
+        Returns:
+            dict: trim_start and trim_end in seconds, or empty if it's silent
+        """
+        speech = speech_bounds(self._levels.levels, self._peak, self._duration)
+        if( speech is None ):
+            return {"empty": True}
+        return {"empty": False, "trim_start": speech[0], "trim_end": speech[1]}
+
+class PeaksStage():
+    """Loudest sample in each of _PEAK_COUNT equal slices of the recording,
+    for drawing a waveform
+    """
+    def __init__(self, rate:int, frames:int):
+        self._slice = frames // _PEAK_COUNT
+        self._peaks = np.zeros(_PEAK_COUNT, dtype=np.float32)
+        self._offset = 0
+
+    def add(self, samples:"np.ndarray"):
+        offset = self._offset
+        self._offset += len(samples)
+        # Anything past the last whole slice is left out
+        end = min(len(samples), self._slice * _PEAK_COUNT - offset)
+        if( self._slice == 0 or end <= 0 ):
+            return
+        first = offset // self._slice
+        starts = np.concatenate(([0], np.arange((first + 1) * self._slice - offset, end, self._slice)))
+        maxima = np.maximum.reduceat(np.abs(samples[:end]), starts)
+        self._peaks[first:first + len(maxima)] = np.maximum(self._peaks[first:first + len(maxima)], maxima)
+
+    def result(self) -> dict:
+        """
+        Returns:
+            dict: peaks, each in the range [0, 1]
+        """
+        if( self._slice == 0 ):
+            return {"peaks": []}
+        return {"peaks": [round(float(peak), 3) for peak in self._peaks]}
+
+def _mean_db(levels:"np.ndarray") -> float:
+    """Level of the average power of some blocks
+    """
+    return 10 * np.log10(np.mean(10 ** (levels / 10)))
+
+def gated_loudness_db(levels:"np.ndarray") -> float:
+    """How loud a recording is, going by the parts with someone talking. No
+    K-weighting, an earpiece has none of the bass it's there to discount.
+
+    Args:
+        levels (np.ndarray): level of each _LOUDNESS_BLOCK_SEC block in dBFS
+
+    Returns:
+        float: loudness in dBFS, None if it's all silence
+    """
+    levels = levels[levels > _ABSOLUTE_GATE_DB]
+    if( len(levels) == 0 ):
+        return None
+    levels = levels[levels > _mean_db(levels) + _RELATIVE_GATE_DB]
+    return float(_mean_db(levels))
+
+class LoudnessStage():
+    """Works out the gain that brings the recording to the target loudness
+    """
+    def __init__(self, rate:int, frames:int):
+        # Anything shorter than a block is measured as one block
+        block_sec = min(_LOUDNESS_BLOCK_SEC, frames / rate) if frames > 0 else _LOUDNESS_BLOCK_SEC
+        self._levels = _BlockLevels(rate, block_sec)
+        self._peak = 0.0
+
+    def add(self, samples:"np.ndarray"):
+        self._levels.add(samples)
+        if( len(samples) > 0 ):
+            self._peak = max(self._peak, float(np.max(np.abs(samples))))
+
+    def result(self) -> dict:
+        """
+        Returns:
+            dict: loudness_db (None if silent) and gain_db
+        """
+        loudness = gated_loudness_db(self._levels.levels)
+        if( loudness is None ):
+            return {"loudness_db": None, "gain_db": 0.0}
+        gain = min(max(_TARGET_LOUDNESS_DB - loudness, -_MAX_CUT_DB), _MAX_BOOST_DB)
+        if( self._peak > 0 ):
+            gain = min(gain, 20 * np.log10(_PEAK_CEILING / self._peak))
+        return {"loudness_db": round(loudness, 2), "gain_db": round(float(gain), 2)}
+
+# Everything a worker can do to a recording, run in this order. Each stage
+# is built with the sample rate and length, handed the recording a block at
+# a time, and then asked what it found.
+STAGES = {
+    "speech": SpeechStage,
+    "peaks":  PeaksStage,
+    "loudness": LoudnessStage,
+}
+
+def analyse(path:str, stages:list) -> dict:
+    """Run the given stages over a recording and write the sidecar. Runs in a
+    worker process. WAV recordings are read a block at a time straight out
+    of the file, rather than converting all of it first.
+
+    Args:
+        path (str): the recording
+        stages (list): names of the stages to run
+
+    Returns:
+        dict: everything the stages found
+    """
+    results = {"recording": Path(path).name, "analysed_at": time.time()}
+    with pcm.AudioBlocks(path) as audio:
+        running = [STAGES[stage](audio.rate, audio.frames) for stage in stages]
+        for samples in audio.blocks(max(1, int(audio.rate * _READ_BLOCK_SEC))):
+            for stage in running:
+                stage.add(samples)
+    for stage in running:
+        results.update(stage.result())
+
+    sidecar = sidecar_path(path)
+    tmp_path = sidecar.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(results))
+    os.replace(tmp_path, sidecar)
+    return results
+
+class PostProcessor(Thread):
+    """Hands finished recordings to a pool of worker processes. Queueing never
+    blocks; if the workers are too far behind, the recording is left for
+    backfill() to pick up later.
+    """
+    def __init__(self, workers:int=_DEFAULT_WORKERS, backlog:int=_DEFAULT_BACKLOG, stages:list=None):
+        """
+        Args:
+            workers (int, optional): how many recordings to work on at once
+            backlog (int, optional): how many recordings can wait for a worker
+            stages (list, optional): names of the STAGES to run, defaults to all of them
+        """
+        super().__init__(daemon=True)
+        self.name = "PostProcessor"
+        self._workers = workers
+        self._stages = list(STAGES) if stages is None else stages
+        self._jobs = Queue(maxsize=backlog)
+        self._slots = BoundedSemaphore(workers)
+        self._pool = None
+        self._keep_going = True
+
+    def submit(self, index:RecordingIndex, path:Path) -> bool:
+        """Post-process a recording when a worker is free
+
+        Args:
+            index (RecordingIndex): where the recording is indexed
+            path (Path): the recording
+
+        Returns:
+            bool: False if the queue is full and the recording was left for later
+        """
+        try:
+            self._jobs.put_nowait((index, Path(path), time.monotonic()))
+        except Full:
+            logging.warning("PostProcessor: Too far behind, leaving %s for later", Path(path).name)
+            _DEFERRED.inc()
+            return False
+        _QUEUED.set(self._jobs.qsize())
+        return True
+
+    def backfill(self, index:RecordingIndex) -> int:
+        """Queue recordings that haven't been post-processed yet, e.g. ones
+        that were still waiting when we were last shut down
+
+        Args:
+            index (RecordingIndex): the recordings to check
+
+        Returns:
+            int: how many were queued
+        """
+        queued = 0
+        for path in index.unanalysed():
+            if( not self.submit(index, path) ):
+                break
+            queued += 1
+        if( queued > 0 ):
+            logging.info("PostProcessor: Queued %d recordings that haven't been analysed", queued)
+        return queued
+
+    def kill(self):
+        """Stop, dropping anything still queued. Recordings a worker is part
+        way through are finished, but their results aren't stored.
+        """
+        self._keep_going = False
+        try:
+            self._jobs.put_nowait(None)
+        except Full:
+            pass
+
+    def _store(self, index:RecordingIndex, path:Path, queued:float, future):
+        """Called once a worker is done with a recording
+        """
+        self._slots.release()
+        if( not self._keep_going ):
+            return
+        try:
+            results = future.result()
+        except Exception as e:
+            logging.error("PostProcessor: Unable to analyse %s: %s", path.name, e)
+            _FAILED.inc()
+            return
+        _PROCESS_TIME.observe(time.monotonic() - queued)
+
+        if( results.get("empty") ):
+            # Kept in case we're wrong, retention gets rid of these first
+            logging.info("PostProcessor: Nobody seems to have said anything in %s, marking it as empty", path.name)
+        elif( "trim_start" in results ):
+            logging.debug("PostProcessor: Speech in %s runs from %.2fs to %.2fs", path.name, results["trim_start"], results["trim_end"])
+        index.set_analysis(path.name, results)
+
+    def run(self):
+        # forkserver rather than fork, forking a process that's running
+        # threads can leave the children holding locks nobody will release.
+        # The server imports the heavy modules once for all the workers.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["numpy", __name__])
+        self._pool = ProcessPoolExecutor(self._workers, context, initializer=lower_priority)
+        try:
+            while( self._keep_going ):
+                job = self._jobs.get()
+                _QUEUED.set(self._jobs.qsize())
+                if( job is None or not self._keep_going ):
+                    break
+                index, path, queued = job
+                self._slots.acquire()
+                if( not path.exists() ):
+                    self._slots.release()
+                    continue
+                future = self._pool.submit(analyse, str(path), self._stages)
+                future.add_done_callback(lambda future, index=index, path=path, queued=queued: self._store(index, path, queued, future))
+        finally:
+            self._pool.shutdown(wait=False, cancel_futures=True)
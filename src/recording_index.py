@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+
+# recording_index.py
+#
+# Keeps a small sqlite database describing every recording in the tattle
+# directory, so playback doesn't have to scan and parse the whole directory
+# every time someone dials in.
+
+import logging
+import re
+import sqlite3
+import struct
+import time
+from datetime import date, datetime, time as day_time, timedelta
+from os import scandir
+from pathlib import Path
+from threading import Lock
+from wav_reader import WavError, parse_header
+
+_MONTH_MAP = {
+    1:  "January",
+    2:  "February",
+    3:  "March",
+    4:  "April",
+    5:  "May",
+    6:  "June",
+    7:  "July",
+    8:  "August",
+    9:  "September",
+    10: "October",
+    11: "November",
+    12: "December"
+}
+RECORDING_RE = re.compile( r"(?P<year>\d\d\d\d)-(?P<month>\d\d)-(?P<day>\d\d)_(?P<hour>\d\d)(?P<minute>\d\d)(?P<second>\d\d)\.(?P<ext>wav|flac|opus)$")
+
+_PLAYBACK_TEXT = "Tattled on {month} {day} at {hour} {minute} {am_pm}"
+
+# How many rows to pull out of the database at a time while iterating
+_PAGE_SIZE = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    name        TEXT PRIMARY KEY,
+    timestamp   REAL NOT NULL,
+    duration    REAL,
+    size        INTEGER NOT NULL,
+    intro_text  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recordings_by_time ON recordings (timestamp, name);
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    target      TEXT PRIMARY KEY,
+    timestamp   REAL NOT NULL,
+    name        TEXT NOT NULL
+);
+"""
+
+# How many recordings there are in each hour of each day (local time), kept
+# up to date by triggers so finding a day never has to look at the
+# recordings themselves
+_HOURS_SCHEMA = """
+CREATE TABLE recording_hours (
+    day     TEXT NOT NULL,
+    hour    INTEGER NOT NULL,
+    mday    INTEGER NOT NULL,
+    count   INTEGER NOT NULL,
+    PRIMARY KEY (day, hour)
+) WITHOUT ROWID;
+CREATE INDEX recording_hours_by_mday ON recording_hours (mday, day);
+"""
+
+_DAY = "date({0}.timestamp, 'unixepoch', 'localtime')"
+_HOUR = "CAST(strftime('%H', {0}.timestamp, 'unixepoch', 'localtime') AS INTEGER)"
+_MDAY = "CAST(strftime('%d', {0}.timestamp, 'unixepoch', 'localtime') AS INTEGER)"
+
+_COUNT_IN = f"""
+    INSERT INTO recording_hours (day, hour, mday, count) VALUES ({_DAY.format("NEW")}, {_HOUR.format("NEW")}, {_MDAY.format("NEW")}, 1)
+    ON CONFLICT(day, hour) DO UPDATE SET count = count + 1;
+"""
+_COUNT_OUT = f"""
+    UPDATE recording_hours SET count = count - 1 WHERE day = {_DAY.format("OLD")} AND hour = {_HOUR.format("OLD")};
+    DELETE FROM recording_hours WHERE day = {_DAY.format("OLD")} AND hour = {_HOUR.format("OLD")} AND count <= 0;
+"""
+_HOURS_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS recordings_count_insert AFTER INSERT ON recordings BEGIN {_COUNT_IN} END;
+CREATE TRIGGER IF NOT EXISTS recordings_count_delete AFTER DELETE ON recordings BEGIN {_COUNT_OUT} END;
+CREATE TRIGGER IF NOT EXISTS recordings_count_update AFTER UPDATE OF timestamp ON recordings
+    WHEN OLD.timestamp != NEW.timestamp BEGIN {_COUNT_OUT} {_COUNT_IN} END;
+"""
+_HOURS_BACKFILL = f"""
+INSERT INTO recording_hours (day, hour, mday, count)
+    SELECT {_DAY.format("recordings")}, {_HOUR.format("recordings")}, {_MDAY.format("recordings")}, COUNT(*)
+    FROM recordings GROUP BY 1, 2
+"""
+
+# Columns added since the first version of the schema, added to older
+# databases when they're opened.
+_ADDED_COLUMNS = {
+    "trim_start":  "REAL",
+    "trim_end":    "REAL",
+    "analysed_at": "REAL",
+    "gain_db":     "REAL",
+    "empty":       "INTEGER NOT NULL DEFAULT 0",
+}
+
+# Columns filled in by post-processing, see set_analysis()
+ANALYSIS_COLUMNS = ("trim_start", "trim_end", "gain_db", "empty")
+
+_RECORDING_COLUMNS = "name, timestamp, duration, size, intro_text, trim_start, trim_end, gain_db, empty"
+
+# Refresh what we learn from the file, but keep anything worked out later
+_UPSERT = """
+INSERT INTO recordings (name, timestamp, duration, size, intro_text) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(name) DO UPDATE SET
+    timestamp=excluded.timestamp, duration=excluded.duration,
+    size=excluded.size, intro_text=excluded.intro_text
+"""
+
+def sidecar_path(path) -> Path:
+    """Where the post-processing results for a recording are kept
+
+    Args:
+        path: the recording
+
+    Returns:
+        Path: e.g. 2023-01-02_151617.flac.json next to the recording
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".json")
+
+def day_range(day:date) -> tuple:
+    """The timestamps a day runs between, in local time
+
+    Args:
+        day (date): the day
+
+    Returns:
+        tuple: (start, end), the end being the start of the next day
+    """
+    start = datetime.combine(day, day_time())
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+def get_intro_text(file_name:str) -> str:
+    """Build the sentence that's spoken before a recording is played
+
+    Args:
+        file_name (str): name of the recording, e.g. 2023-01-02_151617.wav
+
+    Returns:
+        str: The intro, or None if this isn't a recording
+    """
+    match = RECORDING_RE.match(file_name)
+    if( match is None ):
+        return None
+
+    # Figure out AM / PM
+    hour = match.group('hour')
+    am_pm = "A.M."
+    if( int(hour) > 12 ):
+        hour = str(int(hour) - 12)
+        am_pm = "P.M."
+
+    # Figure out minute
+    minute = int(match.group('minute'))
+    minute_str = match.group('minute')
+    if(minute == 0):
+        minute_str = "o'clock"
+    elif(minute < 10 ):
+        minute_str = f"O {minute}"
+
+    # Construct intro
+    intro_text = _PLAYBACK_TEXT.format(
+        month=_MONTH_MAP[int(match.group('month'))],
+        day=int(match.group('day')),
+        hour=hour,
+        minute=minute_str,
+        am_pm=am_pm
+    )
+    return intro_text
+
+def get_timestamp(file_name:str) -> float:
+    """Work out when a recording was made from its name
+
+    Args:
+        file_name (str): name of the recording
+
+    Returns:
+        float: POSIX timestamp, or None if this isn't a recording
+    """
+    match = RECORDING_RE.match(file_name)
+    if( match is None ):
+        return None
+    return datetime(*(int(match.group(field)) for field in ("year", "month", "day", "hour", "minute", "second"))).timestamp()
+
+def _wav_duration(header:bytes, size:int) -> float:
+    """Work out how long a WAV file is. We go from the file size rather than
+    the header, since a recording that was cut off may have a header with
+    bogus lengths in it.
+    """
+    try:
+        fmt = parse_header(header)
+    except WavError:
+        return None
+    if( fmt.rate == 0 ):
+        return None
+    return max(0, size - fmt.data_offset) / (fmt.rate * fmt.frame_bytes)
+
+def _flac_duration(header:bytes) -> float:
+    """Read the length out of the FLAC STREAMINFO block, which the encoder
+    fills in once it has finished.
+    """
+    if( header[0:4] != b"fLaC" or len(header) < 8 + 18 ):
+        return None
+    # STREAMINFO always comes first, sample rate and total samples are
+    # packed into the 8 bytes starting 10 bytes into it.
+    packed = struct.unpack_from(">Q", header, 8 + 10)[0]
+    rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    if( rate == 0 or total_samples == 0 ):
+        return None
+    return total_samples / rate
+
+def _opus_duration(path:Path, size:int) -> float:
+    """Opus has no length in its header, so find the granule position (in
+    48kHz samples) of the last Ogg page.
+    """
+    with open(path, "rb") as f:
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+    page = tail.rfind(b"OggS")
+    if( page < 0 or page + 14 > len(tail) ):
+        return None
+    granule = struct.unpack_from("<q", tail, page + 6)[0]
+    if( granule < 0 ):
+        return None
+    return granule / 48000
+
+def get_duration(path:Path, size:int) -> float:
+    """Work out how long a recording is, without decoding it
+
+    Args:
+        path (Path): the recording
+        size (int): size of the file in bytes
+
+    Returns:
+        float: Length in seconds, or None if we can't tell
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(4096)
+        suffix = path.suffix.lower()
+        if( suffix == ".flac" ):
+            return _flac_duration(header)
+        elif( suffix == ".opus" ):
+            return _opus_duration(path, size)
+        return _wav_duration(header, size)
+    except (OSError, struct.error):
+        return None
+
+class Recording():
+    """Everything we know about a single recording
+    """
+    def __init__(self, directory:Path, name:str, timestamp:float, duration:float, size:int, intro_text:str,
+                 trim_start:float=None, trim_end:float=None, gain_db:float=None, empty:bool=False):
+        self.path = Path(directory, name)
+        self.name = name
+        self.timestamp = timestamp
+        self.duration = duration
+        self.size = size
+        self.intro_text = intro_text
+
+        # Where the speech starts and ends, None if we haven't looked yet
+        self.trim_start = trim_start
+        self.trim_end = trim_end
+
+        # How much to turn it up (or down) so it's as loud as the others,
+        # None if we haven't measured it yet
+        self.gain_db = gain_db
+
+        # Post-processing couldn't hear anybody in it
+        self.empty = bool(empty)
+
+class RecordingIndex():
+    """Persistent index of the recordings in a directory.
+    """
+    def __init__(self, directory:str, db_path:str):
+        """Open (or create) the index
+
+        Args:
+            directory (str): where the recordings live
+            db_path (str): where to keep the database
+        """
+        self._directory = Path(directory)
+        self.is_new = not Path(db_path).exists()
+
+        # The player's prefetch thread reads while the core thread writes
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+            existing = set(row[1] for row in self._db.execute("PRAGMA table_info(recordings)"))
+            for column, column_type in _ADDED_COLUMNS.items():
+                if( column not in existing ):
+                    self._db.execute(f"ALTER TABLE recordings ADD COLUMN {column} {column_type}")
+            if( self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'recording_hours'").fetchone() is None ):
+                self._db.executescript(_HOURS_SCHEMA)
+                self._db.execute(_HOURS_BACKFILL)
+            self._db.executescript(_HOURS_TRIGGERS)
+
+    def _describe(self, path:Path) -> tuple:
+        """Build the row for the given recording
+
+        Args:
+            path (Path): the recording
+
+        Returns:
+            tuple: the row, or None if this isn't a recording
+        """
+        timestamp = get_timestamp(path.name)
+        if( timestamp is None ):
+            return None
+        size = path.stat().st_size
+        return (path.name, timestamp, get_duration(path, size), size, get_intro_text(path.name))
+
+    def add(self, path):
+        """Add (or refresh) a single recording, e.g. one that's just finished
+
+        Args:
+            path (str): the recording
+        """
+        try:
+            row = self._describe(Path(path))
+        except OSError as e:
+            logging.error("RecordingIndex: Unable to index %s: %s", path, e)
+            return
+        if( row is None ):
+            logging.debug("RecordingIndex: %s isn't a recording, not indexing it", path)
+            return
+        with self._lock, self._db:
+            self._db.execute(_UPSERT, row)
+
+    def remove(self, name:str):
+        """Forget about a recording
+
+        Args:
+            name (str): name of the recording
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM recordings WHERE name = ?", (name,))
+
+    def set_analysis(self, name:str, fields:dict):
+        """Store what post-processing worked out about a recording, and note
+        that it has been analysed
+
+        Args:
+            name (str): name of the recording
+            fields (dict): values for any of ANALYSIS_COLUMNS, anything else
+                is ignored
+        """
+        columns = [column for column in ANALYSIS_COLUMNS if column in fields]
+        assignments = "".join(f"{column} = ?, " for column in columns)
+        with self._lock, self._db:
+            self._db.execute(f"UPDATE recordings SET {assignments}analysed_at = ? WHERE name = ?",
+                             [fields[column] for column in columns] + [time.time(), name])
+
+    def unanalysed(self):
+        """Recordings post-processing hasn't got to yet, or that were analysed
+        before the loudness was measured, most recent first
+
+        Yields:
+            Path: each recording
+        """
+        with self._lock:
+            names = [name for (name,) in self._db.execute(
+                "SELECT name FROM recordings WHERE analysed_at IS NULL OR gain_db IS NULL ORDER BY timestamp DESC, name DESC")]
+        for name in names:
+            yield Path(self._directory, name)
+
+    def rebuild(self):
+        """Make the index match what's actually in the directory
+        """
+        logging.info("RecordingIndex: Rebuilding the index of %s", self._directory)
+        rows = []
+        names = set()
+        for entry in scandir(self._directory):
+            try:
+                row = self._describe(Path(entry.path))
+            except OSError:
+                continue
+            if( row is not None ):
+                rows.append(row)
+                names.add(row[0])
+
+        with self._lock, self._db:
+            stale = [(name,) for (name,) in self._db.execute("SELECT name FROM recordings") if name not in names]
+            self._db.executemany("DELETE FROM recordings WHERE name = ?", stale)
+            self._db.executemany(_UPSERT, rows)
+        logging.info("RecordingIndex: Indexed %d recordings, dropped %d", len(rows), len(stale))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    def totals(self) -> tuple:
+        """How much we're storing
+
+        Returns:
+            tuple: (number of recordings, total size in bytes)
+        """
+        with self._lock:
+            return tuple(self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM recordings").fetchone())
+
+    def hours(self, day:date) -> dict:
+        """How many recordings were made in each hour of a day
+
+        Args:
+            day (date): the day, in local time
+
+        Returns:
+            dict: count for each hour (0-23) that has any recordings
+        """
+        with self._lock:
+            return dict(self._db.execute("SELECT hour, count FROM recording_hours WHERE day = ? ORDER BY hour",
+                                         (day.isoformat(),)))
+
+    def count(self, day:date) -> int:
+        """How many recordings were made on a day
+
+        Args:
+            day (date): the day, in local time
+
+        Returns:
+            int: the number of recordings
+        """
+        return sum(self.hours(day).values())
+
+    def latest_day(self, day_of_month:int) -> date:
+        """The most recent day with recordings that falls on the given day
+        of the month, e.g. the last 14th anyone tattled
+
+        Args:
+            day_of_month (int): 1 to 31
+
+        Returns:
+            date: the day, None if there are no recordings on that day of any month
+        """
+        with self._lock:
+            row = self._db.execute("SELECT day FROM recording_hours WHERE mday = ? ORDER BY day DESC LIMIT 1",
+                                   (day_of_month,)).fetchone()
+        return None if row is None else date.fromisoformat(row[0])
+
+    def sync_cursor(self, target:str) -> tuple:
+        """The last recording that was sent somewhere in full
+
+        Args:
+            target (str): where to
+
+        Returns:
+            tuple: (timestamp, name), None if nothing has been sent
+        """
+        with self._lock:
+            return self._db.execute("SELECT timestamp, name FROM sync_cursors WHERE target = ?", (target,)).fetchone()
+
+    def set_sync_cursor(self, target:str, recording:Recording):
+        """Note that everything up to and including a recording has been sent
+
+        Args:
+            target (str): where to
+            recording (Recording): the last recording sent
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO sync_cursors (target, timestamp, name) VALUES (?, ?, ?)",
+                             (target, recording.timestamp, recording.name))
+
+    def oldest_first(self, after:tuple=None):
+        """Iterate over the recordings, least recent first, a page at a time
+
+        Args:
+            after (tuple, optional): (timestamp, name) to start after, e.g. a sync_cursor()
+
+        Yields:
+            Recording: each recording
+        """
+        key = (float("-inf"), "") if after is None else tuple(after)
+        while( True ):
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT {_RECORDING_COLUMNS} FROM recordings "
+                    "WHERE timestamp > ? OR (timestamp = ? AND name > ?) "
+                    "ORDER BY timestamp ASC, name ASC LIMIT ?",
+                    (key[0], key[0], key[1], _PAGE_SIZE)).fetchall()
+            for row in rows:
+                yield Recording(self._directory, *row)
+            if( len(rows) < _PAGE_SIZE ):
+                return
+            key = (rows[-1][1], rows[-1][0])
+
+    def empty_recordings(self) -> list:
+        """Recordings post-processing found nobody talking in, least recent
+        first
+
+        Returns:
+            list: Recordings
+        """
+        with self._lock:
+            rows = self._db.execute(f"SELECT {_RECORDING_COLUMNS} FROM recordings WHERE empty ORDER BY timestamp ASC, name ASC").fetchall()
+        return [Recording(self._directory, *row) for row in rows]
+
+    def newest_first(self, since:float=None, until:float=None):
+        """Iterate over the recordings, most recent first. Rows are fetched a
+        page at a time so this is cheap to start and to abandon part way.
+
+        Args:
+            since (float, optional): only recordings made at or after this timestamp
+            until (float, optional): only recordings made before this timestamp
+
+        Yields:
+            Recording: each recording
+        """
+        key = (float("inf") if until is None else until, "")
+        since = float("-inf") if since is None else since
+        while( True ):
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT {_RECORDING_COLUMNS} FROM recordings "
+                    "WHERE (timestamp < ? OR (timestamp = ? AND name < ?)) AND timestamp >= ? "
+                    "ORDER BY timestamp DESC, name DESC LIMIT ?",
+                    (key[0], key[0], key[1], since, _PAGE_SIZE)).fetchall()
+            for row in rows:
+                yield Recording(self._directory, *row)
+            if( len(rows) < _PAGE_SIZE ):
+                return
+            key = (rows[-1][1], rows[-1][0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
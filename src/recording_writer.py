@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# recording_writer.py
+#
+# Gets recordings onto the SD card safely and cheaply. A recording is
+# written to a .part file in large aligned chunks, synced now and then
+# rather than after every write, and only renamed to its real name once its
+# header has been fixed up. Anything left as a .part after a power cut is
+# recovered, or thrown away, the next time we start.
+
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+import metrics
+from wav_reader import WavError, repair_header
+
+PART_SUFFIX = ".part"
+
+# Writes are made this big, and line up with the start of the file, so the
+# card sees a few whole blocks rather than lots of partial ones
+_CHUNK_BYTES = 64 * 1024
+
+# At most this much of a recording is lost if the power goes
+_DEFAULT_SYNC_SEC = 5.0
+
+# Sizes written into a WAV header until we know the real ones, the same as
+# arecord writes when it's streaming
+_UNKNOWN_SIZE = 0xFFFFFFFF
+_WAV_HEADER_BYTES = 44
+_WAV_HEADER = "<4sI4s4sIHHIIHH4sI"
+
+_SYNCS = metrics.counter("tattle_recording_syncs_total", "Times a recording in progress was synced to the card")
+_RECOVERED = metrics.counter("tattle_recordings_recovered_total", "Partial recordings recovered at startup")
+_DISCARDED = metrics.counter("tattle_recordings_discarded_total", "Partial recordings thrown away at startup")
+
+def part_path(path) -> Path:
+    """Where a recording is written until it's finished
+
+    Args:
+        path: where the finished recording goes
+
+    Returns:
+        Path: e.g. 2023-01-02_151617.wav.part
+    """
+    path = Path(path)
+    return path.with_name(path.name + PART_SUFFIX)
+
+def wav_header(data_bytes:int, rate:int, channels:int, sample_width:int=2) -> bytes:
+    """A plain 44 byte PCM WAV header
+
+    Args:
+        data_bytes (int): size of the sample data, _UNKNOWN_SIZE if we don't know yet
+        rate (int): sample rate
+        channels (int): number of channels
+        sample_width (int, optional): bytes per sample
+
+    Returns:
+        bytes: the header
+    """
+    riff_bytes = _UNKNOWN_SIZE if data_bytes == _UNKNOWN_SIZE else _WAV_HEADER_BYTES - 8 + data_bytes
+    return struct.pack(_WAV_HEADER, b"RIFF", riff_bytes, b"WAVE", b"fmt ", 16, 1, channels, rate,
+                       rate * channels * sample_width, channels * sample_width, sample_width * 8, b"data", data_bytes)
+
+def _repair_flac(f, frames:int):
+    """Fill in the total samples in the FLAC STREAMINFO, which the encoder
+    can't do itself when it's writing to a pipe
+    """
+    f.seek(0)
+    header = f.read(8 + 18)
+    if( header[0:4] != b"fLaC" or len(header) < 8 + 18 ):
+        raise WavError("Not a FLAC file")
+    packed = struct.unpack_from(">Q", header, 8 + 10)[0]
+    packed = (packed & ~0xFFFFFFFFF) | (frames & 0xFFFFFFFFF)
+    f.seek(8 + 10)
+    f.write(struct.pack(">Q", packed))
+
+def sync_directory(directory):
+    """Make a rename in the directory survive a power cut
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def finalize(part:Path, path:Path, frames:int=None):
+    """Fix up a finished recording's header, make sure it's on the card and
+    give it its real name
+
+    Args:
+        part (Path): the .part file
+        path (Path): its real name
+        frames (int, optional): how many frames were recorded, needed to fix
+            up FLAC written through a pipe
+    """
+    with open(part, "r+b") as f:
+        suffix = Path(path).suffix.lower()
+        if( suffix == ".wav" ):
+            repair_header(f)
+        elif( suffix == ".flac" and frames is not None ):
+            _repair_flac(f, frames)
+        f.flush()
+        os.fdatasync(f.fileno())
+    os.replace(part, path)
+    sync_directory(Path(path).parent)
+
+def recover_parts(directory) -> list:
+    """Deal with recordings that were cut off by a crash or power cut. WAV
+    files are fine up to the last synced chunk, so they're kept, compressed
+    ones can't be trusted so they're deleted.
+
+    Args:
+        directory: where the recordings are
+
+    Returns:
+        list: Paths of the recordings that were recovered
+    """
+    recovered = []
+    for part in Path(directory).glob("*" + PART_SUFFIX):
+        path = part.with_name(part.name[:-len(PART_SUFFIX)])
+        try:
+            if( path.suffix.lower() == ".wav" and part.stat().st_size > _WAV_HEADER_BYTES ):
+                finalize(part, path)
+                logging.info("Recovered the partial recording %s", path.name)
+                recovered.append(path)
+                _RECOVERED.inc()
+                continue
+        except (OSError, WavError, struct.error) as e:
+            logging.error("Unable to recover %s: %s", part.name, e)
+        logging.info("Deleting the partial recording %s", part.name)
+        part.unlink(missing_ok=True)
+        _DISCARDED.inc()
+    return recovered
+
+class RecordingWriter():
+    """Writes a recording to its .part file a chunk at a time, and puts it in
+    place once it's finished
+    """
+    def __init__(self, path, rate:int=None, channels:int=None, sync_sec:float=_DEFAULT_SYNC_SEC):
+        """
+        Args:
+            path: where the finished recording goes
+            rate (int, optional): sample rate, for WAV files we write the
+                header of ourselves
+            channels (int, optional): number of channels, for WAV files
+            sync_sec (float, optional): most time between syncs to the card
+        """
+        self.path = Path(path)
+        self._part = part_path(self.path)
+        self._sync_sec = sync_sec
+        self._buffer = bytearray()
+        self._written = 0
+        self._last_sync = time.monotonic()
+        self._file = open(self._part, "wb", buffering=0)
+        if( rate is not None and channels is not None ):
+            self._buffer += wav_header(_UNKNOWN_SIZE, rate, channels)
+
+    @property
+    def size(self) -> int:
+        """How big the recording is so far, including what's still buffered
+        """
+        return self._written + len(self._buffer)
+
+    def write(self, data:bytes):
+        """Add to the recording. Nothing reaches the card until a whole chunk
+        has built up.
+        """
+        self._buffer += data
+        if( len(self._buffer) >= _CHUNK_BYTES ):
+            whole = len(self._buffer) - len(self._buffer) % _CHUNK_BYTES
+            self._write_out(whole)
+            if( time.monotonic() - self._last_sync >= self._sync_sec ):
+                os.fdatasync(self._file.fileno())
+                self._last_sync = time.monotonic()
+                _SYNCS.inc()
+
+    def _write_out(self, count:int):
+        """Write the first count bytes of the buffer to the file
+        """
+        offset = 0
+        with memoryview(self._buffer) as view:
+            while( offset < count ):
+                with view[offset:count] as rest:
+                    offset += self._file.write(rest)
+        del self._buffer[:count]
+        self._written += count
+
+    def finish(self, frames:int=None) -> Path:
+        """Write out the rest, fix up the header and move the recording into
+        place
+
+        Args:
+            frames (int, optional): how many frames were recorded
+
+        Returns:
+            Path: the finished recording
+        """
+        self._write_out(len(self._buffer))
+        self._file.close()
+        finalize(self._part, self.path, frames)
+        return self.path
+
+    def abort(self):
+        """Throw the recording away
+        """
+        self._file.close()
+        self._part.unlink(missing_ok=True)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# retention.py
+#
+# Stops the recordings filling the SD card. A background thread, running at
+# the lowest CPU and I/O priority, deletes the oldest recordings once there
+# are too many, they take up too much space, or they're too old.
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from threading import Thread, Event
+import metrics
+import startup
+from recording_index import RecordingIndex, sidecar_path
+
+_DEFAULT_INTERVAL_SEC = 3600
+
+# Rough bytes per second of recording for each encoding, for estimating how
+# much room is left
+_BYTES_PER_SEC = {
+    "wav": 32000,
+    "flac": 20000,
+    "opus": 4000,
+}
+
+_EVICTED = metrics.counter("tattle_retention_evicted_total", "Recordings deleted by the retention policy")
+_STORED_BYTES = metrics.gauge("tattle_retention_stored_bytes", "Total size of the indexed recordings")
+_FREE_BYTES = metrics.gauge("tattle_storage_free_bytes", "Free space where the recordings are kept")
+
+class RetentionPolicy():
+    """Limits on what we keep, None for no limit
+    """
+    def __init__(self, max_bytes:int=None, max_age:float=None, max_count:int=None):
+        """
+        Args:
+            max_bytes (int, optional): total size of all recordings
+            max_age (float, optional): seconds since a recording was made
+            max_count (int, optional): number of recordings
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_count = max_count
+
+    def is_unlimited(self) -> bool:
+        return self.max_bytes is None and self.max_age is None and self.max_count is None
+
+def select_evictions(recordings, count:int, total_bytes:int, now:float, policy:RetentionPolicy, empty:list=()) -> list:
+    """Work out which recordings have to go
+
+    Args:
+        recordings (iterable): Recordings, oldest first. Only as many are
+            read as need to be evicted.
+        count (int): how many recordings there are
+        total_bytes (int): how big they all are
+        now (float): the current time
+        policy (RetentionPolicy): the limits
+        empty (list, optional): Recordings nobody seems to be talking in,
+            oldest first. These go first when there are too many or they
+            take up too much room.
+
+    Returns:
+        list: the Recordings to delete
+    """
+    evict = []
+    for recording in empty:
+        too_many = policy.max_count is not None and count > policy.max_count
+        too_big = policy.max_bytes is not None and total_bytes > policy.max_bytes
+        if( not (too_many or too_big) ):
+            break
+        evict.append(recording)
+        count -= 1
+        total_bytes -= recording.size
+
+    evicted = set(recording.name for recording in evict)
+    for recording in recordings:
+        if( recording.name in evicted ):
+            continue
+        too_many = policy.max_count is not None and count > policy.max_count
+        too_big = policy.max_bytes is not None and total_bytes > policy.max_bytes
+        too_old = policy.max_age is not None and recording.timestamp < now - policy.max_age
+        if( not (too_many or too_big or too_old) ):
+            break
+        evict.append(recording)
+        count -= 1
+        total_bytes -= recording.size
+    return evict
+
+def lower_priority():
+    """Make the calling thread as polite as possible. On Linux nice values
+    and I/O priorities belong to threads, so this doesn't slow down the rest
+    of the phone.
+    """
+    thread_id = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+    except (AttributeError, OSError) as e:
+        logging.debug("Unable to lower the CPU priority of thread %d: %s", thread_id, e)
+
+    ionice = startup.which("ionice")
+    if( ionice is not None ):
+        result = subprocess.run([ionice, "-c3", "-p", str(thread_id)], capture_output=True)
+        if( result.returncode != 0 ):
+            logging.debug("Unable to lower the I/O priority of thread %d", thread_id)
+
+class RetentionManager(Thread):
+    """Applies the retention policy now and then, and whenever it's kicked,
+    e.g. after a new recording is added.
+    """
+    def __init__(self, index:RecordingIndex, directory:str, policy:RetentionPolicy, interval:float=_DEFAULT_INTERVAL_SEC):
+        super().__init__(daemon=True)
+        self.name = "RetentionManager"
+        self._index = index
+        self._directory = Path(directory)
+        self._policy = policy
+        self._interval = interval
+        self._kick_event = Event()
+        self._keep_going = True
+
+    def kick(self):
+        """Apply the policy soon, rather than waiting for the next interval
+        """
+        self._kick_event.set()
+
+    def kill(self):
+        self._keep_going = False
+        self._kick_event.set()
+
+    def headroom(self, encoding:str, max_record_sec:float=None) -> float:
+        """Check how much room there is for recordings, logging it, and
+        kicking off a clean up if there isn't room for a full length one.
+
+        Args:
+            encoding (str): how the next recording will be stored
+            max_record_sec (float, optional): the longest a recording can be
+
+        Returns:
+            float: roughly how many seconds of recording there's room for
+        """
+        try:
+            free = shutil.disk_usage(self._directory).free
+        except OSError as e:
+            logging.error("RetentionManager: Unable to check the free space in %s: %s", self._directory, e)
+            return None
+        _FREE_BYTES.set(free)
+        seconds = free / _BYTES_PER_SEC.get(encoding, _BYTES_PER_SEC["wav"])
+        logging.info("RetentionManager: %.1f MB free, about %.0f minutes of recording", free / 1024 / 1024, seconds / 60)
+        if( max_record_sec is not None and seconds < max_record_sec ):
+            logging.warning("RetentionManager: Not enough room for a full length recording")
+            self.kick()
+        return seconds
+
+    def apply(self) -> int:
+        """Delete whatever the policy says has to go
+
+        Returns:
+            int: how many recordings were deleted
+        """
+        count, total_bytes = self._index.totals()
+        evictions = select_evictions(self._index.oldest_first(), count, total_bytes, time.time(), self._policy,
+                                     self._index.empty_recordings())
+        for recording in evictions:
+            logging.info("RetentionManager: Deleting %s", recording.name)
+            try:
+                recording.path.unlink(missing_ok=True)
+                sidecar_path(recording.path).unlink(missing_ok=True)
+            except OSError as e:
+                logging.error("RetentionManager: Unable to delete %s: %s", recording.name, e)
+                continue
+            self._index.remove(recording.name)
+            total_bytes -= recording.size
+            _EVICTED.inc()
+        _STORED_BYTES.set(total_bytes)
+        return len(evictions)
+
+    def run(self):
+        lower_priority()
+        while( self._keep_going ):
+            if( not self._policy.is_unlimited() ):
+                try:
+                    self.apply()
+                except Exception as e:
+                    logging.error("RetentionManager: Failed to apply the retention policy: %s", e)
+            self._kick_event.wait(self._interval)
+            self._kick_event.clear()
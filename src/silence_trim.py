@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# silence_trim.py
+#
+# Finds where the talking starts and stops in a recording, so that playback
+# can skip the handset being picked up and the fumbling before hang-up.
+
+import startup
+np = startup.lazy_import("numpy")
+
+# Length of the blocks we measure energy over
+BLOCK_SEC = 0.02
+
+# Keep a little of the silence either side so words aren't clipped
+_PAD_SEC = 0.2
+
+# Speech has to be this far above the background noise...
+_SPEECH_MARGIN_DB = 12
+
+# ...and never quieter than this, no matter how quiet the line is. Only a
+# recording that never gets this loud at all counts as empty.
+_SPEECH_FLOOR_DB = -45
+
+# With less speech than this standing out from the background we can't tell
+# where the talking is, so the whole recording is kept
+_MIN_SPEECH_SEC = 0.3
+
+def block_energy_db(samples:"np.ndarray", rate:int, block_sec:float=BLOCK_SEC) -> "np.ndarray":
+    """RMS level of each block of the recording
+
+    Args:
+        samples (np.ndarray): mono float samples in the range [-1, 1]
+        rate (int): sample rate
+        block_sec (float, optional): block length in seconds
+
+    Returns:
+        np.ndarray: level of each block in dBFS
+    """
+    block = max(1, int(rate * block_sec))
+    blocks = len(samples) // block
+    if( blocks == 0 ):
+        return np.zeros(0, dtype=np.float32)
+    frames = samples[:blocks * block].reshape(blocks, block).astype(np.float32)
+    power = np.einsum('ij,ij->i', frames, frames) / block
+    return 10 * np.log10(np.maximum(power, 1e-10))
+
+def speech_bounds(levels:"np.ndarray", peak:float, duration:float) -> tuple:
+    """Find the part of the recording that has someone talking in it, from
+    the level of each BLOCK_SEC block. The noise floor is taken from the
+    quietest blocks, anything well above that counts as speech. A recording
+    with no quiet stretch, like someone talking the whole time or a noisy
+    room, has nothing standing out from its floor, so all of it is kept.
+
+    Args:
+        levels (np.ndarray): level of each block in dBFS, see block_energy_db()
+        peak (float): the loudest sample, in the range [0, 1]
+        duration (float): length of the recording in seconds
+
+    Returns:
+        tuple: (start, end) in seconds, None if it's too quiet for anybody
+            to have said anything
+    """
+    if( len(levels) == 0 ):
+        return None
+
+    peak_db = 20 * np.log10(max(peak, 1e-5))
+    if( peak_db < _SPEECH_FLOOR_DB and np.max(levels) < _SPEECH_FLOOR_DB ):
+        return None
+
+    noise_floor = np.percentile(levels, 10)
+    threshold = max(noise_floor + _SPEECH_MARGIN_DB, _SPEECH_FLOOR_DB)
+    voiced = levels > threshold
+    if( np.count_nonzero(voiced) * BLOCK_SEC < _MIN_SPEECH_SEC ):
+        return 0.0, duration
+
+    first = int(np.argmax(voiced))
+    last = len(voiced) - 1 - int(np.argmax(voiced[::-1]))
+    start = max(0.0, first * BLOCK_SEC - _PAD_SEC)
+    end = min(duration, (last + 1) * BLOCK_SEC + _PAD_SEC)
+    return start, end
+
+def find_speech(samples:"np.ndarray", rate:int) -> tuple:
+    """speech_bounds() for a whole recording at once
+
+    Args:
+        samples (np.ndarray): mono float samples in the range [-1, 1]
+        rate (int): sample rate
+
+    Returns:
+        tuple: (start, end) in seconds, None if nobody said anything
+    """
+    if( len(samples) == 0 ):
+        return None
+    return speech_bounds(block_energy_db(samples, rate), float(np.max(np.abs(samples))), len(samples) / rate)
+
+if __name__ == "__main__":
+    import sys
+    import pcm
+    for file in sys.argv[1:]:
+        print(f"{file}: {find_speech(*pcm.decode_audio(file))}")
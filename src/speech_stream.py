@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# speech_stream.py
+#
+# Plays speech while espeak-ng is still synthesizing it. espeak-ng writes
+# WAV to a pipe a clause at a time, so instead of waiting for it to finish
+# we parse the header as soon as it arrives and hand the samples on as they
+# come. The first words are heard about as soon as they're synthesized,
+# however long the rest of the sentence is.
+
+import logging
+import struct
+import subprocess
+import time
+from threading import Lock
+import metrics
+import pcm
+from wav_reader import WavError, parse_header
+
+# Read whatever espeak-ng has written, up to this much at a time
+_READ_BYTES = 4096
+
+# If there's still no data chunk after this much, it isn't a WAV stream
+_MAX_HEADER_BYTES = 4096
+
+_FIRST_SAMPLE = metrics.histogram("tattle_tts_first_sample_seconds", "Time from starting to synthesize speech to its first samples being ready",
+                                  buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+class SpeechStream():
+    """A speech engine writing WAV to a pipe, read a piece at a time. What's
+    read can also be copied somewhere, e.g. into the TTS cache, which is only
+    told to keep it if the whole thing came through.
+    """
+    def __init__(self, args:list, tee=None):
+        """Start synthesizing
+
+        Args:
+            args (list): command line that writes WAV to stdout
+            tee (optional): gets everything that's read via write(), then
+                commit() if synthesis finished or discard() if it didn't
+        """
+        self._tee = tee
+        self._lock = Lock()
+        self._cancelled = False
+        self._finished = False
+        self._started = time.monotonic()
+        self._proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+    def cancel(self):
+        """Stop synthesizing. Anyone reading chunks() sees the end of the
+        stream straight away.
+        """
+        with self._lock:
+            if( self._finished ):
+                return
+            self._cancelled = True
+            if( self._proc.poll() is None ):
+                self._proc.kill()
+
+    def _read(self) -> bytes:
+        data = self._proc.stdout.read1(_READ_BYTES)
+        if( self._tee is not None and len(data) > 0 ):
+            self._tee.write(data)
+        return data
+
+    def chunks(self):
+        """The speech, as it's synthesized
+
+        Yields:
+            np.ndarray: int16 samples in the output format
+        """
+        header = b""
+        fmt = None
+        while( fmt is None ):
+            data = self._read()
+            if( len(data) == 0 ):
+                self._finished = True
+                return
+            header += data
+            try:
+                fmt = parse_header(header)
+            except (WavError, struct.error):
+                # Not all of the header has arrived yet
+                if( len(header) > _MAX_HEADER_BYTES ):
+                    raise
+
+        pending = header[fmt.data_offset:]
+        first = True
+        while( True ):
+            whole = len(pending) - len(pending) % fmt.frame_bytes
+            if( whole > 0 ):
+                if( first ):
+                    _FIRST_SAMPLE.observe(time.monotonic() - self._started)
+                    first = False
+                yield pcm.decode_chunk(pending[:whole], fmt)
+                pending = pending[whole:]
+            data = self._read()
+            if( len(data) == 0 ):
+                self._finished = True
+                return
+            pending += data
+
+    def close(self) -> bool:
+        """Wait for the engine to exit, or stop it if we didn't read to the
+        end, and tell the tee whether to keep what it was given
+
+        Returns:
+            bool: True if the speech was synthesized in full
+        """
+        if( not self._finished ):
+            self.cancel()
+        self._proc.stdout.close()
+        returncode = self._proc.wait()
+        complete = returncode == 0 and not self._cancelled
+        if( not complete and not self._cancelled ):
+            logging.error("SpeechStream: %s exited with %d", self._proc.args[0], returncode)
+        if( self._tee is not None ):
+            if( complete ):
+                self._tee.commit()
+            else:
+                self._tee.discard()
+        return complete
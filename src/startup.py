@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# startup.py
+#
+# Helpers for getting the phone answering quickly after it's powered on:
+# modules that are only needed once someone uses the phone are imported on
+# first use, command line tools are only looked up once, and the time each
+# part of startup takes is measured so we can see where it goes.
+
+import functools
+import importlib.util
+import logging
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+class _LazyModule():
+    """Stands in for a module until one of its attributes is used. The first
+    use imports it under a lock, importlib.util.LazyLoader can hand out a
+    half loaded module when two threads get there at once.
+    """
+    def __init__(self, name:str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute:str):
+        module = self._module
+        if( module is None ):
+            with self._lock:
+                if( self._module is None ):
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attribute)
+
+def lazy_import(name:str):
+    """Import a module the first time one of its attributes is used, rather
+    than now. Anything used in annotations must be quoted, or the module is
+    loaded as soon as the function is defined.
+
+    Args:
+        name (str): the module, e.g. "numpy"
+
+    Returns:
+        module: the module, or a stand-in which loads it on first use
+    """
+    if( name in sys.modules ):
+        return sys.modules[name]
+    if( importlib.util.find_spec(name) is None ):
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    return _LazyModule(name)
+
+@functools.lru_cache(maxsize=None)
+def which(tool:str) -> str:
+    """shutil.which(), but each tool is only searched for once
+
+    Args:
+        tool (str): name of the command line tool
+
+    Returns:
+        str: full path to it, None if it isn't installed
+    """
+    return shutil.which(tool)
+
+class StartupTimer():
+    """Notes how long each part of startup takes, and when we were ready
+    """
+    def __init__(self, started:float=None):
+        """
+        Args:
+            started (float, optional): time.monotonic() when startup began.
+                Defaults to now.
+        """
+        self._started = time.monotonic() if started is None else started
+        self._phases = []
+
+    def add(self, name:str, seconds:float):
+        self._phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name:str):
+        """Time the body of a with statement
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    def report(self) -> str:
+        """Log how long startup took, broken down by component
+
+        Returns:
+            str: the report
+        """
+        breakdown = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self._phases)
+        report = f"Ready after {self.elapsed() * 1000:.0f}ms ({breakdown})"
+        logging.info(report)
+        return report
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# sync_receiver.py
+#
+# A small HTTP server that takes recordings from SyncService and files them
+# in a directory, for testing or for a machine on the local network to
+# collect tattles with. Files being uploaded are kept as .part until the
+# last byte arrives.
+#
+#   python3 sync_receiver.py --directory ./received --port 8080
+#   python3 tattle_core.py --sync_url http://<this machine>:8080/
+
+import argparse
+import logging
+import os
+import re
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+_PART_SUFFIX = ".part"
+
+# Only plain names, so nobody can write outside the directory
+_SEGMENT_RE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+_RANGE_RE = re.compile(r"bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$")
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    """HEAD says how much of a file we have, PUT with a Content-Range adds to
+    it, PUT without one replaces it
+    """
+    # Keep the connection open between chunks
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("SyncReceiver: %s %s", self.address_string(), format % args)
+
+    def _local_path(self) -> Path:
+        """Where the requested file goes, None if the path isn't allowed
+        """
+        segments = [unquote(segment) for segment in urlsplit(self.path).path.split("/") if segment]
+        if( len(segments) == 0 or not all(_SEGMENT_RE.match(segment) for segment in segments) ):
+            return None
+        return Path(self.server.directory, *segments)
+
+    def _reply(self, status:int, offset:int=None):
+        self.send_response(status)
+        if( offset is not None ):
+            self.send_header("Upload-Offset", str(offset))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _received(self, path:Path) -> int:
+        """How much of a file has arrived, None if none of it has
+        """
+        for candidate in (path, path.with_name(path.name + _PART_SUFFIX)):
+            if( candidate.exists() ):
+                return candidate.stat().st_size
+        return None
+
+    def do_HEAD(self):
+        path = self._local_path()
+        if( path is None ):
+            self._reply(400)
+            return
+        received = self._received(path)
+        self._reply(404 if received is None else 200, received)
+
+    def do_PUT(self):
+        path = self._local_path()
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length)
+        if( path is None ):
+            self._reply(400)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part = path.with_name(path.name + _PART_SUFFIX)
+
+        content_range = self.headers.get("Content-Range")
+        if( content_range is None ):
+            part.write_bytes(body)
+            os.replace(part, path)
+            self._reply(201)
+            return
+
+        match = _RANGE_RE.match(content_range)
+        if( match is None or int(match.group("end")) - int(match.group("start")) + 1 != len(body) ):
+            self._reply(400)
+            return
+        start, total = int(match.group("start")), int(match.group("total"))
+        if( path.exists() ):
+            # Already have all of it
+            self._reply(409, path.stat().st_size)
+            return
+        received = part.stat().st_size if part.exists() else 0
+        if( start != received ):
+            self._reply(409, received)
+            return
+        with open(part, "ab") as f:
+            f.write(body)
+        if( received + len(body) >= total ):
+            os.replace(part, path)
+            logging.info("SyncReceiver: Received %s", path)
+            self._reply(201, total)
+        else:
+            self._reply(204, received + len(body))
+
+class SyncReceiver(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory:str, port:int, host:str=""):
+        """
+        Args:
+            directory (str): where to put what we're sent
+            port (int): port to listen on, 0 for any free one
+            host (str, optional): address to listen on, defaults to all of them
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        super().__init__((host, port), SyncRequestHandler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directory", help="Where to put received recordings", default="received")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("--host", help="Address to listen on", default="")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    receiver = SyncReceiver(args.directory, args.port, args.host)
+    logging.info("SyncReceiver: Listening on port %d, saving to %s", receiver.server_address[1], receiver.directory)
+    try:
+        receiver.serve_forever()
+    except KeyboardInterrupt:
+        pass
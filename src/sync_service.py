@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# sync_service.py
+#
+# Copies recordings, and what we know about them, to an HTTP server in the
+# background. Uploads go oldest first in chunks over one kept-alive
+# connection, at a limited rate, and pick up where they left off after a
+# dropped connection or a restart. Nothing is sent while a handset is off
+# the hook, so the SD card and CPU are left to the audio.
+#
+# The server is expected to answer HEAD with how much of a file it has in an
+# Upload-Offset header (404 if none), and to accept PUTs with a Content-Range
+# saying where the chunk goes. sync_receiver.py is one that does.
+
+import http.client
+import json
+import logging
+import time
+from pathlib import Path
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit, quote
+import metrics
+from recording_index import RecordingIndex, Recording, sidecar_path
+
+_DEFAULT_CHUNK_BYTES = 256 * 1024
+_DEFAULT_RATE_BYTES = 128 * 1024
+
+# How often to look for something to send when nobody tells us, and how
+# long to leave it after the server has a problem
+_POLL_SEC = 300
+_RETRY_SEC = 30
+_TIMEOUT_SEC = 30
+
+# Recordings are left this long for post-processing to get to them first,
+# it may decide they're empty and delete them. While we're waiting on one we
+# look again more often.
+_SETTLE_SEC = 120
+_SETTLE_POLL_SEC = 15
+
+_SENT_BYTES = metrics.counter("tattle_sync_bytes_total", "Bytes of recordings uploaded")
+_SENT = metrics.counter("tattle_sync_recordings_total", "Recordings uploaded in full")
+_ERRORS = metrics.counter("tattle_sync_errors_total", "Uploads that failed and will be retried")
+_PAUSED = metrics.counter("tattle_sync_paused_total", "Uploads that stopped part way because a handset was picked up")
+
+class SyncError(Exception):
+    """Raised when the server says no
+    """
+    pass
+
+class TokenBucket():
+    """Limits how fast we send. Tokens (bytes) build up at a steady rate, to
+    at most burst of them, and each chunk waits until there are enough.
+    """
+    def __init__(self, rate:float, burst:int):
+        """
+        Args:
+            rate (float): bytes per second, None for no limit
+            burst (int): most bytes that can be sent in one go
+        """
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def take(self, amount:int, interrupt:Event) -> bool:
+        """Wait until we're allowed to send
+
+        Args:
+            amount (int): bytes about to be sent, at most burst
+            interrupt (Event): stop waiting if this is set
+
+        Returns:
+            bool: False if we were interrupted
+        """
+        if( self._rate is None ):
+            return not interrupt.is_set()
+        while( True ):
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if( self._tokens >= amount ):
+                self._tokens -= amount
+                return True
+            if( interrupt.wait((amount - self._tokens) / self._rate) ):
+                return False
+
+class SyncService(Thread):
+    """Uploads the recordings in one or more indexes, oldest first. Each
+    index remembers the last recording that was sent in full, so a restart
+    carries on from there, and a half sent recording is resumed from
+    wherever the server says it got to.
+    """
+    def __init__(self, url:str, rate_bytes:float=_DEFAULT_RATE_BYTES, chunk_bytes:int=_DEFAULT_CHUNK_BYTES):
+        """
+        Args:
+            url (str): where to send recordings, e.g. http://nas.local:8080/tattles/
+            rate_bytes (float, optional): most bytes per second to send, None for no limit
+            chunk_bytes (int, optional): how much to send in each request
+        """
+        super().__init__(daemon=True)
+        self.name = "SyncService"
+        parts = urlsplit(url)
+        if( parts.scheme not in ("http", "https") or not parts.hostname ):
+            raise ValueError(f"Can't sync to {url}, it needs to be an http:// or https:// URL")
+        self._url = url
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._base = parts.path.rstrip("/")
+        self._chunk_bytes = chunk_bytes
+        self._bucket = TokenBucket(rate_bytes, chunk_bytes)
+        self._connection = None
+        self._poll_sec = _POLL_SEC
+
+        self._lock = Lock()
+        self._sources = []
+        self._holds = 0
+        self._wake = Event()
+        # Set while nothing is stopping us sending
+        self._clear = Event()
+        self._clear.set()
+        # Set when we should stop what we're sending
+        self._interrupt = Event()
+        self._keep_going = True
+
+    def watch(self, index:RecordingIndex, prefix:str=None):
+        """Sync the recordings in an index
+
+        Args:
+            index (RecordingIndex): the recordings
+            prefix (str, optional): directory on the server to put them in,
+                e.g. the line they were recorded on
+        """
+        with self._lock:
+            self._sources.append((index, prefix))
+        self.kick()
+
+    def kick(self):
+        """Look for something to send now, e.g. after a recording finishes
+        """
+        self._wake.set()
+
+    def hold(self):
+        """Stop sending, e.g. because a handset has been picked up. Whatever
+        is being sent stops after the chunk in flight.
+        """
+        with self._lock:
+            self._holds += 1
+            self._clear.clear()
+            self._interrupt.set()
+
+    def release(self):
+        """Undo a hold(), sending starts again once nobody is holding us
+        """
+        with self._lock:
+            self._holds = max(0, self._holds - 1)
+            if( self._holds == 0 ):
+                self._interrupt.clear()
+                self._clear.set()
+                self._wake.set()
+
+    def kill(self):
+        self._keep_going = False
+        self._interrupt.set()
+        self._clear.set()
+        self._wake.set()
+
+    def _cursor_key(self, prefix:str) -> str:
+        """What the cursor is kept under in the index, so pointing us at a
+        different server starts again from the beginning
+        """
+        return self._url if prefix is None else f"{self._url}#{prefix}"
+
+    def _remote_path(self, prefix:str, name:str) -> str:
+        parts = [self._base] + ([quote(prefix)] if prefix else []) + [quote(name)]
+        return "/".join(parts)
+
+    def _request(self, method:str, path:str, body:bytes=None, headers:dict=None) -> http.client.HTTPResponse:
+        """Make a request on the kept-alive connection, opening a new one if
+        the server has closed it since we last used it
+
+        Returns:
+            http.client.HTTPResponse: the response, its body already read
+        """
+        for attempt in range(2):
+            if( self._connection is None ):
+                connection_type = http.client.HTTPSConnection if self._scheme == "https" else http.client.HTTPConnection
+                self._connection = connection_type(self._host, self._port, timeout=_TIMEOUT_SEC)
+            try:
+                self._connection.request(method, path, body=body, headers=headers or {})
+                response = self._connection.getresponse()
+                response.read()
+                if( response.will_close ):
+                    self._close()
+                return response
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # An idle keep-alive connection the server has given up on
+                self._close()
+                if( attempt > 0 ):
+                    raise
+
+    def _close(self):
+        if( self._connection is not None ):
+            self._connection.close()
+            self._connection = None
+
+    def _offset(self, path:str) -> int:
+        """How much of a file the server already has
+        """
+        response = self._request("HEAD", path)
+        if( response.status == 404 ):
+            return 0
+        if( response.status != 200 ):
+            raise SyncError(f"HEAD {path} returned {response.status}")
+        return int(response.getheader("Upload-Offset", "0"))
+
+    def _upload(self, local:Path, remote:str) -> bool:
+        """Send a file a chunk at a time, starting from wherever the server
+        got to
+
+        Returns:
+            bool: True once the server has all of it, False if we were held
+        """
+        size = local.stat().st_size
+        offset = self._offset(remote) if size > 0 else 0
+        with open(local, "rb") as f:
+            while( offset < size ):
+                f.seek(offset)
+                chunk = f.read(min(self._chunk_bytes, size - offset))
+                if( not self._bucket.take(len(chunk), self._interrupt) ):
+                    _PAUSED.inc()
+                    return False
+                end = offset + len(chunk) - 1
+                response = self._request("PUT", remote, chunk, {
+                    "Content-Range": f"bytes {offset}-{end}/{size}",
+                    "Content-Type": "application/octet-stream"})
+                if( response.status == 409 ):
+                    # Someone else has been writing to it, go with what it has
+                    offset = int(response.getheader("Upload-Offset", "0"))
+                    continue
+                if( response.status not in (200, 201, 204) ):
+                    raise SyncError(f"PUT {remote} returned {response.status}")
+                _SENT_BYTES.inc(len(chunk))
+                offset += len(chunk)
+        return True
+
+    def _metadata(self, recording:Recording) -> bytes:
+        """What we know about a recording, with anything post-processing found
+        """
+        details = {
+            "name": recording.name,
+            "timestamp": recording.timestamp,
+            "duration": recording.duration,
+            "size": recording.size,
+            "intro_text": recording.intro_text,
+            "trim_start": recording.trim_start,
+            "trim_end": recording.trim_end,
+            "gain_db": recording.gain_db,
+        }
+        try:
+            details["analysis"] = json.loads(sidecar_path(recording.path).read_text())
+        except (OSError, ValueError):
+            pass
+        return json.dumps(details).encode("utf-8")
+
+    def _sync(self, index:RecordingIndex, prefix:str) -> bool:
+        """Send everything in an index we haven't sent yet
+
+        Returns:
+            bool: False if we stopped because we were held
+        """
+        target = self._cursor_key(prefix)
+        for recording in index.oldest_first(after=index.sync_cursor(target)):
+            if( recording.gain_db is None and time.time() - recording.timestamp - (recording.duration or 0) < _SETTLE_SEC ):
+                logging.debug("SyncService: Waiting for %s to be post-processed", recording.name)
+                self._poll_sec = _SETTLE_POLL_SEC
+                return True
+            if( recording.path.exists() ):
+                logging.debug("SyncService: Sending %s", recording.name)
+                if( not self._upload(recording.path, self._remote_path(prefix, recording.name)) ):
+                    return False
+                response = self._request("PUT", self._remote_path(prefix, recording.name + ".json"), self._metadata(recording),
+                                         {"Content-Type": "application/json"})
+                if( response.status not in (200, 201, 204) ):
+                    raise SyncError(f"PUT {recording.name}.json returned {response.status}")
+                _SENT.inc()
+            index.set_sync_cursor(target, recording)
+        return True
+
+    def run(self):
+        while( self._keep_going ):
+            self._wake.wait(self._poll_sec)
+            self._wake.clear()
+            self._clear.wait()
+            self._poll_sec = _POLL_SEC
+            with self._lock:
+                sources = list(self._sources)
+            for index, prefix in sources:
+                if( not self._keep_going ):
+                    break
+                try:
+                    if( not self._sync(index, prefix) ):
+                        logging.debug("SyncService: Held, carrying on later")
+                        break
+                except (OSError, http.client.HTTPException, SyncError) as e:
+                    logging.warning("SyncService: Unable to sync to %s, trying again in %ds: %s", self._url, _RETRY_SEC, e)
+                    _ERRORS.inc()
+                    self._close()
+                    self._interrupt.wait(_RETRY_SEC)
+                    self._wake.set()
+                    break
+        self._close()
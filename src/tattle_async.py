@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+
+# tattle_async.py
+#
+# The phone's state machine on a single asyncio event loop. GPIO edges,
+# audio and recording subprocesses finishing, and timeouts are all things
+# to await, instead of each having a thread blocked on a Queue. Selected
+# with `tattle_core.py --runtime asyncio`.
+
+import asyncio
+import logging
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+import gpio_backend
+import pcm
+import startup
+from hook_monitor import HookMonitor, HookState
+from dial_monitor import DialMonitor
+from voice_recorder import ENCODING_EXTENSIONS, capture_args, encoder_args
+from tts_cache import TTSCache, CacheEntryWriter
+from playback_pipeline import prepare_recording
+from transport import Transport, TransportControl, PLAYER_LEAD_SEC
+from recording_writer import part_path, finalize
+from post_process import PostProcessor
+import tattle_core
+from tattle_core import TattlePhone, TattleState, TattleRootMenu, build_retention_manager, build_sync_service, max_record_bytes, open_recording_index
+from recording_index import day_range
+
+_PLAYBACK_UTIL = 'aplay'
+_RECORD_UTIL = 'arecord'
+
+# How long each state may wait for something to happen, None waits forever.
+# Nobody choosing from the menu, or talking for too long, puts the phone back
+# to idle until the handset is hung up and lifted again. Recording is limited
+# by --max_record_sec.
+_STATE_TIMEOUTS = {
+    TattleState.TATTLE_IDLE: None,
+    TattleState.TATTLE_MENU_ROOT: 60,
+    TattleState.TATTLE_MENU_DAY: 60,
+}
+
+# How often to check the size of a recording, when it's limited
+_SIZE_CHECK_SEC = 0.5
+
+# Slack on top of a clip's length before we give up on it having finished
+_CLIP_TIMEOUT_SLACK_SEC = 5
+_ENCODER_TIMEOUT_SEC = 10
+
+# Samples handed to aplay at a time while a transport is playing
+_TRANSPORT_PERIOD_FRAMES = 512
+
+# Speech is passed from espeak-ng to aplay in pieces up to this big
+_SPEECH_READ_BYTES = 4096
+
+# Decoding and synthesis are the only things that can't be awaited directly
+_EXECUTOR_WORKERS = 2
+
+class _EventSink():
+    """Looks enough like a Queue for the monitors to put their events in,
+    they're only ever called on the loop so this never blocks.
+    """
+    def __init__(self, queue:asyncio.Queue):
+        self._queue = queue
+
+    def put(self, item):
+        self._queue.put_nowait(item)
+
+class AsyncEdgeDispatcher():
+    """Does the job of gpio_backend.EdgeDispatcher on the event loop, so the
+    hook and dial monitors don't need a thread at all. GPIO callbacks hand
+    the timestamped edge to the loop with call_soon_threadsafe() and timers
+    are plain loop timers.
+    """
+    def __init__(self, loop:asyncio.AbstractEventLoop, gpio):
+        self._loop = loop
+        self._gpio = gpio
+        self._handlers = {}
+
+    @property
+    def gpio(self):
+        return self._gpio
+
+    def clock(self) -> float:
+        return self._gpio.clock()
+
+    def watch(self, pin:int, edge:int, handler):
+        if( pin in self._handlers ):
+            raise ValueError(f"Pin {pin} is already being watched")
+        self._handlers[pin] = handler
+        self._gpio.add_event_detect(pin, edge, callback=self._on_edge)
+
+    def unwatch(self, pin:int):
+        if( self._handlers.pop(pin, None) is not None ):
+            self._gpio.remove_event_detect(pin)
+
+    def call_at(self, deadline:float, callback):
+        delay = max(0, deadline - self.clock()) / self._gpio.time_scale
+        self._loop.call_later(delay, callback)
+
+    def _on_edge(self, pin):
+        # Called on whatever thread the GPIO library uses
+        self._loop.call_soon_threadsafe(self._deliver, pin, self._gpio.clock())
+
+    def _deliver(self, pin:int, timestamp:float):
+        handler = self._handlers.get(pin)
+        if( handler is not None ):
+            handler(pin, timestamp)
+
+class AsyncTattlePhone():
+    """Same phone as TattlePhone, with the same states and menu, but every
+    wait is an await with an explicit timeout.
+    """
+    def __init__(self, config, audio_backend=None):
+        """Constructor
+
+        Args:
+            config (argparse.Namespace): settings, see tattle_core.build_parser()
+            audio_backend: ignored, audio always goes through aplay subprocesses
+                that the loop can wait on
+        """
+        self._config = config
+        self._state = TattleState.TATTLE_IDLE
+        self._running = True
+        self._loop = None
+        self._events = None
+        self._audio_task = None
+        self._audio_serial = 0
+        self._playback_day = None
+        self._playback_util = startup.which(_PLAYBACK_UTIL)
+        self._record_util = startup.which(_RECORD_UTIL)
+
+        # Set once the loop is running and the monitors are watching
+        self.ready = threading.Event()
+
+        self.startup = startup.StartupTimer(tattle_core._IMPORT_START)
+        self.startup.add("imports", tattle_core._IMPORT_SEC)
+
+        # Open the index of recordings, after tidying up anything a crash left behind
+        with self.startup.phase("index"):
+            self.recording_index = open_recording_index(self._config)
+
+        # Keep the recordings from filling the card
+        self.retention = build_retention_manager(self._config, self.recording_index)
+        self.retention.start()
+
+        # Analyse finished recordings in worker processes, catching up on any
+        # that were missed last time
+        self.post_processor = PostProcessor(self._config.postprocess_workers)
+        self.post_processor.start()
+        self.post_processor.backfill(self.recording_index)
+
+        # Copy recordings to the server in the background, if there is one
+        self.sync_service = build_sync_service(self._config)
+        if( self.sync_service is not None ):
+            self.sync_service.start()
+            self.sync_service.watch(self.recording_index, self._config.line_name)
+
+        # Instantiate the speech cache, the prompts are warmed once the loop is running
+        with self.startup.phase("tts cache"):
+            self.tts_cache = TTSCache(self._config.tts_cache_dir, max_bytes=self._config.tts_cache_mb * 1024 * 1024)
+
+    def change_state(self, new_state:TattleState):
+        logging.debug("Changing from %s to %s", self._state.name, new_state.name)
+        # Don't upload anything while someone's using the phone
+        if( self.sync_service is not None and (self._state == TattleState.TATTLE_IDLE) != (new_state == TattleState.TATTLE_IDLE) ):
+            if( new_state == TattleState.TATTLE_IDLE ):
+                self.sync_service.release()
+            else:
+                self.sync_service.hold()
+        self._state = new_state
+
+    def kill(self):
+        """Ask the phone to shut down, safe to call from any thread
+        """
+        if( self._loop is not None ):
+            self._loop.call_soon_threadsafe(self._events.put_nowait, ("KILL", None))
+
+    async def _next_event(self, timeout:float=None) -> tuple:
+        """Wait for the next thing to happen
+
+        Args:
+            timeout (float, optional): seconds to wait, None for forever
+
+        Returns:
+            tuple: (source, item), ("TIMEOUT", None) if nothing happened in time
+        """
+        try:
+            return await asyncio.wait_for(self._events.get(), timeout)
+        except asyncio.TimeoutError:
+            return ("TIMEOUT", None)
+
+    def _remaining(self, deadline:float) -> float:
+        if( deadline is None ):
+            return None
+        return max(0, deadline - self._loop.time())
+
+    def _state_deadline(self) -> float:
+        if( self._state == TattleState.TATTLE_RECORD ):
+            timeout = self._config.max_record_sec
+        else:
+            timeout = _STATE_TIMEOUTS.get(self._state)
+        return None if timeout is None else self._loop.time() + timeout
+
+    # Audio
+
+    async def _run_player(self, args:list, data:bytes=None):
+        """Run a player until it finishes, killing it if we're cancelled
+
+        Args:
+            args (list): command line
+            data (bytes, optional): fed to its stdin
+        """
+        proc = await asyncio.create_subprocess_exec(*args,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL)
+        try:
+            if( data is not None ):
+                with suppress(BrokenPipeError, ConnectionResetError):
+                    proc.stdin.write(data)
+                    await proc.stdin.drain()
+                    proc.stdin.close()
+            await proc.wait()
+        finally:
+            if( proc.returncode is None ):
+                proc.kill()
+                await proc.wait()
+
+    async def _play_samples(self, samples):
+        await self._run_player([self._playback_util, "-q", "-t", "raw", "-f", "S16_LE",
+                                "-r", str(pcm.OUTPUT_RATE), "-c", str(pcm.OUTPUT_CHANNELS), "-"],
+                               samples.tobytes())
+
+    async def _play_transport(self, transport:Transport):
+        """Feed aplay from a transport, staying only a little ahead of it so
+        jumps are heard quickly
+        """
+        proc = await asyncio.create_subprocess_exec(self._playback_util, "-q", "-t", "raw", "-f", "S16_LE",
+                                                    "-r", str(pcm.OUTPUT_RATE), "-c", str(pcm.OUTPUT_CHANNELS), "-",
+                                                    stdin=asyncio.subprocess.PIPE)
+        try:
+            started = self._loop.time()
+            written = 0
+            with suppress(BrokenPipeError, ConnectionResetError):
+                while( True ):
+                    ahead = written / pcm.OUTPUT_RATE - (self._loop.time() - started)
+                    if( ahead > PLAYER_LEAD_SEC ):
+                        await asyncio.sleep(ahead - PLAYER_LEAD_SEC)
+                        continue
+                    period = transport.read(_TRANSPORT_PERIOD_FRAMES)
+                    if( len(period) == 0 ):
+                        break
+                    proc.stdin.write(period.tobytes())
+                    written += len(period)
+                    await proc.stdin.drain()
+                proc.stdin.close()
+            await proc.wait()
+        finally:
+            if( proc.returncode is None ):
+                proc.kill()
+                await proc.wait()
+
+    async def _play_file(self, file):
+        # aplay only understands WAV, anything else we decode ourselves
+        if( str(file).lower().endswith(".wav") ):
+            await self._run_player([self._playback_util, "-q", str(file)])
+        else:
+            await self._play_samples(await self._loop.run_in_executor(None, pcm.load_audio, file))
+
+    async def _play_text(self, text:str):
+        path = self.tts_cache.cached(text)
+        if( path is not None ):
+            await self._play_file(path)
+        else:
+            await self._stream_text(text)
+
+    async def _stream_text(self, text:str):
+        """Pipe espeak-ng into aplay so speaking starts while it's still
+        synthesizing, saving the speech to the cache on the way through
+        """
+        speech = await asyncio.create_subprocess_exec(*self.tts_cache.stream_args(text), stdout=asyncio.subprocess.PIPE)
+        entry = None
+        proc = None
+        complete = False
+        try:
+            entry = CacheEntryWriter(self.tts_cache, text)
+            proc = await asyncio.create_subprocess_exec(self._playback_util, "-q", "-", stdin=asyncio.subprocess.PIPE)
+            with suppress(BrokenPipeError, ConnectionResetError):
+                while( True ):
+                    data = await speech.stdout.read(_SPEECH_READ_BYTES)
+                    if( len(data) == 0 ):
+                        break
+                    entry.write(data)
+                    proc.stdin.write(data)
+                    await proc.stdin.drain()
+                proc.stdin.close()
+            complete = await speech.wait() == 0
+            await proc.wait()
+        finally:
+            for running in (speech, proc):
+                if( running is not None and running.returncode is None ):
+                    running.kill()
+                    await running.wait()
+            if( entry is not None and complete ):
+                entry.commit()
+            elif( entry is not None ):
+                entry.discard()
+
+    async def _play_clips(self, clips:list, serial:int):
+        for kind, item in clips:
+            try:
+                if( kind == "TEXT" ):
+                    await self._play_text(item)
+                elif( kind == "FILE" ):
+                    await self._play_file(item)
+                elif( kind == "SAMPLES" ):
+                    await self._play_samples(item)
+                elif( kind == "TRANSPORT" ):
+                    await self._play_transport(item)
+            except Exception as e:
+                # Whatever went wrong, the state machine still needs its AUDIO
+                logging.error("Unable to play %s: %s", kind, e)
+        self._events.put_nowait(("AUDIO", serial))
+
+    async def play(self, *clips):
+        """Stop whatever is playing and play these clips one after another.
+        An ("AUDIO", serial) event is sent once they've all played, unless
+        they're stopped first.
+
+        Args:
+            clips: ("TEXT", text), ("FILE", path), ("SAMPLES", samples) or
+                ("TRANSPORT", transport) tuples
+        """
+        await self.stop_audio()
+        self._audio_serial += 1
+        self._audio_task = asyncio.create_task(self._play_clips(clips, self._audio_serial))
+
+    async def stop_audio(self):
+        """Stop playing, once this returns the player process is gone
+        """
+        if( self._audio_task is not None and not self._audio_task.done() ):
+            self._audio_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._audio_task
+        self._audio_task = None
+
+    def _audio_finished(self, source:str, item) -> bool:
+        # Clips that were stopped never send their AUDIO, but one that
+        # finished just before it was replaced can, so check it's ours
+        return source == "AUDIO" and item == self._audio_serial
+
+    # Recording
+
+    async def _start_recorder(self, filename:Path) -> list:
+        """Start arecord, and an encoder if we're compressing
+
+        Returns:
+            list: the processes, arecord first
+        """
+        encoder = encoder_args(self._config.encoding, filename)
+        if( encoder is None ):
+            return [await asyncio.create_subprocess_exec(*capture_args(self._record_util, str(filename)))]
+
+        # arecord writes straight into the encoder, nothing passes through us
+        read_fd, write_fd = os.pipe()
+        try:
+            capture = await asyncio.create_subprocess_exec(*capture_args(self._record_util, "-"), stdout=write_fd)
+            encode = await asyncio.create_subprocess_exec(*encoder, stdin=read_fd)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        return [capture, encode]
+
+    async def _stop_recorder(self, procs:list):
+        """Stop arecord politely and give the encoder time to finish the file
+        """
+        capture = procs[0]
+        if( capture.returncode is None ):
+            capture.terminate()
+        await capture.wait()
+        for proc in procs[1:]:
+            try:
+                await asyncio.wait_for(proc.wait(), _ENCODER_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                logging.error("Encoder didn't finish in time")
+                proc.kill()
+                await proc.wait()
+
+    # States
+
+    def _hook_changed(self, source:str, item) -> bool:
+        if( source == "HOOK" and HookState(item) != self.hook_state ):
+            self.hook_state = HookState(item)
+            return True
+        return False
+
+    async def idle(self) -> TattleState:
+        source,item = await self._next_event(_STATE_TIMEOUTS[TattleState.TATTLE_IDLE])
+        if( self._hook_changed(source, item) and self.hook_state == HookState.HOOK_OFF ):
+            return TattleState.TATTLE_MENU_ROOT
+        elif( source == "KILL" ):
+            self._running = False
+        return TattleState.TATTLE_IDLE
+
+    async def menu_root(self) -> TattleState:
+        deadline = self._state_deadline()
+        await self.play(("TEXT", tattle_core._ROOT_MENU_TEXT))
+        while( True ):
+            source,item = await self._next_event(self._remaining(deadline))
+            if( self._audio_finished(source, item) ):
+                logging.debug("No selection was made, coming back around.")
+                await self.play(("TEXT", tattle_core._ROOT_MENU_TEXT))
+            elif( self._hook_changed(source, item) ):
+                logging.debug("Hung up while playing menu, return to idle")
+                await self.stop_audio()
+                return TattleState.TATTLE_IDLE
+            elif( source == "DIAL" ):
+                if( item == TattleRootMenu.ROOT_MENU_RECORD.value ):
+                    await self.stop_audio()
+                    return TattleState.TATTLE_RECORD
+                elif( item == TattleRootMenu.ROOT_MENU_PLAYBACK.value ):
+                    await self.stop_audio()
+                    return TattleState.TATTLE_PLAYBACK
+                elif( item == TattleRootMenu.ROOT_MENU_DAY.value ):
+                    await self.stop_audio()
+                    return TattleState.TATTLE_MENU_DAY
+                logging.debug("Someone dialed %s, not valid.", item)
+            elif( source == "TIMEOUT" ):
+                logging.info("Nobody chose anything, giving up until the phone is hung up")
+                await self.stop_audio()
+                return TattleState.TATTLE_IDLE
+            elif( source == "KILL" ):
+                await self.stop_audio()
+                self._running = False
+                return TattleState.TATTLE_IDLE
+
+    async def record(self) -> TattleState:
+        deadline = self._state_deadline()
+        max_bytes = max_record_bytes(self._config)
+        await self.play(("FILE", tattle_core._BEEP_WAV))
+
+        self.retention.headroom(self._config.encoding, self._config.max_record_sec)
+        filename = Path(self._config.recording_dir, TattlePhone.get_filename(ENCODING_EXTENSIONS[self._config.encoding]))
+        logging.debug("Creating recording %s", filename)
+        # Recorded under a temporary name, and only renamed once it's finished
+        part = part_path(filename)
+        procs = await self._start_recorder(part)
+        try:
+            while( True ):
+                timeout = self._remaining(deadline)
+                if( max_bytes is not None ):
+                    timeout = min(timeout, _SIZE_CHECK_SEC)
+                source,item = await self._next_event(timeout)
+                if( self._hook_changed(source, item) ):
+                    break
+                elif( source == "TIMEOUT" and self._loop.time() >= deadline ):
+                    logging.info("Recording %s has gone on too long, stopping it", filename.name)
+                    break
+                elif( source == "TIMEOUT" and max_bytes is not None and part.exists() and part.stat().st_size >= max_bytes ):
+                    logging.info("Recording %s has got too big, stopping it", filename.name)
+                    break
+                elif( source == "KILL" ):
+                    self._running = False
+                    break
+        finally:
+            await self._stop_recorder(procs)
+            try:
+                await self._loop.run_in_executor(None, finalize, part, filename)
+            except (OSError, ValueError) as e:
+                logging.error("Unable to finish recording %s: %s", filename.name, e)
+        await self.stop_audio()
+
+        # Nothing to do if the recording didn't make it
+        if( filename.exists() ):
+            self.recording_index.add(filename)
+            self.retention.kick()
+            # Work out where the talking is without holding up the phone
+            self.post_processor.submit(self.recording_index, filename)
+            if( self.sync_service is not None ):
+                self.sync_service.kick()
+        return TattleState.TATTLE_IDLE
+
+    async def menu_day(self) -> TattleState:
+        deadline = self._state_deadline()
+        await self.play(("TEXT", tattle_core._DAY_MENU_TEXT))
+        digits = []
+        while( len(digits) == 0 or not tattle_core.day_dialed(digits) ):
+            timeout = tattle_core._DAY_DIGIT_TIMEOUT_SEC if digits else self._remaining(deadline)
+            source,item = await self._next_event(timeout)
+            if( self._hook_changed(source, item) ):
+                logging.debug("Hung up while choosing a day, return to idle")
+                await self.stop_audio()
+                return TattleState.TATTLE_IDLE
+            elif( source == "DIAL" ):
+                await self.stop_audio()
+                digits.append(item)
+            elif( self._audio_finished(source, item) and len(digits) == 0 ):
+                await self.play(("TEXT", tattle_core._DAY_MENU_TEXT))
+            elif( source == "TIMEOUT" and len(digits) == 0 ):
+                logging.info("Nobody chose a day, giving up until the phone is hung up")
+                await self.stop_audio()
+                return TattleState.TATTLE_IDLE
+            elif( source == "TIMEOUT" ):
+                break
+            elif( source == "KILL" ):
+                await self.stop_audio()
+                self._running = False
+                return TattleState.TATTLE_IDLE
+
+        day, text = tattle_core.choose_day(self.recording_index, digits)
+        logging.debug("Dialed %s, playing %s", digits, day)
+
+        # Say what we found before starting on the recordings
+        await self.play(("TEXT", text))
+        while( True ):
+            source,item = await self._next_event()
+            if( self._hook_changed(source, item) ):
+                await self.stop_audio()
+                return TattleState.TATTLE_IDLE
+            elif( self._audio_finished(source, item) ):
+                break
+            elif( source == "KILL" ):
+                await self.stop_audio()
+                self._running = False
+                return TattleState.TATTLE_IDLE
+
+        if( day is None ):
+            return TattleState.TATTLE_MENU_ROOT
+        self._playback_day = day
+        return TattleState.TATTLE_PLAYBACK
+
+    async def playback(self) -> TattleState:
+        # Just the day that was chosen, if there was one
+        bounds = () if self._playback_day is None else day_range(self._playback_day)
+        self._playback_day = None
+        recordings = iter(self.recording_index.newest_first(*bounds))
+
+        def prepare_next():
+            for recording in recordings:
+                try:
+                    return prepare_recording(recording, self.tts_cache)
+                except Exception as e:
+                    logging.error("Unable to prepare %s: %s", recording.name, e)
+            return None
+
+        # Always have the next recording being prepared while one plays
+        upcoming = self._loop.run_in_executor(None, prepare_next)
+        try:
+            while( True ):
+                prepared = await upcoming
+                if( prepared is None ):
+                    break
+                upcoming = self._loop.run_in_executor(None, prepare_next)
+
+                logging.debug("Playing %s", prepared.name)
+                transport = Transport(prepared.samples)
+                await self.play(("TRANSPORT", transport))
+                while( True ):
+                    # Jumping around moves the end, so work it out afresh each time
+                    deadline = self._loop.time() + transport.remaining() + _CLIP_TIMEOUT_SLACK_SEC
+                    source,item = await self._next_event(self._remaining(deadline))
+                    if( self._hook_changed(source, item) ):
+                        logging.debug("Phone was hung up, stopping audio")
+                        await self.stop_audio()
+                        return TattleState.TATTLE_IDLE
+                    elif( self._audio_finished(source, item) ):
+                        break
+                    elif( source == "DIAL" and item == TransportControl.SKIP ):
+                        logging.debug("Skipping!")
+                        await self.stop_audio()
+                        break
+                    elif( source == "DIAL" and transport.control(item) ):
+                        logging.debug("%s: now at %.1fs, %.1fx speed", TransportControl(item).name, transport.position, transport.speed)
+                    elif( source == "TIMEOUT" ):
+                        logging.warning("%s should have finished by now, moving on", prepared.name)
+                        await self.stop_audio()
+                        break
+                    elif( source == "KILL" ):
+                        await self.stop_audio()
+                        self._running = False
+                        return TattleState.TATTLE_IDLE
+        finally:
+            upcoming.cancel()
+        return TattleState.TATTLE_MENU_ROOT
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(_EXECUTOR_WORKERS, thread_name_prefix="TattleWorker"))
+        self._events = asyncio.Queue()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError, RuntimeError, ValueError):
+                self._loop.add_signal_handler(signum, self.kill)
+
+        self._loop.run_in_executor(None, self.tts_cache.warm, [tattle_core._READY_TEXT, tattle_core._ROOT_MENU_TEXT])
+
+        # The monitors run on the loop too
+        dispatcher = AsyncEdgeDispatcher(self._loop, gpio_backend.get_gpio())
+        sink = _EventSink(self._events)
+        self.hook_monitor = HookMonitor(self._config.hook_pin, sink, hold_off=self._config.hook_hold_off,
+                                        hold_on=self._config.hook_hold_on, dispatcher=dispatcher)
+        self.hook_monitor.start()
+        self.dial_monitor = DialMonitor(self._config.dial_pin, sink, pulse_timeout=self._config.dial_digit_gap,
+                                        debounce=self._config.dial_debounce, dispatcher=dispatcher)
+        self.dial_monitor.start()
+
+        self.hook_state = self.hook_monitor.hook_state()
+        logging.debug("Initial hookstate = %s", self.hook_state)
+        self.startup.report()
+        self.ready.set()
+        await self.play(("TEXT", tattle_core._READY_TEXT), ("FILE", "../sounds/ready.wav"))
+        if( self.hook_state == HookState.HOOK_OFF ):
+            self.change_state(TattleState.TATTLE_MENU_ROOT)
+
+        states = {
+            TattleState.TATTLE_IDLE: self.idle,
+            TattleState.TATTLE_MENU_ROOT: self.menu_root,
+            TattleState.TATTLE_RECORD: self.record,
+            TattleState.TATTLE_PLAYBACK: self.playback,
+            TattleState.TATTLE_MENU_DAY: self.menu_day,
+        }
+        try:
+            while( self._running ):
+                logging.debug("Currently in %s", self._state.name)
+                new_state = await states[self._state]()
+                if( new_state != self._state ):
+                    self.change_state(new_state)
+        finally:
+            await self.stop_audio()
+            self.retention.kill()
+            self.post_processor.kill()
+            if( self.sync_service is not None ):
+                self.sync_service.kill()
+            self.hook_monitor.kill()
+            self.dial_monitor.kill()
@@ -4,42 +4,42 @@
 #
 # Sits in the middle and keeps everything running
 
-import RPi.GPIO as GPIO
+# Noted before anything else is imported, so the startup report includes imports
+import time
+_IMPORT_START = time.monotonic()
+
+import gpio_backend
 from hook_monitor import HookMonitor, HookState
 from dial_monitor import DialMonitor
-from voice_recorder import VoiceRecorder
+from voice_recorder import VoiceRecorder, ENCODING_EXTENSIONS, DEFAULT_MAX_RECORD_SEC, tools_missing
+from capture_stream import CaptureStream
+from retention import RetentionManager, RetentionPolicy
 from audio_player import AudioPlayer
+from audio_backend import create_backend
+from tts_cache import TTSCache
+from playback_pipeline import PlaybackPipeline
+from transport import Transport, TransportControl
+from recording_index import RecordingIndex, get_intro_text, day_range
+from recording_writer import recover_parts
+from post_process import PostProcessor
+from sync_service import SyncService
+from log_pipeline import LogPipeline, LEVELS
+import metrics
+import startup
 import argparse
 from queue import Queue, Empty
-from threading import Event
+from threading import Event, Thread
 import logging
-import time
-import subprocess
-import shutil
 import enum
-from os import scandir
-import re
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
 
-_MONTH_MAP = {
-    1:  "January",
-    2:  "February",
-    3:  "March",
-    4:  "April",
-    5:  "May",
-    6:  "June",
-    7:  "July",
-    8:  "August",
-    9:  "September",
-    10: "October",
-    11: "November",
-    12: "December"
-}
-_RECORDING_DIR = "/var/lib/tattles"
-_RECORDING_RE = re.compile( r"(?P<year>\d\d\d\d)-(?P<month>\d\d)-(?P<day>\d\d)_(?P<hour>\d\d)(?P<minute>\d\d)(?P<second>\d\d)\.wav")
-
-_PLAYBACK_TEXT = "Tattled on {month} {day} at {hour} {minute} {am_pm}"
+_READY_TEXT = "I'm all ears"
+_ROOT_MENU_TEXT = ("To tattle on someone, please dial {record}. To listen to the tattling of others, please dial {playback}. "
+                   "To listen to one day's tattling, please dial {day}")
+_DAY_MENU_TEXT = "Dial the day of the month, or dial 0 for today"
+_DAY_TEXT = "{count} {when}"
+_NO_DAY_TEXT = "Nobody tattled {when}"
 
 # Audio files
 _BEEP_WAV = "../sounds/beep.wav"
@@ -49,82 +49,231 @@ class TattleState(enum.Enum):
     TATTLE_MENU_ROOT=2
     TATTLE_RECORD=3
     TATTLE_PLAYBACK=4
+    TATTLE_MENU_DAY=5
 
 class TattleRootMenu(enum.Enum):
     ROOT_MENU_RECORD=1
     ROOT_MENU_PLAYBACK=2
+    ROOT_MENU_DAY=3
+
+_ROOT_MENU_TEXT = _ROOT_MENU_TEXT.format(
+    record=TattleRootMenu.ROOT_MENU_RECORD.value,
+    playback=TattleRootMenu.ROOT_MENU_PLAYBACK.value,
+    day=TattleRootMenu.ROOT_MENU_DAY.value)
+
+# How long to wait for the second digit of a day of the month
+_DAY_DIGIT_TIMEOUT_SEC = 3
 
 
 _HOOK_TIMEOUT_SEC = 0.1
 _JOIN_TIMEOUT_SEC = 10
+_READY_TIMEOUT_SEC = 10
+_IMPORT_SEC = time.monotonic() - _IMPORT_START
+
+
+def _ordinal(number:int) -> str:
+    """e.g. 1st, 2nd, 11th, 23rd
+    """
+    suffix = "th" if 10 <= number % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(number % 10, "th")
+    return f"{number}{suffix}"
+
+def day_dialed(digits:list) -> bool:
+    """Whether the digits dialed so far make a whole day of the month. 0 is
+    today, and nothing starting with 4 or more can have a second digit.
+
+    Args:
+        digits (list): digits dialed so far
+
+    Returns:
+        bool: True if there's no point waiting for another digit
+    """
+    return len(digits) >= 2 or digits[0] == 0 or digits[0] > 3
+
+def choose_day(recording_index:RecordingIndex, digits:list) -> tuple:
+    """Work out which day was dialed and what to say about it
+
+    Args:
+        recording_index (RecordingIndex): the recordings
+        digits (list): the digits dialed
 
-_SPEECH_UTIL = shutil.which('espeak-ng')
+    Returns:
+        tuple: (day, text to speak), day is None if there's nothing to play
+    """
+    if( digits == [0] ):
+        day = date.today()
+        when = "today"
+    else:
+        day_of_month = int("".join(str(digit) for digit in digits))
+        if( not 1 <= day_of_month <= 31 ):
+            return None, f"There's no day {day_of_month}"
+        day = recording_index.latest_day(day_of_month)
+        if( day is None ):
+            return None, _NO_DAY_TEXT.format(when=f"on the {_ordinal(day_of_month)}")
+        when = f"on {day:%B} {day.day}"
+
+    count = recording_index.count(day)
+    if( count == 0 ):
+        return None, _NO_DAY_TEXT.format(when=when)
+    return day, _DAY_TEXT.format(count="1 tattle" if count == 1 else f"{count} tattles", when=when)
+
+_EVENT_QUEUE_DEPTH = metrics.histogram("tattle_event_queue_depth", "Events waiting for the state machine",
+                                       buckets=(0, 1, 2, 4, 8, 16, 32))
 
 class TattlePhone():
 
     def change_state(self, new_state:TattleState) -> TattleState:
-        logging.debug(f"Changing from {self._state.name} to {new_state.name}")
+        logging.debug("Changing from %s to %s", self._state.name, new_state.name)
         self._state = new_state
 
+        # Keep the microphone warm whenever the handset is off the hook
+        if( new_state == TattleState.TATTLE_IDLE ):
+            self._stop_capture()
+        elif( self._config.warm_capture and self._capture_stream is None ):
+            self._capture_stream = CaptureStream(device=self._config.audio_device)
+            self._capture_stream.start()
+
+        # Don't upload anything while someone's using the phone
+        self._hold_sync(new_state != TattleState.TATTLE_IDLE)
+
+    def _hold_sync(self, hold:bool):
+        if( self.sync_service is None or hold == self._holding_sync ):
+            return
+        if( hold ):
+            self.sync_service.hold()
+        else:
+            self.sync_service.release()
+        self._holding_sync = hold
+
+    def _stop_capture(self):
+        if( self._capture_stream is not None ):
+            self._capture_stream.kill()
+            self._capture_stream = None
+
     @staticmethod
     def get_intro_text(file_name:str) -> str:
-        match = _RECORDING_RE.match(file_name)
-        if( match is None ):
-            return None
-        
-        # Figure out AM / PM
-        hour = match.group('hour')
-        am_pm = "A.M."
-        if( int(hour) > 12 ):
-            hour = str(int(hour) - 12)
-            am_pm = "P.M."
-        
-        # Figure out minute
-        minute = int(match.group('minute'))
-        minute_str = match.group('minute')
-        if(minute == 0):
-            minute_str = "o'clock"
-        elif(minute < 10 ):
-            minute_str = f"O {minute}"
-        
-        # Construct intro
-        intro_text = _PLAYBACK_TEXT.format(
-            month=_MONTH_MAP[int(match.group('month'))],
-            day=int(match.group('day')),
-            hour=hour,
-            minute=minute_str,
-            am_pm=am_pm
-        )
-        return intro_text
+        return get_intro_text(file_name)
     
     @staticmethod
-    def get_filename() -> str:
+    def get_filename(extension:str=".wav") -> str:
         """Get a filename with the current time embedded
 
+        Args:
+            extension (str, optional): File extension to use. Defaults to ".wav".
+
         Returns:
             str: Filanme of the format YYYY-MM-DD_HHMMSS.wav
         """
         dt = datetime.now()
-        return dt.strftime("%Y-%m-%d_%H%M%S") + ".wav"
+        return dt.strftime("%Y-%m-%d_%H%M%S") + extension
+
+    def __init__(self, config:argparse.Namespace, audio_backend=None, tts_cache:TTSCache=None, post_processor:PostProcessor=None,
+                 sync_service:SyncService=None):
+        """Constructor
 
-    def __init__(self):
+        Args:
+            config (argparse.Namespace): settings, see build_parser()
+            audio_backend (optional): what to play audio through. Defaults to
+                the one named in the config.
+            tts_cache (TTSCache, optional): rendered speech, shared with other
+                lines. Defaults to a cache of our own.
+            post_processor (PostProcessor, optional): analyses finished
+                recordings, shared with other lines. Defaults to one of our own.
+            sync_service (SyncService, optional): uploads recordings, shared
+                with other lines. Defaults to one of our own if --sync_url is given.
+        """
+        self._config = config
         self._my_input_queue = Queue()
         self._state = TattleState.TATTLE_IDLE
+        self._running = True
+        self._capture_stream = None
+
+        # The day chosen from the day menu, if we're only playing one day
+        self._playback_day = None
+
+        self.startup = startup.StartupTimer(_IMPORT_START)
+        self.startup.add("imports", _IMPORT_SEC)
+
+        # Open the index of recordings, after tidying up anything a crash left behind
+        with self.startup.phase("index"):
+            self.recording_index = open_recording_index(self._config)
+
+        # Keep the recordings from filling the card
+        self.retention = build_retention_manager(self._config, self.recording_index)
+        self.retention.start()
+
+        # Analyse finished recordings in the background, catching up on any
+        # that were missed last time
+        self._owns_post_processor = post_processor is None
+        self.post_processor = post_processor or PostProcessor(self._config.postprocess_workers)
+        if( self._owns_post_processor ):
+            self.post_processor.start()
+        self.post_processor.backfill(self.recording_index)
+
+        # Copy recordings to the server in the background, if there is one
+        self._owns_sync_service = sync_service is None
+        self.sync_service = sync_service or build_sync_service(self._config)
+        self._holding_sync = False
+        if( self.sync_service is not None ):
+            if( self._owns_sync_service ):
+                self.sync_service.start()
+            self.sync_service.watch(self.recording_index, self._config.line_name)
+
+        # Instantiate the speech cache and get our fixed prompts ready in the
+        # background, the player waits for anything it needs
+        with self.startup.phase("tts cache"):
+            self.tts_cache = tts_cache or TTSCache(self._config.tts_cache_dir, max_bytes=self._config.tts_cache_mb * 1024 * 1024)
+        Thread(target=self.tts_cache.warm, args=([_READY_TEXT, _ROOT_MENU_TEXT],), name="TTSWarmer", daemon=True).start()
         
-        # Instantiate the audio player
-        self.audio_player = AudioPlayer(self._my_input_queue)
+        # Instantiate the audio player, it opens the sound card on its own thread
+        backend_factory = lambda: create_backend(self._config.audio_backend, self._config.audio_device)
+        self.audio_player = AudioPlayer(self._my_input_queue, self.tts_cache, audio_backend, backend_factory)
         self.audio_player.start()
 
-        # Instantiate the hook monitor
-        self.hook_monitor = HookMonitor(args.hook_pin, self._my_input_queue)
-        self.hook_monitor.start()
-        
-        # Instantiate the dial monitor
-        self.dial_monitor = DialMonitor(args.dial_pin, self._my_input_queue)
-        self.dial_monitor.start()
+        # Instantiate the hook and dial monitors
+        with self.startup.phase("monitors"):
+            self.hook_monitor = HookMonitor(self._config.hook_pin, self._my_input_queue,
+                                            hold_off=self._config.hook_hold_off, hold_on=self._config.hook_hold_on)
+            self.hook_monitor.start()
+            self.dial_monitor = DialMonitor(self._config.dial_pin, self._my_input_queue,
+                                            pulse_timeout=self._config.dial_digit_gap, debounce=self._config.dial_debounce)
+            self.dial_monitor.start()
+
+        # Wait for everyone to say they're ready
+        self._wait_ready("gpio", gpio_backend.get_dispatcher().ready)
+        self._wait_ready("audio", self.audio_player.ready)
+        self.startup.report()
+
+    def _wait_ready(self, name:str, ready:Event):
+        """Wait for a worker to be ready, noting how long we waited
 
-        # Give our threads a moment to start
-        time.sleep(1)
+        Args:
+            name (str): what to call it in the startup report
+            ready (Event): set by the worker once it's ready
+        """
+        with self.startup.phase(f"{name} ready"):
+            if( not ready.wait(_READY_TIMEOUT_SEC) ):
+                logging.error("%s wasn't ready after %d seconds, carrying on anyway", name, _READY_TIMEOUT_SEC)
+
+    def _next_event(self, timeout:float=None) -> tuple:
+        """Wait for the next thing to happen
+
+        Args:
+            timeout (float, optional): seconds to wait, None for forever
+
+        Returns:
+            tuple: (source, item), ("TIMEOUT", None) if nothing happened in time
+        """
+        _EVENT_QUEUE_DEPTH.observe(self._my_input_queue.qsize())
+        try:
+            return self._my_input_queue.get(timeout=timeout)
+        except Empty:
+            return ("TIMEOUT", None)
+
+    def kill(self):
+        """Ask the phone to shut down. This is noticed when the phone is idle
+        or at the menu.
+        """
+        self._my_input_queue.put(("KILL", None))
 
     def run(self):
         # Make a reference to the recorder
@@ -133,35 +282,34 @@ class TattlePhone():
         # Start the state machine
         self._state = TattleState.TATTLE_IDLE
         self.hook_state = self.hook_monitor.hook_state()
-        logging.debug("Initial hookstate = {}".format(self.hook_state))
+        logging.debug("Initial hookstate = %s", self.hook_state)
         if( self.hook_state == HookState.HOOK_OFF):
             self.change_state(TattleState.TATTLE_MENU_ROOT)
         
         # Let the user know we're ready.
-        self.audio_player.play_text("I'm all ears")
+        self.audio_player.play_text(_READY_TEXT)
         self.audio_player.play_file("../sounds/ready.wav")
 
-        while( 1 ):
-            logging.debug(f"Currently in {self._state.name}")
+        while( self._running ):
+            logging.debug("Currently in %s", self._state.name)
 
             if( self._state == TattleState.TATTLE_IDLE ):
                 # Wait for a hook change
-                source,item = self._my_input_queue.get()
+                source,item = self._next_event()
                 if( source == "HOOK" and HookState(item) != self.hook_state ):
                     self.hook_state = item
                     self.change_state(TattleState.TATTLE_MENU_ROOT)
+                elif( source == "KILL" ):
+                    self._running = False
                 else:
-                    logging.debug(f"Received Unhandled Event: {source}:{item}")
+                    logging.debug("Received Unhandled Event: %s:%s", source, item)
                     
             elif( self._state == TattleState.TATTLE_MENU_ROOT ):
                 # Playback menu selection
-                self.audio_player.play_text(
-                        "To tattle on someone, please dial {record}. To listen to the tattling of others, please dial {playback}" \
-                        .format(record=TattleRootMenu.ROOT_MENU_RECORD.value, 
-                                playback=TattleRootMenu.ROOT_MENU_PLAYBACK.value) )
+                self.audio_player.play_text(_ROOT_MENU_TEXT)
                 
                 # Wait for audio to finish
-                source,item = self._my_input_queue.get()
+                source,item = self._next_event()
                 if( source == "AUDIO" ):
                     logging.debug("No selection was made, coming back around.")
                 
@@ -186,11 +334,19 @@ class TattlePhone():
                     # Selected playback
                     elif( item == TattleRootMenu.ROOT_MENU_PLAYBACK.value ):
                         self.change_state(TattleState.TATTLE_PLAYBACK)
+
+                    # Selected one day's playback
+                    elif( item == TattleRootMenu.ROOT_MENU_DAY.value ):
+                        self.change_state(TattleState.TATTLE_MENU_DAY)
                     
                     else:
-                        logging.debug(f"Someone dialed {item}, not valid.")
+                        logging.debug("Someone dialed %s, not valid.", item)
+
+                elif( source == "KILL" ):
+                    self.audio_player.stop()
+                    self._running = False
                 else:
-                    logging.debug(f"Received Unhandled Event: {source}:{item}")
+                    logging.debug("Received Unhandled Event: %s:%s", source, item)
                 
             elif( self._state == TattleState.TATTLE_RECORD ):
                 # Create a voice recording
@@ -198,30 +354,53 @@ class TattlePhone():
                     # Play the beep
                     self.audio_player.play_file(_BEEP_WAV)
 
-                    filename = Path(_RECORDING_DIR,self.get_filename())
-                    logging.debug(f"Creating recording {filename}")
-                    self.voice_recorder = VoiceRecorder(filename)
+                    self.retention.headroom(self._config.encoding, self._config.max_record_sec)
+                    filename = Path(self._config.recording_dir,self.get_filename(ENCODING_EXTENSIONS[self._config.encoding]))
+                    logging.debug("Creating recording %s", filename)
+                    self.voice_recorder = VoiceRecorder(filename, self._capture_stream, self._config.preroll_sec,
+                                                        self._config.max_record_sec, max_record_bytes(self._config),
+                                                        self._config.audio_device)
                     self.voice_recorder.start()
 
                 # Wait for a hook change
                 while(self.hook_state != HookState.HOOK_ON ):
-                    source,item = self._my_input_queue.get()
+                    source,item = self._next_event()
                     if( source == "HOOK" and HookState(item) != self.hook_state ):
                         self.hook_state = item
                         self.change_state(TattleState.TATTLE_IDLE)
                     else:
-                        logging.debug(f"Received Unhandled Event: {source}:{item}")
+                        logging.debug("Received Unhandled Event: %s:%s", source, item)
                 
                 # Kill our recording
                 self.voice_recorder.kill()
                 self.voice_recorder.join()
                 self.voice_recorder = None
 
+                # Nothing to do if the recording didn't make it
+                if( filename.exists() ):
+                    self.recording_index.add(filename)
+                    self.retention.kick()
+                    # Work out where the talking is without holding up the phone
+                    self.post_processor.submit(self.recording_index, filename)
+                    if( self.sync_service is not None ):
+                        self.sync_service.kick()
+
+            elif( self._state == TattleState.TATTLE_MENU_DAY ):
+                destination_state = self.menu_day()
+                self.change_state(destination_state)
+
             elif( self._state == TattleState.TATTLE_PLAYBACK ):
                 destination_state = self.playback()
                 self.change_state(destination_state)
 
         # Cleanup all of our threads
+        self._stop_capture()
+        self.retention.kill()
+        if( self._owns_post_processor ):
+            self.post_processor.kill()
+        self._hold_sync(False)
+        if( self._owns_sync_service and self.sync_service is not None ):
+            self.sync_service.kill()
         self.hook_monitor.kill()
         self.hook_monitor.join(_JOIN_TIMEOUT_SEC)
         
@@ -230,53 +409,320 @@ class TattlePhone():
         
         self.audio_player.kill()
         self.audio_player.join()
-        GPIO.cleanup()
-    
+
+    def menu_day(self) -> TattleState:
+        """Ask which day to play, then play just that day
+
+        Returns:
+            TattleState: where to go next
+        """
+        self.audio_player.play_text(_DAY_MENU_TEXT)
+        digits = []
+        while( len(digits) == 0 or not day_dialed(digits) ):
+            source,item = self._next_event(_DAY_DIGIT_TIMEOUT_SEC if digits else None)
+            if( source == "HOOK" and HookState(item) != self.hook_state ):
+                logging.debug("Hung up while choosing a day, return to idle")
+                self.audio_player.stop()
+                self.hook_state = item
+                return TattleState.TATTLE_IDLE
+            elif( source == "DIAL" ):
+                self.audio_player.stop()
+                digits.append(item)
+            elif( source == "AUDIO" and len(digits) == 0 ):
+                self.audio_player.play_text(_DAY_MENU_TEXT)
+            elif( source == "TIMEOUT" ):
+                break
+            elif( source == "KILL" ):
+                self.audio_player.stop()
+                self._running = False
+                return TattleState.TATTLE_IDLE
+            else:
+                logging.debug("Received Unhandled Event: %s:%s", source, item)
+
+        day, text = choose_day(self.recording_index, digits)
+        logging.debug("Dialed %s, playing %s", digits, day)
+
+        # Say what we found before starting on the recordings, so the end of
+        # this isn't taken for the end of the first one
+        self.audio_player.play_text(text)
+        while( True ):
+            source,item = self._next_event()
+            if( source == "HOOK" and HookState(item) != self.hook_state ):
+                self.audio_player.stop()
+                self.hook_state = item
+                return TattleState.TATTLE_IDLE
+            elif( source == "AUDIO" ):
+                break
+            elif( source == "KILL" ):
+                self.audio_player.stop()
+                self._running = False
+                return TattleState.TATTLE_IDLE
+            else:
+                logging.debug("Received Unhandled Event: %s:%s", source, item)
+
+        if( day is None ):
+            return TattleState.TATTLE_MENU_ROOT
+        self._playback_day = day
+        return TattleState.TATTLE_PLAYBACK
+
     def playback(self) -> TattleState:
-        files = list(scandir(_RECORDING_DIR))
-        files = sorted( files, key=lambda x: x.name, reverse=True)
-        for file in files:
-            intro_text = self.get_intro_text(file.name)
-            if( intro_text is None ):
-                continue
-            
-            logging.debug("Queuing up text and file to play")
-            self.audio_player.play_text(intro_text)
-            self.audio_player.play_file(file)
-            still_playing = True
-            while( still_playing ):
-                source,item = self._my_input_queue.get()
-                if( source == "HOOK" and HookState(item) != self.hook_state ):
-                    logging.debug("Phone was hung up, stopping audio")
-                    self.audio_player.stop()
-                    self.hook_state = item
-                    return TattleState.TATTLE_IDLE
-                elif( source == "AUDIO" ):
-                    logging.debug("Looks like the audio player is free, let's move on!")
-                    still_playing = False
-                elif( source == "DIAL" and item == 1 ):
-                    logging.debug("Skipping!")
-                    self.audio_player.stop()
-                    still_playing = False
-                else:
-                    logging.debug(f"Received Unhandled Event: {source}:{item}")
+        # Just the day that was chosen, if there was one
+        bounds = () if self._playback_day is None else day_range(self._playback_day)
+        self._playback_day = None
+
+        # Get the recordings ready in the background while we're playing
+        pipeline = PlaybackPipeline(self.recording_index.newest_first(*bounds), self.tts_cache, self._config.prefetch_depth)
+        pipeline.start()
+        try:
+            while( True ):
+                prepared = pipeline.next()
+                if( prepared is None ):
+                    break
+
+                logging.debug("Queuing up %s to play", prepared.name)
+                transport = Transport(prepared.samples)
+                self.audio_player.play_transport(transport)
+                still_playing = True
+                while( still_playing ):
+                    source,item = self._next_event()
+                    if( source == "HOOK" and HookState(item) != self.hook_state ):
+                        logging.debug("Phone was hung up, stopping audio")
+                        self.audio_player.stop()
+                        self.hook_state = item
+                        return TattleState.TATTLE_IDLE
+                    elif( source == "AUDIO" ):
+                        logging.debug("Looks like the audio player is free, let's move on!")
+                        still_playing = False
+                    elif( source == "DIAL" and item == TransportControl.SKIP ):
+                        logging.debug("Skipping!")
+                        self.audio_player.stop()
+                        still_playing = False
+                    elif( source == "DIAL" and transport.control(item) ):
+                        logging.debug("%s: now at %.1fs, %.1fx speed", TransportControl(item).name, transport.position, transport.speed)
+                    else:
+                        logging.debug("Received Unhandled Event: %s:%s", source, item)
+        finally:
+            pipeline.cancel()
         
         return TattleState.TATTLE_MENU_ROOT
 
-if __name__ == "__main__":
+def open_recording_index(config:argparse.Namespace) -> RecordingIndex:
+    """Open the index of recordings, building it if we've never had one, and
+    recover any recordings that were cut off last time we ran
+
+    Args:
+        config (argparse.Namespace): settings, see build_parser()
+
+    Returns:
+        RecordingIndex: the index
+    """
+    recovered = recover_parts(config.recording_dir)
+    index_path = config.index_path or Path(config.recording_dir, "index.sqlite3")
+    recording_index = RecordingIndex(config.recording_dir, index_path)
+    if( config.rebuild_index or recording_index.is_new ):
+        recording_index.rebuild()
+    for path in recovered:
+        recording_index.add(path)
+    return recording_index
+
+def max_record_bytes(config:argparse.Namespace) -> int:
+    if( config.max_record_mb is None ):
+        return None
+    return int(config.max_record_mb * 1024 * 1024)
+
+def build_retention_manager(config:argparse.Namespace, recording_index:RecordingIndex) -> RetentionManager:
+    """Set up the retention manager from the command line options
+
+    Args:
+        config (argparse.Namespace): settings, see build_parser()
+        recording_index (RecordingIndex): the recordings to look after
+
+    Returns:
+        RetentionManager: ready to start
+    """
+    policy = RetentionPolicy(
+        max_bytes=None if config.retain_mb is None else int(config.retain_mb * 1024 * 1024),
+        max_age=None if config.retain_days is None else config.retain_days * 24 * 3600,
+        max_count=config.retain_count)
+    return RetentionManager(recording_index, config.recording_dir, policy)
+
+def build_sync_service(config:argparse.Namespace) -> SyncService:
+    """Set up uploading from the command line options
+
+    Args:
+        config (argparse.Namespace): settings, see build_parser()
+
+    Returns:
+        SyncService: ready to start, None if --sync_url wasn't given
+    """
+    if( config.sync_url is None ):
+        return None
+    rate = None if config.sync_kb_per_sec <= 0 else config.sync_kb_per_sec * 1024
+    return SyncService(config.sync_url, rate)
+
+def line_configs(config:argparse.Namespace) -> list:
+    """Work out the settings for each line. Every line gets its own pins,
+    sound card and recordings, everything else is shared.
+
+    Args:
+        config (argparse.Namespace): settings, see build_parser()
+
+    Raises:
+        ValueError: if a --line doesn't make sense
+
+    Returns:
+        list: (name, config) for each line, just ("phone", config) if no
+            --line was given
+    """
+    if( not config.line ):
+        return [("phone", config)]
+
+    lines = []
+    for name, hook_pin, dial_pin, audio_device in config.line:
+        if( any(name == existing for existing, _ in lines) ):
+            raise ValueError(f"Line {name} is given more than once")
+        line_config = argparse.Namespace(**vars(config))
+        line_config.hook_pin = int(hook_pin)
+        line_config.dial_pin = int(dial_pin)
+        line_config.audio_device = audio_device
+        line_config.recording_dir = str(Path(config.recording_dir, name))
+        line_config.index_path = None
+        line_config.line_name = name
+        lines.append((name, line_config))
+
+    pins = [pin for _, line_config in lines for pin in (line_config.hook_pin, line_config.dial_pin)]
+    if( len(set(pins)) != len(pins) ):
+        raise ValueError("Each line needs its own hook and dial pins")
+    return lines
+
+def build_parser() -> argparse.ArgumentParser:
+    """Command line options for the phone, also used to build the config
+    handed to TattlePhone.
+
+    Returns:
+        argparse.ArgumentParser: the parser
+    """
     parser = argparse.ArgumentParser()
+    parser.add_argument("--runtime", help="Run the phone as worker threads, or as a single asyncio event loop",
+                        choices=["threads", "asyncio"], default="threads")
     parser.add_argument("--hook_pin", help="GPIO pin where the hook circuit is connected", type=int, default=12)
     parser.add_argument("--dial_pin", help="GPIO pin where the dial circuit is connected", type=int, default=16)
+    parser.add_argument("--line", help="Drive another handset, give once per handset. Each line keeps its recordings in a directory of its own under --recording_dir",
+                        nargs=4, action="append", metavar=("NAME", "HOOK_PIN", "DIAL_PIN", "AUDIO_DEVICE"))
+    parser.add_argument("--gpio_trace", help="Simulate the GPIO pins by replaying this trace file instead of using the real ones")
+    parser.add_argument("--gpio_speed", help="How many times faster than real time to replay --gpio_trace", type=float, default=1.0)
+    parser.add_argument("--gpio_capture", help="Record every edge on the hook and dial pins to this trace file", default=None)
+    parser.add_argument("--hook_hold_off", help="Seconds the handset must stay lifted before it counts as off the hook", type=float, default=0.05)
+    parser.add_argument("--hook_hold_on", help="Seconds the handset must stay down before it counts as back on the hook", type=float, default=0.25)
+    parser.add_argument("--dial_debounce", help="Dial pulses closer together than this many seconds are treated as contact bounce", type=float, default=0.03)
+    parser.add_argument("--dial_digit_gap", help="A gap of this many seconds after a dial pulse ends the digit", type=float, default=0.15)
+    parser.add_argument("--tts_cache_dir", help="Directory to keep rendered speech in", default="/var/cache/tattle/tts")
+    parser.add_argument("--tts_cache_mb", help="Maximum size of the rendered speech cache in megabytes", type=int, default=32)
+    parser.add_argument("--audio_backend", help="How to play audio, alsa keeps one output stream open, subprocess runs aplay per clip",
+                        choices=["alsa", "subprocess"], default="alsa")
+    parser.add_argument("--audio_device", help="ALSA device to play audio through and record from", default="default")
+    parser.add_argument("--encoding", help="How to store recordings, flac and opus are encoded as they're captured",
+                        choices=list(ENCODING_EXTENSIONS), default="flac")
+    parser.add_argument("--no_warm_capture", help="Don't keep arecord running while the handset is off the hook, start it for each recording instead",
+                        dest="warm_capture", action="store_false")
+    parser.add_argument("--preroll_sec", help="How much audio from before the beep to keep at the start of each recording", type=float, default=0.1)
+    parser.add_argument("--recording_dir", help="Where to keep the recordings", default="/var/lib/tattles")
+    parser.add_argument("--max_record_sec", help="Longest a single recording can be, in seconds", type=float, default=DEFAULT_MAX_RECORD_SEC)
+    parser.add_argument("--max_record_mb", help="Largest a single recording can be, in megabytes", type=float, default=None)
+    parser.add_argument("--retain_mb", help="Delete the oldest recordings once they take up more than this many megabytes", type=float, default=None)
+    parser.add_argument("--retain_days", help="Delete recordings older than this many days", type=float, default=None)
+    parser.add_argument("--retain_count", help="Keep at most this many recordings, deleting the oldest", type=int, default=None)
+    parser.add_argument("--index_path", help="Where to keep the index of recordings, defaults to index.sqlite3 in the recording directory")
+    parser.add_argument("--rebuild_index", help="Rebuild the index of recordings from the recording directory at startup", action="store_true")
+    parser.add_argument("--metrics_file", help="Periodically write metrics to this file", default=None)
+    parser.add_argument("--metrics_port", help="Serve metrics on http://127.0.0.1:<port>/", type=int, default=None)
+    parser.add_argument("--postprocess_workers", help="How many finished recordings to analyse at once, in low priority worker processes", type=int, default=1)
+    parser.add_argument("--prefetch_depth", help="How many recordings to decode ahead during playback", type=int, default=2)
+    parser.add_argument("--sync_url", help="Upload recordings to this HTTP server while the phone isn't in use, see sync_receiver.py", default=None)
+    parser.add_argument("--sync_kb_per_sec", help="Most kilobytes per second to upload at, 0 for no limit", type=float, default=128)
+    parser.add_argument("--log_level", help="Least important messages to log", choices=LEVELS, default="INFO")
+    parser.add_argument("--log_file", help="Also log to this file, rotated once it reaches a megabyte", default=None)
+    parser.set_defaults(line_name=None)
+    return parser
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
 
-    # Setup GPIO
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(args.hook_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    GPIO.setup(args.dial_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    # Find out now if we can't record, rather than when someone tries to
+    missing = tools_missing(args.encoding)
+    if( "arecord" in missing ):
+        parser.error("arecord isn't installed, it's needed to record")
+    fallback_from = None
+    if( missing ):
+        fallback_from, args.encoding = args.encoding, "wav"
+
+    try:
+        lines = line_configs(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if( len(lines) > 1 and args.runtime == "asyncio" ):
+        parser.error("--line is only supported by the threads runtime")
+
+    # Setup GPIO, either the real pins or a simulation of them
+    if( args.gpio_trace is not None ):
+        gpio_backend.use(gpio_backend.SimulatedGPIO(args.gpio_speed))
+    elif( args.gpio_capture is not None ):
+        gpio_backend.use(gpio_backend.CapturingGPIO(args.gpio_capture))
+    GPIO = gpio_backend.get_gpio()
+    GPIO.setmode(gpio_backend.BOARD)
+    for _, line_config in lines:
+        GPIO.setup(line_config.hook_pin, gpio_backend.IN, pull_up_down=gpio_backend.PUD_UP)
+        GPIO.setup(line_config.dial_pin, gpio_backend.IN, pull_up_down=gpio_backend.PUD_UP)
+
+    # Setup logging, written out by a background thread so the GPIO
+    # callbacks and the audio never wait on it
+    log_pipeline = LogPipeline(args.log_level, args.log_file)
+    log_pipeline.start()
+    if( fallback_from is not None ):
+        logging.warning("%s isn't installed, recording to wav instead of %s", ", ".join(missing), fallback_from)
 
-    # Setup logging
-    logging.basicConfig(level=logging.DEBUG)
+    # Metrics cost next to nothing unless someone asks for them
+    if( args.metrics_file is not None or args.metrics_port is not None ):
+        metrics.enable()
+        metrics.MetricsExporter(args.metrics_file, args.metrics_port).start()
 
     # Start the phone
-    tattle_phone = TattlePhone()
-    tattle_phone.run()
\ No newline at end of file
+    if( args.runtime == "asyncio" ):
+        import asyncio
+        from tattle_async import AsyncTattlePhone
+        tattle_phone = AsyncTattlePhone(args)
+        if( args.gpio_trace is not None ):
+            GPIO.replay(gpio_backend.read_trace(args.gpio_trace))
+        asyncio.run(tattle_phone.run())
+    elif( len(lines) == 1 ):
+        tattle_phone = TattlePhone(args)
+        if( args.gpio_trace is not None ):
+            GPIO.replay(gpio_backend.read_trace(args.gpio_trace))
+        tattle_phone.run()
+    else:
+        # One state machine per handset, all sharing the GPIO dispatcher and
+        # the rendered speech
+        tts_cache = TTSCache(args.tts_cache_dir, max_bytes=args.tts_cache_mb * 1024 * 1024)
+        post_processor = PostProcessor(args.postprocess_workers)
+        post_processor.start()
+        sync_service = build_sync_service(args)
+        if( sync_service is not None ):
+            sync_service.start()
+        phone_threads = []
+        for name, line_config in lines:
+            Path(line_config.recording_dir).mkdir(parents=True, exist_ok=True)
+            tattle_phone = TattlePhone(line_config, tts_cache=tts_cache, post_processor=post_processor, sync_service=sync_service)
+            phone_threads.append(Thread(target=tattle_phone.run, name=f"TattlePhone-{name}"))
+        for phone_thread in phone_threads:
+            phone_thread.start()
+        if( args.gpio_trace is not None ):
+            GPIO.replay(gpio_backend.read_trace(args.gpio_trace))
+        for phone_thread in phone_threads:
+            phone_thread.join()
+        post_processor.kill()
+        if( sync_service is not None ):
+            sync_service.kill()
+    gpio_backend.stop_dispatcher()
+    GPIO.cleanup()
+    log_pipeline.stop()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# transport.py
+#
+# Dial controls for a recording that's playing: jump back or forward, start
+# again, or speed up without everyone sounding like chipmunks. The player
+# pulls audio from a Transport a period at a time, so a jump is heard as
+# soon as the audio already handed to the sound card has played out.
+
+import enum
+from threading import Lock
+import startup
+np = startup.lazy_import("numpy")
+import pcm
+
+_JUMP_SEC = 5.0
+_FAST_SPEED = 1.5
+
+# Speeding up is done with WSOLA: 46ms frames of the recording are
+# overlap-added half a frame apart, taking them further apart than that in
+# the recording. Each frame is nudged by up to _TOLERANCE samples so that it
+# lines up with the last one, which keeps the pitch and avoids warbling.
+_FRAME = 1024
+_HOP = _FRAME // 2
+_TOLERANCE = 128
+
+# How far ahead of the sound card a player that can't throw away what it's
+# already been given (e.g. a pipe to aplay) should stay
+PLAYER_LEAD_SEC = 0.25
+
+class TransportControl(enum.IntEnum):
+    """What each digit does while a recording is playing
+    """
+    SKIP = 1
+    REPLAY = 3
+    BACK = 4
+    FORWARD = 6
+    FAST = 9
+
+class Transport():
+    """Prepared samples being played, with a position and speed that can be
+    changed from another thread while they play
+    """
+    def __init__(self, samples:"np.ndarray", rate:int=pcm.OUTPUT_RATE):
+        """
+        Args:
+            samples (np.ndarray): int16 samples in the output format
+            rate (int, optional): their sample rate
+        """
+        self._samples = samples
+        self._rate = rate
+        self._lock = Lock()
+        self._position = 0
+        self._speed = 1.0
+        self._jumped = False
+        # Periodic Hann windows half a frame apart add up to exactly one
+        self._window = np.hanning(_FRAME + 1)[:-1].astype(np.float32)
+        self._reset_stretch()
+
+    def _reset_stretch(self):
+        self._pending = np.zeros(0, dtype=np.int16)
+        self._tail = None
+        self._previous = None
+
+    @property
+    def duration(self) -> float:
+        return len(self._samples) / self._rate
+
+    @property
+    def position(self) -> float:
+        return self._position / self._rate
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    def remaining(self) -> float:
+        """Roughly how long until the end, at the current speed
+
+        Returns:
+            float: seconds
+        """
+        with self._lock:
+            return (len(self._samples) - self._position) / self._rate / self._speed + len(self._pending) / self._rate
+
+    def jump_to(self, seconds:float):
+        """Carry on playing from somewhere else
+
+        Args:
+            seconds (float): where from, clamped to the recording
+        """
+        with self._lock:
+            self._jump_to(int(seconds * self._rate))
+
+    def jump(self, seconds:float):
+        """Jump back (negative) or forward from where we are
+        """
+        with self._lock:
+            self._jump_to(self._position + int(seconds * self._rate))
+
+    def _jump_to(self, position:int):
+        """Must be called with the lock held
+        """
+        self._position = min(max(0, position), len(self._samples))
+        self._reset_stretch()
+        self._jumped = True
+
+    def set_speed(self, speed:float):
+        with self._lock:
+            self._speed = speed
+            self._reset_stretch()
+
+    def toggle_speed(self):
+        """Switch between normal and fast
+        """
+        with self._lock:
+            self._speed = 1.0 if self._speed != 1.0 else _FAST_SPEED
+            self._reset_stretch()
+
+    def control(self, digit:int) -> bool:
+        """Act on a dialed digit
+
+        Args:
+            digit (int): what was dialed
+
+        Returns:
+            bool: True if the digit is a transport control, other than SKIP
+                which is up to whoever is playing us
+        """
+        if( digit == TransportControl.REPLAY ):
+            self.jump_to(0)
+        elif( digit == TransportControl.BACK ):
+            self.jump(-_JUMP_SEC)
+        elif( digit == TransportControl.FORWARD ):
+            self.jump(_JUMP_SEC)
+        elif( digit == TransportControl.FAST ):
+            self.toggle_speed()
+        else:
+            return False
+        return True
+
+    def take_jump(self) -> bool:
+        """Whether we've jumped since this was last asked, so the player can
+        throw away what it had queued up from before the jump
+
+        Returns:
+            bool: True if there was a jump
+        """
+        with self._lock:
+            jumped = self._jumped
+            self._jumped = False
+            return jumped
+
+    def read(self, frames:int) -> "np.ndarray":
+        """The next few samples to play
+
+        Args:
+            frames (int): how many samples are wanted
+
+        Returns:
+            np.ndarray: up to that many int16 samples, empty at the end
+        """
+        with self._lock:
+            if( self._speed == 1.0 ):
+                samples = self._samples[self._position:self._position + frames]
+                self._position += len(samples)
+                return samples
+
+            while( len(self._pending) < frames and (self._position < len(self._samples) or self._tail is not None) ):
+                self._stretch_frame()
+            samples, self._pending = self._pending[:frames], self._pending[frames:]
+            return samples
+
+    def _stretch_frame(self):
+        """Add half a frame of sped up audio to what's pending. Must be called
+        with the lock held.
+        """
+        samples = self._samples
+        if( self._position >= len(samples) ):
+            # Let the last frame fade out
+            self._pending = np.concatenate((self._pending, self._tail.astype(np.int16)))
+            self._tail = None
+            return
+
+        start = self._position
+        if( self._previous is not None ):
+            # Find where around here looks most like the audio that followed
+            # the last frame we used
+            natural = samples[self._previous + _HOP:self._previous + _FRAME].astype(np.float32)
+            low = max(0, start - _TOLERANCE)
+            high = min(len(samples) - _HOP, start + _TOLERANCE)
+            if( len(natural) == _HOP and high > low ):
+                region = samples[low:high + _HOP].astype(np.float32)
+                start = low + int(np.argmax(np.correlate(region, natural, mode="valid")))
+
+        frame = samples[start:start + _FRAME].astype(np.float32)
+        if( len(frame) < _FRAME ):
+            frame = np.pad(frame, (0, _FRAME - len(frame)))
+        frame *= self._window
+        head = frame[:_HOP] if self._tail is None else self._tail + frame[:_HOP]
+        self._tail = frame[_HOP:]
+        self._pending = np.concatenate((self._pending, np.clip(head, -32767, 32767).astype(np.int16)))
+        self._previous = start
+        self._position += int(round(_HOP * self._speed))
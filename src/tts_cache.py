@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# tts_cache.py
+#
+# Keeps rendered speech on disk so that prompts we've already said once can
+# be played straight from a WAV file instead of waiting on espeak-ng again.
+# Speech that isn't cached yet can be streamed while it's synthesized, and is
+# saved to the cache on the way through.
+
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+from threading import Lock
+import metrics
+import startup
+from speech_stream import SpeechStream
+from wav_reader import WavError, repair_header
+
+_SPEECH_UTIL = 'espeak-ng'
+_DEFAULT_VOICE = 'en-us+f2'
+_DEFAULT_CACHE_DIR = "/var/cache/tattle/tts"
+_DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+_CACHE_SUFFIX = ".wav"
+
+# Remembers what espeak-ng --version said, so we don't have to ask at every boot
+_VERSION_FILE = "engine_version"
+
+_HITS = metrics.counter("tattle_tts_cache_hits_total", "Speech played straight from the cache")
+_MISSES = metrics.counter("tattle_tts_cache_misses_total", "Speech that had to be synthesized")
+_RENDER_TIME = metrics.histogram("tattle_tts_render_seconds", "Time taken for espeak-ng to render speech to the cache")
+
+class CacheEntryWriter():
+    """Saves speech into the cache as it's streamed, only adding it once the
+    whole thing has been written
+    """
+    def __init__(self, cache:"TTSCache", text:str):
+        self._cache = cache
+        self._path = cache.path_for(text)
+        # Named for the thread, two calls could be saying the same thing
+        self._tmp_path = self._path.with_name(f"{self._path.stem}.{threading.get_ident()}.tmp")
+        self._file = open(self._tmp_path, "w+b")
+
+    def write(self, data:bytes):
+        self._file.write(data)
+
+    def commit(self):
+        """Fix up the header, which espeak-ng leaves without sizes when it
+        writes to a pipe, and put the entry in place
+        """
+        try:
+            repair_header(self._file)
+            self._file.close()
+            os.replace(self._tmp_path, self._path)
+        except (OSError, WavError) as e:
+            logging.error("TTSCache: Unable to save %s: %s", self._path.name, e)
+            self.discard()
+            return
+        self._cache._added(self._path)
+
+    def discard(self):
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+class TTSCache():
+    """Content addressed cache of rendered speech.
+
+    Entries are keyed on the text, the voice and the version of the speech
+    engine, so upgrading espeak-ng or changing the voice never plays a stale
+    rendering. The total size of the cache is bounded, least recently used
+    entries are evicted first. The modification time of each file is used as
+    its "last used" time, since the SD card is normally mounted noatime.
+    """
+    def __init__(self, cache_dir:str=_DEFAULT_CACHE_DIR, voice:str=_DEFAULT_VOICE, max_bytes:int=_DEFAULT_MAX_BYTES):
+        self._dir = Path(cache_dir)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._voice = voice
+        self._max_bytes = max_bytes
+        self._speech_util = startup.which(_SPEECH_UTIL)
+        self._engine_version = self._get_engine_version()
+
+        # Only one render at a time, stops warm-up and the player from
+        # synthesizing the same thing twice.
+        self._lock = Lock()
+        self._size = sum(entry.stat().st_size for entry in self._dir.glob("*" + _CACHE_SUFFIX))
+
+    @property
+    def voice(self) -> str:
+        return self._voice
+
+    def _get_engine_version(self) -> str:
+        """Ask the speech engine what version it is. The answer is kept in
+        the cache directory and reused for as long as the executable is the
+        same file, since running it costs us at startup.
+
+        Returns:
+            str: First line of the version banner, or "unknown"
+        """
+        if( self._speech_util is None ):
+            return "unknown"
+        version_file = Path(self._dir, _VERSION_FILE)
+        try:
+            stat = os.stat(self._speech_util)
+            stamp = f"{self._speech_util}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            stamp = None
+        try:
+            saved_stamp, saved_version = version_file.read_text().split("\n", 1)
+            if( stamp is not None and saved_stamp == stamp ):
+                return saved_version
+        except (OSError, ValueError):
+            pass
+
+        try:
+            result = subprocess.run([self._speech_util, "--version"], capture_output=True, text=True, timeout=5)
+            version = result.stdout.strip().splitlines()[0]
+        except (OSError, subprocess.SubprocessError, IndexError):
+            logging.warning("TTSCache: Unable to determine the %s version", _SPEECH_UTIL)
+            return "unknown"
+        if( stamp is not None ):
+            try:
+                version_file.write_text(f"{stamp}\n{version}")
+            except OSError:
+                pass
+        return version
+
+    def key(self, text:str) -> str:
+        """Compute the cache key for the given text.
+
+        Args:
+            text (str): Text that would be spoken
+
+        Returns:
+            str: Hex digest identifying this rendering
+        """
+        material = "\0".join((self._engine_version, self._voice, text))
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def path_for(self, text:str) -> Path:
+        """Where the rendering of this text lives (or would live)
+
+        Args:
+            text (str): Text that would be spoken
+
+        Returns:
+            Path: Location of the cached WAV file
+        """
+        return Path(self._dir, self.key(text) + _CACHE_SUFFIX)
+
+    def lookup(self, text:str) -> Path:
+        """Find an existing rendering of the text, marking it as recently used.
+
+        Args:
+            text (str): Text that would be spoken
+
+        Returns:
+            Path: Location of the cached WAV file, None on a miss
+        """
+        path = self.path_for(text)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def cached(self, text:str) -> Path:
+        """Like lookup(), but counted as a cache hit or miss, for players
+        that will stream() the text if it isn't cached
+
+        Args:
+            text (str): Text that would be spoken
+
+        Returns:
+            Path: Location of the cached WAV file, None on a miss
+        """
+        path = self.lookup(text)
+        if( path is not None ):
+            _HITS.inc()
+        else:
+            _MISSES.inc()
+        return path
+
+    def stream(self, text:str) -> SpeechStream:
+        """Start synthesizing the text so it can be played as it comes,
+        saving it in the cache if it's synthesized in full
+
+        Args:
+            text (str): Text to be spoken
+
+        Returns:
+            SpeechStream: the speech, close() it once it's been played
+        """
+        logging.debug("TTSCache: Streaming '%s'", text)
+        return SpeechStream(self.stream_args(text), CacheEntryWriter(self, text))
+
+    def stream_args(self, text:str) -> list:
+        """Command line which synthesizes the text as WAV on stdout, for
+        players that stream it themselves and save it with a CacheEntryWriter
+        """
+        return [self._speech_util, f"-v{self._voice}", "--stdout", text]
+
+    def _added(self, path:Path):
+        """Account for a new entry
+        """
+        with self._lock:
+            self._size += path.stat().st_size
+            self._evict(keep=path)
+
+    def render(self, text:str) -> Path:
+        """Return a WAV file with the given text spoken, synthesizing it if
+        it isn't already in the cache.
+
+        Args:
+            text (str): Text to be spoken
+
+        Returns:
+            Path: Location of the cached WAV file, None if synthesis failed
+        """
+        path = self.lookup(text)
+        if( path is not None ):
+            _HITS.inc()
+            return path
+
+        _MISSES.inc()
+        with self._lock:
+            # Someone may have rendered it while we waited
+            path = self.lookup(text)
+            if( path is not None ):
+                return path
+
+            path = self.path_for(text)
+            tmp_path = path.with_suffix(".tmp")
+            logging.debug("TTSCache: Rendering '%s'", text)
+            try:
+                with _RENDER_TIME.time():
+                    subprocess.run([self._speech_util, f"-v{self._voice}", "-w", str(tmp_path), text], check=True)
+                os.replace(tmp_path, path)
+            except (OSError, TypeError, subprocess.SubprocessError) as e:
+                logging.error("TTSCache: Failed to render '%s': %s", text, e)
+                tmp_path.unlink(missing_ok=True)
+                return None
+
+            self._size += path.stat().st_size
+            self._evict(keep=path)
+        return path
+
+    def warm(self, texts):
+        """Make sure each of the given texts is in the cache.
+
+        Args:
+            texts (iterable): Texts we expect to need soon
+        """
+        for text in texts:
+            self.render(text)
+
+    def _evict(self, keep:Path):
+        """Remove least recently used entries until we're under our size
+        budget. Must be called with the lock held.
+
+        Args:
+            keep (Path): Entry which must survive, normally the one just rendered
+        """
+        if( self._size <= self._max_bytes ):
+            return
+
+        entries = []
+        for entry in self._dir.glob("*" + _CACHE_SUFFIX):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if( self._size <= self._max_bytes ):
+                break
+            if( entry == keep ):
+                continue
+            logging.debug("TTSCache: Evicting %s", entry.name)
+            entry.unlink(missing_ok=True)
+            self._size -= size
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    cache = TTSCache("tts_cache_test")
+    print(cache.render("now is the time for all good men to come to the aid of their country."))
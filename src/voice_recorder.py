@@ -2,45 +2,289 @@
 
 # voice-recorder.py
 #
-# A class that will cheat and use arecord to record voice messages to a file
+# A class that will cheat and use arecord to record voice messages to a file,
+# piping it through an encoder on the way if we're storing compressed audio.
+# The file is written by a RecordingWriter, see recording_writer.py.
 
 import subprocess
 from threading import Event, Thread
-import shutil
+from queue import Queue, Empty
 import logging
 import time
-from datetime import datetime
 from pathlib import Path
+import metrics
+import startup
+from recording_writer import RecordingWriter
 
 _RECORD_EXECUTABLE = 'arecord'
 
+# What we capture from the microphone
+CAPTURE_RATE = 16000
+CAPTURE_CHANNELS = 1
+CAPTURE_FORMAT = 'S16_LE'
+
+# How long we give an encoder to finish up after the capture stops
+_ENCODER_TIMEOUT_SEC = 10
+
+# How far before the recording was asked for to start it, when we're fed by
+# a warm capture stream. Covers the time it takes the beep to reach the ear.
+_DEFAULT_PREROLL_SEC = 0.1
+
+# Default limits on a single recording, and how often we check them
+DEFAULT_MAX_RECORD_SEC = 120
+_LIMIT_CHECK_SEC = 0.1
+
+_BYTES_PER_FRAME = 2 * CAPTURE_CHANNELS
+_READ_BYTES = int(CAPTURE_RATE * _LIMIT_CHECK_SEC) * _BYTES_PER_FRAME
+
+# Command lines for encoders which read raw capture data on stdin
+_ENCODERS = {
+    "flac": ['flac', '--silent', '--force', '--force-raw-format', '--endian=little', '--sign=signed',
+             f'--channels={CAPTURE_CHANNELS}', '--bps=16', f'--sample-rate={CAPTURE_RATE}',
+             '--output-name={file}', '-'],
+    "opus": ['opusenc', '--quiet', '--raw', '--raw-bits=16', f'--raw-rate={CAPTURE_RATE}',
+             f'--raw-chan={CAPTURE_CHANNELS}', '--raw-endianness=0', '-', '{file}'],
+}
+
+# flac has to be told to write to stdout, rather than given "-" as a file name
+_TO_STDOUT = {
+    '--output-name={file}': '--stdout',
+}
+
+# File extension for each of the encodings we support
+ENCODING_EXTENSIONS = {
+    "wav": ".wav",
+    "flac": ".flac",
+    "opus": ".opus",
+}
+
+def capture_args(executable:str, output:str, device:str=None) -> list:
+    """Command line for arecord
+
+    Args:
+        executable (str): where arecord is
+        output (str): file to write a WAV to, or "-" for raw samples on stdout
+        device (str, optional): ALSA device to capture from, None for arecord's default
+
+    Returns:
+        list: the command line
+    """
+    args = [executable, "-q"]
+    if( device is not None ):
+        args += ["-D", device]
+    return args + ["-t", "raw" if output == "-" else "wav",
+                   "-f", CAPTURE_FORMAT, "-r", str(CAPTURE_RATE), "-c", str(CAPTURE_CHANNELS), output]
+
+def encoder_args(encoding:str, filename) -> list:
+    """Command line for an encoder reading raw capture data on stdin
+
+    Args:
+        encoding (str): one of the keys of ENCODING_EXTENSIONS
+        filename: where the encoder should write to, "-" for stdout
+
+    Returns:
+        list: the command line, None if the encoding doesn't need an encoder
+    """
+    if( encoding not in _ENCODERS ):
+        return None
+    args = _ENCODERS[encoding]
+    if( filename == "-" ):
+        args = [_TO_STDOUT.get(arg, arg) for arg in args]
+    return [startup.which(args[0])] + [arg.format(file=filename) for arg in args[1:]]
+
+def tools_missing(encoding:str) -> list:
+    """Which of the command line tools needed to record in an encoding
+    aren't installed
+
+    Args:
+        encoding (str): one of the keys of ENCODING_EXTENSIONS
+
+    Returns:
+        list: names of the missing tools, empty if we have everything
+    """
+    tools = [_RECORD_EXECUTABLE] + ([_ENCODERS[encoding][0]] if encoding in _ENCODERS else [])
+    return [tool for tool in tools if startup.which(tool) is None]
+
+_SPAWN_TIME = metrics.histogram("tattle_recorder_spawn_seconds", "Time taken to start arecord and the encoder")
+_BYTES_WRITTEN = metrics.counter("tattle_recording_bytes_total", "Bytes of recordings written")
+
 class VoiceRecorder(Thread):
     """VoiceRecorder class is very direct, basically just records to a file.
+    The encoding is taken from the file extension.
+
+    Given a running CaptureStream the recording is fed from that, starting
+    with audio from just before the recorder was created, otherwise it
+    starts arecord itself.
     """
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, capture_stream=None, preroll_sec:float=_DEFAULT_PREROLL_SEC,
+                 max_sec:float=DEFAULT_MAX_RECORD_SEC, max_bytes:int=None, device:str=None):
+        """
+        Args:
+            filename (str): where to record to
+            capture_stream (CaptureStream, optional): a warm stream to record from
+            preroll_sec (float, optional): how much audio from before now to include
+            max_sec (float, optional): stop recording after this many seconds
+            max_bytes (int, optional): stop recording once the file is this big
+            device (str, optional): ALSA device to capture from, when not using the stream
+        """
         super().__init__()
         self.name = "VoiceRecorder"
         self._filename = Path(filename)
-        self._executable = shutil.which(_RECORD_EXECUTABLE)
+        self._executable = startup.which(_RECORD_EXECUTABLE)
         self._kill_event = Event()
-    
+        self._capture_stream = capture_stream
+        self._start_from = time.monotonic() - preroll_sec
+        self._max_sec = max_sec
+        self._max_bytes = max_bytes
+        self._device = device
+        self._writer = None
+
+        self._encoding = self._filename.suffix.lower().lstrip(".")
+        if( self._encoding not in ENCODING_EXTENSIONS ):
+            raise ValueError(f"Don't know how to record to {self._filename.name}")
+
+    def _record_from_stream(self, write) -> bool:
+        """Record what the capture stream hands us
+
+        Args:
+            write (callable): where the raw capture data goes
+
+        Returns:
+            bool: False if the stream wasn't running, nothing was recorded
+        """
+        chunks = Queue()
+        if( not self._capture_stream.attach(chunks.put, self._start_from) ):
+            return False
+        logging.debug("Starting recording to %s from the capture stream", self._filename.name)
+
+        try:
+            # Until someone tells us to die, then whatever's left
+            started = time.monotonic()
+            while( not self._kill_event.is_set() and not self._limit_reached(started) ):
+                try:
+                    write(chunks.get(timeout=_LIMIT_CHECK_SEC))
+                except Empty:
+                    pass
+        finally:
+            self._capture_stream.detach()
+        while( not chunks.empty() ):
+            write(chunks.get_nowait())
+        return True
+
+    def _record_from_arecord(self, write):
+        """Start arecord ourselves and record what it captures
+
+        Args:
+            write (callable): where the raw capture data goes
+        """
+        with _SPAWN_TIME.time():
+            proc = subprocess.Popen(capture_args(self._executable, "-", self._device), stdout=subprocess.PIPE)
+        logging.debug("Starting recording to %s", self._filename.name)
+
+        try:
+            # Reads are a limit check's worth of audio, so they come back
+            # often enough to notice being told to die
+            started = time.monotonic()
+            while( not self._kill_event.is_set() and not self._limit_reached(started) ):
+                chunk = proc.stdout.read(_READ_BYTES)
+                if( len(chunk) == 0 ):
+                    logging.error("arecord stopped unexpectedly while recording %s", self._filename.name)
+                    break
+                write(chunk)
+        finally:
+            # Die, politely so that we get everything arecord captured
+            proc.terminate()
+            for chunk in iter(lambda: proc.stdout.read(_READ_BYTES), b""):
+                write(chunk)
+            proc.wait()
+
+    def _drain_encoder(self, encoder:subprocess.Popen, writer:RecordingWriter):
+        """Copy what the encoder writes to the recording, on its own thread
+        so the encoder never blocks on a full pipe while we're feeding it
+        """
+        for chunk in iter(lambda: encoder.stdout.read(_READ_BYTES), b""):
+            writer.write(chunk)
+
     def run(self):
-        """Uses arecorord to record to the given wavefile
+        """Record from the capture stream, or arecord if there isn't one,
+        through an encoder if needed. Everything goes through a
+        RecordingWriter, so the recording only appears under its real name
+        once it's finished and its header is right.
         """
-        # Figure out the location of the executable
-        args = [self._executable, self._filename]
+        writer = RecordingWriter(self._filename, CAPTURE_RATE, CAPTURE_CHANNELS) if self._encoding == "wav" else RecordingWriter(self._filename)
+        self._writer = writer
+        captured = 0
+        encoder = None
+        drain = None
+        failed = False
+        try:
+            encoder_command = encoder_args(self._encoding, "-")
+            if( encoder_command is not None ):
+                with _SPAWN_TIME.time():
+                    encoder = subprocess.Popen(encoder_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                drain = Thread(target=self._drain_encoder, args=(encoder, writer), name="EncoderDrain", daemon=True)
+                drain.start()
+                output = encoder.stdin.write
+            else:
+                output = writer.write
 
-        # Start recording to file
-        logging.debug(f"Starting recording to {self._filename.name}")
-        proc = subprocess.Popen(args)
+            def write(chunk:bytes):
+                nonlocal captured
+                captured += len(chunk)
+                output(chunk)
 
-        # Wait until someone tells us to die
-        self._kill_event.wait(timeout=120)        
+            if( self._capture_stream is None or not self._record_from_stream(write) ):
+                self._record_from_arecord(write)
+        except BrokenPipeError:
+            logging.error("Encoder for %s stopped early", self._filename.name)
+        except (OSError, TypeError) as e:
+            # TypeError is Popen() being handed None, a tool that isn't installed
+            logging.error("Unable to record %s: %s", self._filename.name, e)
+            failed = True
+        finally:
+            if( encoder is not None ):
+                try:
+                    encoder.stdin.close()
+                except BrokenPipeError:
+                    pass
+                try:
+                    encoder.wait(timeout=_ENCODER_TIMEOUT_SEC)
+                except subprocess.TimeoutExpired:
+                    logging.error("Encoder didn't finish %s in time", self._filename.name)
+                    encoder.kill()
+                drain.join()
+
+        if( failed ):
+            writer.abort()
+            return
+        try:
+            writer.finish(captured // _BYTES_PER_FRAME)
+        except (OSError, ValueError) as e:
+            logging.error("Unable to finish recording %s: %s", self._filename.name, e)
+            writer.abort()
+            return
+        _BYTES_WRITTEN.inc(writer.size)
+        logging.debug("Completed recording to %s", self._filename.name)
+
+    def _limit_reached(self, started:float) -> bool:
+        """Check whether the recording has gone on too long or got too big
+
+        Args:
+            started (float): time.monotonic() when recording started
+
+        Returns:
+            bool: True if it's time to stop
+        """
+        if( self._max_sec is not None and time.monotonic() - started >= self._max_sec ):
+            logging.info("Recording %s reached %.0f seconds, stopping", self._filename.name, self._max_sec)
+            return True
+        if( self._max_bytes is not None and self._writer is not None ):
+            size = self._writer.size
+            if( size >= self._max_bytes ):
+                logging.info("Recording %s reached %d bytes, stopping", self._filename.name, size)
+                return True
+        return False
 
-        # Die
-        proc.kill()
-        logging.debug(f"Completed recording to {self._filename.name}")
-    
     def kill(self):
         """Kill the subprocess we started
         """
@@ -49,9 +293,9 @@ class VoiceRecorder(Thread):
 if (__name__ == "__main__"):
     """Run a quick test of voice recorder by recording to the given file.
     """
-    print("This test will record a wave file for 8 seconds and then die.")
-    recorder = VoiceRecorder("hudson_test.wav")
+    print("This test will record a flac file for 8 seconds and then die.")
+    recorder = VoiceRecorder("hudson_test.flac")
     recorder.start()
     time.sleep(8)
     recorder.kill()
-    recorder.join()
\ No newline at end of file
+    recorder.join()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# wav_reader.py
+#
+# Reads WAV files by memory-mapping them rather than reading them into
+# Python bytes. Frames are handed out as views straight onto the mapping, so
+# jumping to a point in a recording is just arithmetic, and only the pages
+# that are actually looked at are read from the SD card.
+
+import mmap
+import os
+import struct
+import startup
+np = startup.lazy_import("numpy")
+
+_RIFF_HEADER_BYTES = 12
+_CHUNK_HEADER_BYTES = 8
+
+# Largest size a RIFF header has room for
+_UNKNOWN_SIZE = 0xFFFFFFFF
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample formats numpy can view without converting
+_DTYPES = {
+    (_WAVE_FORMAT_PCM, 8):         "u1",
+    (_WAVE_FORMAT_PCM, 16):        "<i2",
+    (_WAVE_FORMAT_PCM, 32):        "<i4",
+    (_WAVE_FORMAT_IEEE_FLOAT, 32): "<f4",
+    (_WAVE_FORMAT_IEEE_FLOAT, 64): "<f8",
+}
+
+class WavError(Exception):
+    """Raised when we're handed a WAV file we don't understand
+    """
+    pass
+
+class WavFormat():
+    """What's in a WAV file's fmt chunk, and where its data chunk is
+    """
+    def __init__(self, format_tag:int, channels:int, rate:int, bits:int, data_offset:int, data_bytes:int):
+        self.format_tag = format_tag
+        self.channels = channels
+        self.rate = rate
+        self.bits = bits
+        self.data_offset = data_offset
+        self.data_bytes = data_bytes
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.channels * self.bits // 8
+
+    @property
+    def frames(self) -> int:
+        return self.data_bytes // self.frame_bytes
+
+def parse_header(data) -> WavFormat:
+    """Find the format and the sample data in a RIFF/WAVE buffer. Copes with
+    the extensible header, and with the bogus data lengths written by tools
+    that stream WAV to stdout.
+
+    Args:
+        data (bytes-like): the WAV file, or as much of it as there is
+
+    Returns:
+        WavFormat: the format, with the data chunk cut down to whole frames
+            that are actually in the buffer
+    """
+    if( len(data) < _RIFF_HEADER_BYTES or data[0:4] != b"RIFF" or data[8:12] != b"WAVE" ):
+        raise WavError("Not a RIFF/WAVE file")
+
+    fmt = None
+    offset = _RIFF_HEADER_BYTES
+    while( offset + _CHUNK_HEADER_BYTES <= len(data) ):
+        chunk_id = bytes(data[offset:offset + 4])
+        chunk_size = struct.unpack_from("<I", data, offset + 4)[0]
+        body = offset + _CHUNK_HEADER_BYTES
+        if( chunk_id == b"fmt " ):
+            format_tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+            if( format_tag == _WAVE_FORMAT_EXTENSIBLE ):
+                # First two bytes of the sub-format GUID are the real format
+                format_tag = struct.unpack_from("<H", data, body + 24)[0]
+            fmt = (format_tag, channels, rate, bits)
+        elif( chunk_id == b"data" ):
+            if( fmt is None ):
+                raise WavError("data chunk before fmt chunk")
+            format_tag, channels, rate, bits = fmt
+            if( channels == 0 or bits == 0 ):
+                raise WavError(f"Bad format, {channels} channels of {bits} bits")
+            data_bytes = min(chunk_size, len(data) - body)
+            data_bytes -= data_bytes % (channels * bits // 8)
+            return WavFormat(format_tag, channels, rate, bits, body, data_bytes)
+        offset = body + chunk_size + (chunk_size & 1)
+    raise WavError("No data chunk found")
+
+def repair_header(f):
+    """Fill in the sizes in a WAV file's header to match what's actually in
+    it, dropping any half written frame at the end. For files that were
+    written by something that didn't know how long they'd be.
+
+    Args:
+        f (file): the WAV file, open for reading and writing
+    """
+    f.seek(0)
+    fmt = parse_header(f.read(4096))
+    size = os.fstat(f.fileno()).st_size
+    data_bytes = min(size - fmt.data_offset, _UNKNOWN_SIZE)
+    data_bytes -= data_bytes % fmt.frame_bytes
+    f.truncate(fmt.data_offset + data_bytes)
+    f.seek(4)
+    f.write(struct.pack("<I", fmt.data_offset - 8 + data_bytes))
+    f.seek(fmt.data_offset - 4)
+    f.write(struct.pack("<I", data_bytes))
+
+class WavFile():
+    """A memory-mapped WAV file. Everything it hands out is a view onto the
+    mapping, so keep the file open while they're in use.
+    """
+    def __init__(self, path):
+        """Map the file and read its header
+
+        Args:
+            path (str): the WAV file
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise WavError(f"{path} is empty")
+        self._view = memoryview(self._map)
+        try:
+            self.format = parse_header(self._view)
+        except (WavError, struct.error):
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap the file. If any views are still in use the mapping is left
+        for the garbage collector to clean up once they've gone.
+        """
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+    @property
+    def rate(self) -> int:
+        return self.format.rate
+
+    @property
+    def channels(self) -> int:
+        return self.format.channels
+
+    @property
+    def frames(self) -> int:
+        return self.format.frames
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.rate
+
+    @property
+    def can_view(self) -> bool:
+        """Whether samples() can hand out this file's samples as they are,
+        e.g. 24 bit ones have to be converted
+        """
+        return (self.format.format_tag, self.format.bits) in _DTYPES
+
+    def _clamp(self, start:int, count:int) -> tuple:
+        start = min(max(0, start), self.frames)
+        if( count is None ):
+            count = self.frames - start
+        return start, min(max(0, count), self.frames - start)
+
+    def frame_bytes(self, start:int=0, count:int=None) -> memoryview:
+        """Raw sample data, without copying it
+
+        Args:
+            start (int, optional): first frame
+            count (int, optional): how many frames, defaults to the rest of the file
+
+        Returns:
+            memoryview: the frames, interleaved as they are in the file
+        """
+        start, count = self._clamp(start, count)
+        offset = self.format.data_offset + start * self.format.frame_bytes
+        return self._view[offset:offset + count * self.format.frame_bytes]
+
+    def samples(self, start:int=0, count:int=None) -> "np.ndarray":
+        """Samples in the file's own format, without copying them
+
+        Args:
+            start (int, optional): first frame
+            count (int, optional): how many frames, defaults to the rest of the file
+
+        Returns:
+            np.ndarray: one row per frame, one column per channel, read only
+        """
+        dtype = _DTYPES.get((self.format.format_tag, self.format.bits))
+        if( dtype is None ):
+            raise WavError(f"Can't view {self.format.bits} bit samples of format {self.format.format_tag:#x}")
+        start, count = self._clamp(start, count)
+        return np.frombuffer(self._map, dtype=dtype, count=count * self.channels,
+                             offset=self.format.data_offset + start * self.format.frame_bytes).reshape(count, self.channels)
+
+    def blocks(self, block_frames:int, start:int=0):
+        """Walk through the file a block at a time
+
+        Args:
+            block_frames (int): frames per block, the last one may be short
+            start (int, optional): frame to start from
+
+        Yields:
+            np.ndarray: each block, as samples() would return it
+        """
+        for offset in range(max(0, start), self.frames, block_frames):
+            yield self.samples(offset, block_frames)